@@ -14,7 +14,8 @@ module kb_hisat2 {
                                   KBaseAssembly.SingleEndLibrary, KBaseAssembly.PairedEndLibrary,
                                   KBaseFile.SingleEndLibrary, KBaseFile.PairedEndLibrary
     genome_ref = the workspace reference for the reference genome that HISAT2 will align against.
-    num_threads = the number of threads to tell hisat to use (default 2)
+    num_threads = the maximum number of threads to tell hisat to use (default is every CPU the job's
+                  container is allowed to use)
     quality_score = one of phred33 or phred64
     skip = number of initial reads to skip (default 0)
     trim3 = number of bases to trim off of the 3' end of each read (default 0)
@@ -27,9 +28,40 @@ module kb_hisat2 {
     max_intron_length = sets maximum intron length (default 500,000)
     no_spliced_alignment = disable spliced alignment
     tailor_alignments = report alignments tailored for either cufflinks or stringtie
+    stream_reads = 1 to stream reads straight from Shock into HISAT2 through named pipes, so alignment starts
+                   while they're still downloading and the uncompressed FASTQ files never land in scratch.
+                   (default 0)
+    shared_index = 1 to have HISAT2 memory-map the index, after reading it into the page cache once, so every
+                   HISAT2 process aligning against it on the node shares one copy in memory. With the "local_pool"
+                   runner, that lets more libraries align at once. (default 0)
+    num_shards = number of shards to split a single reads library into, to align them in parallel and
+                 merge the results into one alignment. Ignored for sets. (default 1, no splitting)
+    multiplex = 1 to align the small libraries in a set (by the read counts in their metadata) in groups, each
+                group through a single HISAT2 process that loads the index once, then split its output back
+                into an alignment per library. Only used for sets. (default 0)
     condition = a string stating the experimental condition of the reads. REQUIRED for single reads,
                 ignored for sets.
+    runner = how to run the alignments when sampleset_ref is a set of reads libraries, or a library is split
+             into shards. One of
+             "parallel" - align each library (or shard) in its own KBParallel subtask (default)
+             "local_pool" - align all libraries (or shards) on this node, with a pool of workers sized to its
+                            CPUs and memory
+             "hybrid" - align the small libraries in a set (by the total bases in their metadata) on this node,
+                        and the big ones in KBParallel subtasks at the same time. Shards always go to KBParallel.
+                        The report lists where each library was aligned.
+    max_concurrent_tasks = the most alignments of a set's libraries (or a library's shards) to run at once, as
+                           KBParallel subtasks or local workers. The biggest libraries always start first.
+                           (default is as many as the runner allows)
+    max_scratch_gb = the most scratch space, in GB, that the samples in flight may use at once when running
+                     with the "local_pool" runner (default is 80% of the free space)
+    qc_mode = how the report checks the quality of the alignments. One of
+              "native" - report the stats HISAT2 gathers while aligning (default)
+              "qualimap" - also run QualiMap's BAM QC on each alignment, starting as soon as it's uploaded
     build_report = 1 if we build a report, 0 otherwise. (default 1) (shouldn't be user set - mainly used for subtasks)
+    index_shock_id = Shock node id of a packed HISAT2 index built by a parent job, so subtasks don't each
+                     rebuild the index. (shouldn't be user set - mainly used for subtasks)
+    shard = a shard of a reads library uploaded by a parent job, for a subtask to align on its own.
+            (shouldn't be user set - mainly used for subtasks)
     output naming:
         alignment_suffix is appended to the name of each individual reads object name (just the one if
         it's a simple input of a single reads library, but to each if it's a set)
@@ -55,7 +87,17 @@ module kb_hisat2 {
         int max_intron_length;
         bool no_spliced_alignment;
         string tailor_alignments;
+        bool stream_reads;
+        bool shared_index;
+        int num_shards;
+        bool multiplex;
+        string runner;
+        int max_concurrent_tasks;
+        int max_scratch_gb;
+        string qc_mode;
         bool build_report;
+        string index_shock_id;
+        UnspecifiedObject shard;
     } Hisat2Params;
 
 
@@ -63,10 +105,13 @@ module kb_hisat2 {
     Created alignment object returned.
     alignment_ref = the workspace reference of the new alignment object
     name = the name of the new object, for convenience.
+    alignment_stats = the stats gathered while aligning: HISAT2's summary, mapped counts per contig,
+                      and MAPQ, splice, and insert size counts.
 */
     typedef structure {
         string alignment_ref;
         string name;
+        UnspecifiedObject alignment_stats;
     } AlignmentObj;
 
 /*
@@ -74,12 +119,17 @@ module kb_hisat2 {
     alignmentset_ref if an alignment set is created
     alignment_objs for each individual alignment created. The keys are the references to the reads
         object being aligned.
+    shard_alignment is only set by subtasks aligning a shard - its index, the Shock node id of its BAM
+        file, and its alignment stats.
+    profile_file is the path, in scratch, of the JSON profile of the run. Each run gets its own.
 */
     typedef structure {
 		string report_name;
 		string report_ref;
         string alignmentset_ref;
         mapping<string reads_ref, AlignmentObj> alignment_objs;
+        UnspecifiedObject shard_alignment;
+        string profile_file;
     } Hisat2Output;
 
     funcdef run_hisat2(Hisat2Params params)
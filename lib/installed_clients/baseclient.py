@@ -7,10 +7,12 @@
 
 from __future__ import print_function
 
+import gzip as _gzip
 import json as _json
 import requests as _requests
 import random as _random
 import os as _os
+import threading as _threading
 import traceback as _traceback
 from requests.exceptions import ConnectionError
 from urllib3.exceptions import ProtocolError
@@ -29,6 +31,45 @@ import time
 _CT = 'content-type'
 _AJ = 'application/json'
 _URL_SCHEME = frozenset(['http', 'https'])
+
+_DEFAULT_POOL_SIZE = 10
+
+
+def _env_pool_size():
+    # a bad value in the environment shouldn't stop every client from being made
+    try:
+        pool_size = int(_os.environ.get('KB_CLIENT_POOL_SIZE', _DEFAULT_POOL_SIZE))
+    except ValueError:
+        return _DEFAULT_POOL_SIZE
+    return max(1, pool_size)
+
+
+# Connection pooling defaults, for clients that don't set them explicitly (which includes
+# every generated client, since they don't pass these through).
+_POOL_SIZE = _env_pool_size()
+_KEEP_ALIVE = _os.environ.get('KB_CLIENT_KEEP_ALIVE', '1') != '0'
+# gzip is off unless asked for, since not every service accepts a compressed request body.
+_GZIP = _os.environ.get('KB_CLIENT_GZIP', '0') != '0'
+# request bodies smaller than this aren't worth compressing
+_GZIP_MIN_BYTES = 64 * 1024
+
+# One connection pool (a requests HTTPAdapter) per (scheme://host:port, pool size), shared by
+# every client in the process, so calls reuse open (TLS) connections instead of making a new
+# one each time. Sessions, which carry cookies, aren't shared: each client has its own in
+# each thread, with the shared pools mounted on it.
+_adapters = dict()
+_adapters_lock = _threading.Lock()
+
+
+def _get_adapter(base_url, pool_size):
+    key = (base_url, pool_size)
+    with _adapters_lock:
+        adapter = _adapters.get(key)
+        if adapter is None:
+            adapter = _requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=pool_size)
+            _adapters[key] = adapter
+    return adapter
 _CHECK_JOB_RETRYS = 3
 
 
@@ -120,6 +161,17 @@ class BaseClient(object):
     lookup_url - set to true when contacting KBase dynamic services.
     async_job_check_time_ms - the wait time between checking job state for
         asynchronous jobs run with the run_job method.
+    pool_size - the most connections kept open to the service. Default is the
+        KB_CLIENT_POOL_SIZE environment variable, or 10 if that isn't set to a
+        number.
+    keep_alive - if False, close each connection after its call. Default is
+        False if the KB_CLIENT_KEEP_ALIVE environment variable is 0, True
+        otherwise.
+    gzip - if True, gzip request bodies of at least 64 KB, and ask for gzipped
+        responses (e.g. for big get_objects2 calls). Only turn this on for
+        services that accept compressed requests. Default is True if the
+        KB_CLIENT_GZIP environment variable is set to something other than 0,
+        False otherwise.
     '''
     def __init__(
             self, url=None, timeout=30 * 60, user_id=None,
@@ -129,7 +181,10 @@ class BaseClient(object):
             lookup_url=False,
             async_job_check_time_ms=100,
             async_job_check_time_scale_percent=150,
-            async_job_check_max_time_ms=300000):
+            async_job_check_max_time_ms=300000,
+            pool_size=None,
+            keep_alive=None,
+            gzip=None):
         if url is None:
             raise ValueError('A url is required')
         scheme, _, _, _, _, _ = _urlparse(url)
@@ -144,6 +199,10 @@ class BaseClient(object):
         self.async_job_check_time_scale_percent = (
             async_job_check_time_scale_percent)
         self.async_job_check_max_time = async_job_check_max_time_ms / 1000.0
+        self.pool_size = _POOL_SIZE if pool_size is None else int(pool_size)
+        self.keep_alive = _KEEP_ALIVE if keep_alive is None else keep_alive
+        self.gzip = _GZIP if gzip is None else gzip
+        self._local = _threading.local()
         # token overrides user_id and password
         if token is not None:
             self._headers['AUTHORIZATION'] = token
@@ -164,6 +223,17 @@ class BaseClient(object):
         if self.timeout < 1:
             raise ValueError('Timeout value must be at least 1 second')
 
+    def _get_session(self, url):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = _requests.Session()
+            self._local.session = session
+        scheme, netloc, _, _, _, _ = _urlparse(url)
+        base_url = scheme + '://' + netloc + '/'
+        if base_url not in session.adapters:
+            session.mount(base_url, _get_adapter(base_url, self.pool_size))
+        return session
+
     def _call(self, url, method, params, context=None):
         arg_hash = {'method': method,
                     'params': params,
@@ -175,10 +245,20 @@ class BaseClient(object):
                 raise ValueError('context is not type dict as required.')
             arg_hash['context'] = context
 
-        body = _json.dumps(arg_hash, cls=_JSONObjectEncoder)
-        ret = _requests.post(url, data=body, headers=self._headers,
-                             timeout=self.timeout,
-                             verify=not self.trust_all_ssl_certificates)
+        body = _json.dumps(arg_hash, cls=_JSONObjectEncoder).encode('utf-8')
+        headers = dict(self._headers)
+        if not self.keep_alive:
+            headers['Connection'] = 'close'
+        if self.gzip:
+            # requests decodes a gzipped response on its own, before ret.json() reads it.
+            headers['Accept-Encoding'] = 'gzip'
+            if len(body) >= _GZIP_MIN_BYTES:
+                body = _gzip.compress(body)
+                headers['Content-Encoding'] = 'gzip'
+        session = self._get_session(url)
+        ret = session.post(url, data=body, headers=headers,
+                           timeout=self.timeout,
+                           verify=not self.trust_all_ssl_certificates)
         ret.encoding = 'utf-8'
         if ret.status_code == 500:
             if ret.headers.get(_CT) == _AJ:
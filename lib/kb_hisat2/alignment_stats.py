@@ -0,0 +1,441 @@
+"""
+Module: alignment_stats
+
+Gathers alignment statistics while HISAT2 is running, so the report doesn't need to read
+the finished BAM files again. HISAT2's own --new-summary output gives the alignment rates,
+and a single pass over its SAM output (on its way into samtools sort) gives per-contig
+mapped counts, a MAPQ histogram, splice counts, and insert sizes. The main use is as follows:
+
+stats = AlignmentStats()
+tee = SamStatsTee(hisat2_proc.stdout, sort_proc.stdin, stats)
+tee.start()
+... wait for hisat2 ...
+tee.join()
+stats.set_summary(parse_hisat2_summary(summary_file))
+stats.to_dict()
+
+Records are counted in batches: each chunk of SAM lines is split into lists of the fields
+we need, which are then counted with Counter.update, instead of updating a dict per record.
+"""
+
+
+import html
+import os
+import re
+import threading
+from collections import Counter
+
+CHUNK_SIZE = 4 * 1024 ** 2
+# insert sizes are binned this wide, and anything past MAX_INSERT_SIZE goes in the last bin.
+INSERT_SIZE_BIN = 10
+MAX_INSERT_SIZE = 1000
+# at most this many contigs (the ones with the most mapped reads) get reported one by one.
+MAX_REPORTED_CONTIGS = 100
+# SAM flags
+FLAG_PAIRED = 0x1
+FLAG_PROPER_PAIR = 0x2
+FLAG_UNMAPPED = 0x4
+FLAG_FIRST_MATE = 0x40
+FLAG_SECONDARY = 0x100
+FLAG_SUPPLEMENTARY = 0x800
+
+_SUMMARY_LINE = re.compile(r"^\s*(?P<key>[^:]+):\s*(?P<value>[\d.]+)(%|\s|$)")
+
+
+def parse_hisat2_summary(summary_file):
+    """
+    Parses the file written by hisat2 --new-summary --summary-file. Returns a dict of each
+    line's label to its count, e.g. {"Total reads": 15254, "Aligned 0 time": 173, ...,
+    "Overall alignment rate": 98.87}. Counts under "Total unpaired reads" (for paired-end
+    reads) get that as a prefix, e.g. "Total unpaired reads / Aligned 1 time".
+    """
+    summary = dict()
+    section = None
+    with open(summary_file) as f:
+        for line in f:
+            m = _SUMMARY_LINE.match(line)
+            if m is None:
+                continue
+            key = m.group("key").strip()
+            value = m.group("value")
+            value = float(value) if "." in value or "rate" in key else int(value)
+            # the indented counts after "Total unpaired reads" repeat the labels used for
+            # single-end reads, so they get prefixed to keep them apart.
+            if line.startswith("\t") and not line.startswith("\t\t"):
+                section = key if key == "Total unpaired reads" else None
+            elif section is not None and line.startswith("\t\t"):
+                key = "{} / {}".format(section, key)
+            summary[key] = value
+    return summary
+
+
+class AlignmentStats(object):
+    """
+    Accumulates statistics from SAM records. Only primary alignments are counted toward the
+    mapped/unmapped numbers; secondary and supplementary alignments are just counted.
+    """
+
+    def __init__(self):
+        self.records = 0
+        self.unmapped = 0
+        self.multi_mapped = 0
+        self.secondary = 0
+        self.spliced = 0
+        self.junctions = 0
+        self.contig_lengths = dict()
+        self.contigs = Counter()
+        self.mapq = Counter()
+        self.insert_sizes = Counter()
+        self.summary = dict()
+        self._partial = b""
+
+    def add_chunk(self, chunk):
+        """
+        Adds a chunk of raw SAM data, which doesn't need to end on a line boundary.
+        """
+        lines = (self._partial + chunk).split(b"\n")
+        self._partial = lines.pop()
+        self.add_lines(lines)
+
+    def finish(self):
+        """
+        Counts whatever's left over from the last chunk.
+        """
+        if self._partial:
+            self.add_lines([self._partial])
+            self._partial = b""
+
+    def add_lines(self, lines):
+        """
+        Adds a list of SAM lines (as bytes, without newlines).
+        """
+        contigs = list()
+        mapqs = list()
+        tlens = list()
+        for line in lines:
+            if not line:
+                continue
+            if line[:1] == b"@":
+                self._add_header(line)
+                continue
+            fields = line.split(b"\t", 9)
+            flag = int(fields[1])
+            if flag & (FLAG_SECONDARY | FLAG_SUPPLEMENTARY):
+                self.secondary += 1
+                continue
+            self.records += 1
+            if flag & FLAG_UNMAPPED:
+                self.unmapped += 1
+                continue
+            contigs.append(fields[2])
+            mapqs.append(fields[4])
+            nh = fields[9].find(b"\tNH:i:")
+            if nh >= 0 and fields[9][nh + 6:nh + 8] not in (b"1", b"1\t"):
+                self.multi_mapped += 1
+            if b"N" in fields[5]:
+                self.spliced += 1
+                self.junctions += fields[5].count(b"N")
+            if flag & (FLAG_PAIRED | FLAG_PROPER_PAIR | FLAG_FIRST_MATE) == \
+                    FLAG_PAIRED | FLAG_PROPER_PAIR | FLAG_FIRST_MATE:
+                tlens.append(fields[8])
+        self.contigs.update(contigs)
+        self.mapq.update(mapqs)
+        self.insert_sizes.update(tlens)
+
+    def add_file(self, sam_file):
+        """
+        Adds every record in a SAM file.
+        """
+        with open(sam_file, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                self.add_chunk(chunk)
+        self.finish()
+
+    def set_summary(self, summary):
+        self.summary = summary
+
+    def read_summary(self):
+        """
+        Returns a summary like the one from parse_hisat2_summary for single-end reads, but
+        counted from the primary alignment records, e.g. for reads that went through hisat2
+        along with other libraries' reads, so its own summary covers all of them. Each mate
+        of a pair counts as a read.
+        """
+        mapped = self.records - self.unmapped
+        return {
+            "Total reads": self.records,
+            "Aligned 0 time": self.unmapped,
+            "Aligned 1 time": mapped - self.multi_mapped,
+            "Aligned >1 times": self.multi_mapped,
+            "Overall alignment rate": round(100.0 * mapped / self.records, 2)
+            if self.records else 0.0
+        }
+
+    def _add_header(self, line):
+        if line.startswith(b"@SQ"):
+            name = length = None
+            for field in line.split(b"\t")[1:]:
+                if field.startswith(b"SN:"):
+                    name = field[3:].decode("utf-8")
+                elif field.startswith(b"LN:"):
+                    length = int(field[3:])
+            if name is not None:
+                self.contig_lengths[name] = length
+
+    def to_dict(self, max_contigs=MAX_REPORTED_CONTIGS):
+        """
+        Returns the stats as a JSON-friendly dict.
+        """
+        mapped = self.records - self.unmapped
+        mapq = Counter()
+        for (q, count) in self.mapq.items():
+            mapq[int(q)] += count
+        mapq_total = sum(q * count for (q, count) in mapq.items())
+
+        insert_hist = Counter()
+        insert_total = 0
+        insert_count = 0
+        for (tlen, count) in self.insert_sizes.items():
+            size = abs(int(tlen))
+            if size == 0:
+                continue
+            insert_total += size * count
+            insert_count += count
+            insert_hist[min(size, MAX_INSERT_SIZE) // INSERT_SIZE_BIN * INSERT_SIZE_BIN] += count
+
+        contigs = [(name.decode("utf-8"), count) for (name, count) in self.contigs.items()]
+        contigs.sort(key=lambda c: (-c[1], c[0]))
+        return {
+            "hisat2_summary": self.summary,
+            "primary_alignments": self.records,
+            "mapped": mapped,
+            "unmapped": self.unmapped,
+            "secondary_alignments": self.secondary,
+            "spliced": self.spliced,
+            "junctions": self.junctions,
+            "mean_mapq": float(mapq_total) / mapped if mapped else None,
+            "mapq_histogram": dict((str(q), mapq[q]) for q in sorted(mapq)),
+            "insert_size": {
+                "count": insert_count,
+                "mean": float(insert_total) / insert_count if insert_count else None,
+                "median": _histogram_median(insert_hist),
+                "bin_size": INSERT_SIZE_BIN,
+                "histogram": dict((str(b), insert_hist[b]) for b in sorted(insert_hist))
+            },
+            "contigs": [{"name": name, "length": self.contig_lengths.get(name), "mapped": count}
+                        for (name, count) in contigs[:max_contigs]],
+            "other_contigs_mapped": sum(count for (_, count) in contigs[max_contigs:]),
+            "num_contigs": len(self.contig_lengths)
+        }
+
+
+def merge_stats(stats_list, max_contigs=MAX_REPORTED_CONTIGS):
+    """
+    Merges the stats (from AlignmentStats.to_dict) of alignments of separate parts of the same
+    reads, like the shards of a sharded alignment, into the stats of the whole alignment.
+    Counts get added up, and means and alignment rates weighted by their counts. Contigs that
+    weren't reported one by one in a part's stats only count toward other_contigs_mapped.
+    """
+    stats_list = [stats for stats in stats_list if stats]
+    if len(stats_list) == 0:
+        return None
+    merged = {
+        "hisat2_summary": dict(),
+        "mapq_histogram": Counter(),
+        "insert_size": {"count": 0, "mean": None, "median": None, "bin_size": INSERT_SIZE_BIN,
+                        "histogram": Counter()},
+        "contigs": list(),
+        "other_contigs_mapped": 0,
+        "num_contigs": max(stats["num_contigs"] for stats in stats_list)
+    }
+    for key in ["primary_alignments", "mapped", "unmapped", "secondary_alignments", "spliced",
+                "junctions"]:
+        merged[key] = sum(stats[key] for stats in stats_list)
+
+    summary_weights = Counter()
+    insert_total = 0.0
+    contigs = Counter()
+    contig_lengths = dict()
+    for stats in stats_list:
+        summary = stats["hisat2_summary"]
+        weight = summary.get("Total pairs", summary.get("Total reads", 0))
+        for (key, value) in summary.items():
+            if isinstance(value, float):
+                merged["hisat2_summary"][key] = merged["hisat2_summary"].get(key, 0.0) + \
+                    value * weight
+                summary_weights[key] += weight
+            else:
+                merged["hisat2_summary"][key] = merged["hisat2_summary"].get(key, 0) + value
+        merged["mapq_histogram"].update(stats["mapq_histogram"])
+        merged["insert_size"]["count"] += stats["insert_size"]["count"]
+        merged["insert_size"]["histogram"].update(stats["insert_size"]["histogram"])
+        if stats["insert_size"]["count"]:
+            insert_total += stats["insert_size"]["mean"] * stats["insert_size"]["count"]
+        for contig in stats["contigs"]:
+            contigs[contig["name"]] += contig["mapped"]
+            contig_lengths[contig["name"]] = contig["length"]
+        merged["other_contigs_mapped"] += stats["other_contigs_mapped"]
+
+    for (key, weight) in summary_weights.items():
+        merged["hisat2_summary"][key] = merged["hisat2_summary"][key] / weight if weight else 0.0
+    mapq_total = sum(int(q) * count for (q, count) in merged["mapq_histogram"].items())
+    merged["mean_mapq"] = float(mapq_total) / merged["mapped"] if merged["mapped"] else None
+    merged["mapq_histogram"] = dict((q, merged["mapq_histogram"][q])
+                                    for q in sorted(merged["mapq_histogram"], key=int))
+    insert_size = merged["insert_size"]
+    if insert_size["count"]:
+        insert_size["mean"] = insert_total / insert_size["count"]
+        insert_size["median"] = _histogram_median(
+            Counter(dict((int(b), c) for (b, c) in insert_size["histogram"].items())))
+    insert_size["histogram"] = dict((b, insert_size["histogram"][b])
+                                    for b in sorted(insert_size["histogram"], key=int))
+    contigs = sorted(contigs.items(), key=lambda c: (-c[1], c[0]))
+    merged["contigs"] = [{"name": name, "length": contig_lengths[name], "mapped": count}
+                         for (name, count) in contigs[:max_contigs]]
+    merged["other_contigs_mapped"] += sum(count for (_, count) in contigs[max_contigs:])
+    return merged
+
+
+class SamStatsTee(threading.Thread):
+    """
+    Copies SAM data from src (e.g. hisat2's stdout) to dst (e.g. samtools sort's stdin),
+    and adds it to an AlignmentStats on the way through. Both ends get closed when it's done,
+    so the reader sees EOF, and the writer gets SIGPIPE if the reader went away.
+    """
+
+    def __init__(self, src, dst, stats):
+        super(SamStatsTee, self).__init__(name="sam-stats")
+        self.daemon = True
+        self.src = src
+        self.dst = dst
+        self.stats = stats
+        self.error = None
+
+    def run(self):
+        try:
+            for chunk in iter(lambda: self.src.read1(CHUNK_SIZE), b""):
+                self.dst.write(chunk)
+                self.stats.add_chunk(chunk)
+            self.stats.finish()
+        except Exception as e:
+            self.error = e
+        finally:
+            for f in [self.dst, self.src]:
+                try:
+                    f.close()
+                except Exception:
+                    pass
+
+
+def write_stats_html(stats_by_name, out_dir, title="HISAT2 Alignment Statistics",
+                     qc_pages=None):
+    """
+    Writes an HTML page of the stats (from AlignmentStats.to_dict) of one or more alignments
+    to out_dir/index.html. stats_by_name maps each alignment name to its stats, or None if
+    there aren't any. qc_pages optionally maps alignment names to the paths (relative to
+    out_dir) of their QualiMap pages, which get linked from the summary table.
+    Returns the name of the HTML file.
+    """
+    names = sorted(stats_by_name)
+    header = ["Alignment", "Primary alignments", "Mapped", "Overall alignment rate", "Spliced",
+              "Mean MAPQ", "Mean insert size", "Secondary alignments"]
+    links = list()
+    if qc_pages:
+        header.append("QualiMap report")
+        links = [_html_link(qc_pages[name], "QualiMap") if name in qc_pages else "n/a"
+                 for name in names]
+    rows = list()
+    for name in names:
+        stats = stats_by_name[name]
+        if not stats:
+            rows.append([name] + ["n/a"] * 7)
+            continue
+        rate = stats["hisat2_summary"].get("Overall alignment rate")
+        rows.append([
+            name,
+            stats["primary_alignments"],
+            stats["mapped"],
+            "{:.2f}%".format(rate) if rate is not None else "n/a",
+            stats["spliced"],
+            _format_float(stats["mean_mapq"]),
+            _format_float(stats["insert_size"]["mean"]),
+            stats["secondary_alignments"]
+        ])
+    parts = [
+        "<html><head><meta charset=\"utf-8\"><title>{}</title>".format(html.escape(title)),
+        "<style>table {border-collapse: collapse; margin-bottom: 2em;} "
+        "td, th {border: 1px solid #ccc; padding: 4px 8px; text-align: right;} "
+        "td:first-child, th:first-child {text-align: left;}</style></head><body>",
+        "<h2>{}</h2>".format(html.escape(title)),
+        _html_table(header, [row + links[idx:idx + 1] for (idx, row) in enumerate(rows)])
+    ]
+    for name in names:
+        stats = stats_by_name[name]
+        if not stats:
+            continue
+        parts.append("<h3>{}</h3>".format(html.escape(name)))
+        if stats["hisat2_summary"]:
+            parts.append("<h4>HISAT2 summary</h4>")
+            parts.append(_html_table(["", "Value"], sorted(stats["hisat2_summary"].items())))
+        parts.append("<h4>MAPQ</h4>")
+        parts.append(_html_table(["MAPQ", "Alignments"], [
+            [q, c] for (q, c) in sorted(stats["mapq_histogram"].items(), key=lambda i: int(i[0]))
+        ]))
+        if stats["insert_size"]["count"]:
+            bin_size = stats["insert_size"]["bin_size"]
+            parts.append("<h4>Insert sizes (median {})</h4>".format(
+                stats["insert_size"]["median"]))
+            parts.append(_html_table(["Insert size", "Pairs"], [
+                ["{}-{}".format(b, int(b) + bin_size - 1), c] for (b, c) in
+                sorted(stats["insert_size"]["histogram"].items(), key=lambda i: int(i[0]))
+            ]))
+        parts.append("<h4>Contigs ({} total)</h4>".format(stats["num_contigs"]))
+        contig_rows = [[c["name"], c["length"], c["mapped"]] for c in stats["contigs"]]
+        if stats["other_contigs_mapped"]:
+            contig_rows.append(["(all other contigs)", "", stats["other_contigs_mapped"]])
+        parts.append(_html_table(["Contig", "Length", "Mapped"], contig_rows))
+    parts.append("</body></html>")
+    html_file = "index.html"
+    with open(os.path.join(out_dir, html_file), "w") as f:
+        f.write("\n".join(parts))
+    return html_file
+
+
+def _html_table(header, rows):
+    out = ["<table><tr>" + "".join("<th>{}</th>".format(_html_cell(h)) for h in header)
+           + "</tr>"]
+    for row in rows:
+        out.append("<tr>" + "".join("<td>{}</td>".format(_html_cell(c)) for c in row)
+                   + "</tr>")
+    out.append("</table>")
+    return "\n".join(out)
+
+
+class _Markup(str):
+    """
+    A string of HTML that goes into a table cell as is, instead of being escaped.
+    """
+
+
+def _html_cell(value):
+    return value if isinstance(value, _Markup) else html.escape(str(value))
+
+
+def _html_link(href, text):
+    return _Markup("<a href=\"{}\">{}</a>".format(html.escape(href), html.escape(text)))
+
+
+def _histogram_median(hist):
+    total = sum(hist.values())
+    if total == 0:
+        return None
+    seen = 0
+    for b in sorted(hist):
+        seen += hist[b]
+        if seen * 2 >= total:
+            return b
+    return None
+
+
+def _format_float(value):
+    return "{:.1f}".format(value) if value is not None else "n/a"
@@ -0,0 +1,238 @@
+"""
+Module: file_cache
+
+A small on-disk cache of directories, shared between every process that points at the same
+cache root. It's used to keep expensive intermediate files (like HISAT2 indexes) around
+between runs. The main use is as follows:
+
+cache = FileCache(cache_dir, max_bytes)
+with cache.lock(key):
+    entry = cache.get(key)
+    if entry is None:
+        staging = cache.make_staging_dir()
+        ... write files into staging ...
+        entry = cache.publish(key, staging)
+... use entry ...
+cache.close()
+
+Entries are published atomically (built in a staging directory, then renamed into place),
+and evicted least-recently-used first once the cache grows past max_bytes. Entries that are
+in use are pinned with a shared file lock and never evicted. Each FileCache holds its own
+pins, on the entries it got or published, until it's closed (it can also be used as a context
+manager), so a job should use its own FileCache and close it when it's done.
+"""
+
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+ENTRY_MARKER = ".kb_cache_entry.json"
+LOCK_DIR = ".locks"
+STAGING_DIR = ".staging"
+
+
+class FileCache(object):
+    """
+    Manages a directory of cached entries, each one a directory named by its key.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        for d in [cache_dir, os.path.join(cache_dir, LOCK_DIR),
+                  os.path.join(cache_dir, STAGING_DIR)]:
+            os.makedirs(d, exist_ok=True)
+        # key -> open lock file holding a shared "in use" lock on that entry. A shared lock
+        # held by anyone, including another FileCache in this process, stops the entry from
+        # being removed.
+        self._pins = dict()
+        self._pins_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def make_key(*parts):
+        """
+        Builds a cache key from any number of JSON-serializable parts.
+        """
+        key_str = json.dumps(parts, sort_keys=True)
+        return hashlib.sha1(key_str.encode("utf-8")).hexdigest()
+
+    def lock(self, key):
+        """
+        Returns a context manager that holds an exclusive lock on building the entry for key.
+        Any other process that tries to build the same entry will wait until this is released.
+        """
+        return _FileLock(self._lock_path(key, "build"), fcntl.LOCK_EX)
+
+    def get(self, key):
+        """
+        Returns the path to the entry directory for key, or None if it isn't cached.
+        This marks the entry as recently used, and pins it so it can't be evicted until it's
+        released, or this FileCache is closed.
+        """
+        entry_dir = self._entry_path(key)
+        marker = os.path.join(entry_dir, ENTRY_MARKER)
+        # pin first, then look: once pinned, an entry that's there can't be removed, so it
+        # can't disappear between the check and its use.
+        self._pin(key)
+        try:
+            os.utime(marker, None)
+        except FileNotFoundError:
+            self.release(key)
+            return None
+        return entry_dir
+
+    def make_staging_dir(self):
+        """
+        Makes a new, empty directory where an entry can be assembled before it's published.
+        """
+        return tempfile.mkdtemp(dir=os.path.join(self.cache_dir, STAGING_DIR))
+
+    def publish(self, key, staging_dir, info=None):
+        """
+        Moves a finished staging directory into place as the entry for key, then evicts older
+        entries if the cache is over its size limit. info is an optional dict stored with
+        the entry.
+        Returns the path to the entry directory.
+        """
+        entry_info = dict(info or {})
+        entry_info["key"] = key
+        entry_info["size"] = _dir_size(staging_dir)
+        entry_info["created"] = time.time()
+        with open(os.path.join(staging_dir, ENTRY_MARKER), "w") as marker:
+            json.dump(entry_info, marker)
+        entry_dir = self._entry_path(key)
+        if os.path.exists(entry_dir):
+            # a stale, half-published entry without a marker. Clear it out.
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        self._pin(key)
+        os.rename(staging_dir, entry_dir)
+        self.evict()
+        return entry_dir
+
+    def get_info(self, key):
+        """
+        Returns the info dict stored with the entry for key, or None if it isn't cached.
+        """
+        marker = os.path.join(self._entry_path(key), ENTRY_MARKER)
+        if not os.path.exists(marker):
+            return None
+        with open(marker) as f:
+            return json.load(f)
+
+    def remove(self, key):
+        """
+        Removes the entry for key, if it exists and isn't in use by anyone else (this
+        FileCache's own pin on it is released). Returns True if it was removed.
+        """
+        use_lock = _FileLock(self._lock_path(key, "use"), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.release(key)
+        try:
+            with use_lock:
+                shutil.rmtree(self._entry_path(key), ignore_errors=True)
+                return True
+        except BlockingIOError:
+            return False
+
+    def release(self, key):
+        """
+        Releases this FileCache's pin on the entry for key, making it eligible for eviction.
+        """
+        with self._pins_lock:
+            pinned = self._pins.pop(key, None)
+        if pinned is not None:
+            pinned.close()
+
+    def close(self):
+        """
+        Releases all of this FileCache's pins.
+        """
+        with self._pins_lock:
+            pins = list(self._pins.values())
+            self._pins.clear()
+        for pinned in pins:
+            pinned.close()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in max_bytes. Entries
+        that are pinned, by this FileCache or anyone else, are skipped.
+        """
+        entries = list()
+        total_size = 0
+        for key in os.listdir(self.cache_dir):
+            marker = os.path.join(self._entry_path(key), ENTRY_MARKER)
+            if key.startswith(".") or not os.path.exists(marker):
+                continue
+            with open(marker) as f:
+                size = json.load(f).get("size", 0)
+            entries.append((os.path.getmtime(marker), key, size))
+            total_size += size
+        for (_, key, size) in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            if key in self._pins:
+                continue
+            if self.remove(key):
+                print("Evicted cache entry {} ({} bytes)".format(key, size))
+                total_size -= size
+
+    def _pin(self, key):
+        with self._pins_lock:
+            if key not in self._pins:
+                lock_file = open(self._lock_path(key, "use"), "a")
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_SH)
+                except Exception:
+                    lock_file.close()
+                    raise
+                self._pins[key] = lock_file
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _lock_path(self, key, kind):
+        return os.path.join(self.cache_dir, LOCK_DIR, "{}.{}".format(key, kind))
+
+
+class _FileLock(object):
+    """
+    Context manager around an flock()ed lock file.
+    """
+
+    def __init__(self, path, mode):
+        self.path = path
+        self.mode = mode
+        self.lock_file = None
+
+    def __enter__(self):
+        self.lock_file = open(self.path, "a")
+        try:
+            fcntl.flock(self.lock_file, self.mode)
+        except Exception:
+            self.lock_file.close()
+            raise
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+
+
+def _dir_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            size += os.path.getsize(os.path.join(root, f))
+    return size
@@ -2,24 +2,52 @@
 Utility functions to fetch files from various Workspace object types.
 Depends on the more general util.py that's here, too.
 """
+import bz2
+import hashlib
+import itertools
+import os
+import shutil
+import threading
+import zlib
 from pprint import pprint
 
+import requests
+
 from installed_clients.AssemblyUtilClient import AssemblyUtil
+from installed_clients.DataFileUtilClient import DataFileUtil
 from installed_clients.ReadsUtilsClient import ReadsUtils
 from installed_clients.SetAPIServiceClient import SetAPI
 from installed_clients.WorkspaceClient import Workspace
-from kb_hisat2.util import check_ref_type, get_object_type, get_object_names
+from kb_hisat2.file_cache import FileCache
+from kb_hisat2.util import check_ref_type, get_object_type, get_object_names, get_object_upa
+
+FASTA_FILE_NAME = "assembly.fa"
+# reads are dealt out to shards in blocks of this many records (or pairs).
+SHARD_BLOCK_READS = 100000
+# seconds between tries at unblocking a reads stream that's still waiting for a reader.
+STREAM_CLOSE_INTERVAL = 0.1
 
 
-def fetch_fasta_from_genome(genome_ref, ws_url, callback_url):
+def fetch_fasta_from_genome(genome_ref, ws_url, callback_url, info_cache=None, fasta_cache=None):
     """
     Returns an assembly or contigset as FASTA.
+    If fasta_cache (a FileCache) is given, the FASTA file is taken from there if it's already
+    cached, and added to it otherwise.
+    """
+    assembly_ref = get_assembly_ref_from_genome(genome_ref, ws_url, info_cache=info_cache)
+    return fetch_fasta_from_assembly(assembly_ref, ws_url, callback_url, info_cache=info_cache,
+                                     fasta_cache=fasta_cache)
+
+
+def get_assembly_ref_from_genome(genome_ref, ws_url, info_cache=None):
+    """
+    Returns the ref path to the assembly or contigset that holds the sequence of a genome.
     """
 
     allowed_types = ['KBaseGenomes.Genome',
                      'KBaseMetagenomes.AnnotatedMetagenomeAssembly']
 
-    if not check_ref_type(genome_ref, allowed_types, ws_url):
+    if not check_ref_type(genome_ref, allowed_types, ws_url, info_cache=info_cache):
         raise ValueError("The given genome_ref {} is not a {} type!".format(genome_ref,
                                                                             ' or '.join(allowed_types)))
     # test if genome references an assembly type
@@ -42,45 +70,126 @@ def fetch_fasta_from_genome(genome_ref, ws_url, callback_url):
     for idx, info in enumerate(ref_info.get('infos')):
         if "KBaseGenomeAnnotations.Assembly" in info[2] or "KBaseGenomes.ContigSet" in info[2]:
             assembly_ref.append(";".join(ref_info.get('paths')[idx]))
+            if info_cache is not None:
+                info_cache.add(assembly_ref[-1], info)
 
     if len(assembly_ref) == 1:
-        return fetch_fasta_from_assembly(assembly_ref[0], ws_url, callback_url)
+        return assembly_ref[0]
     else:
         raise ValueError("Multiple assemblies found associated with the given genome ref {}! "
                          "Unable to continue.")
 
 
-def fetch_fasta_from_assembly(assembly_ref, ws_url, callback_url):
+def _get_sequence_source_kind(ref, ws_url, info_cache=None):
+    """
+    Returns "genome" if the object given in ref is a genome (or annotated metagenome assembly),
+    whose sequence is in an assembly it refers to, or "assembly" if it's an assembly or
+    contigset, which holds the sequence itself. Raises a ValueError for any other type.
+    """
+    obj_type = get_object_type(ref, ws_url, info_cache=info_cache)
+    if "KBaseGenomes.Genome" in obj_type or \
+            "KBaseMetagenomes.AnnotatedMetagenomeAssembly" in obj_type:
+        return "genome"
+    elif "KBaseGenomeAnnotations.Assembly" in obj_type or "KBaseGenomes.ContigSet" in obj_type:
+        return "assembly"
+    else:
+        raise ValueError("Unable to fetch a FASTA file from an object of type {}".format(obj_type))
+
+
+def resolve_assembly_ref(ref, ws_url, info_cache=None):
+    """
+    From the object given in ref, if it's a genome, returns the ref path to its assembly (or
+    contigset). If it's already an assembly or contigset, returns ref as-is. This is the object
+    that actually holds the sequence a FASTA file (or index) gets built from.
+    """
+    if _get_sequence_source_kind(ref, ws_url, info_cache=info_cache) == "genome":
+        return get_assembly_ref_from_genome(ref, ws_url, info_cache=info_cache)
+    return ref
+
+
+def fetch_fasta_from_assembly(assembly_ref, ws_url, callback_url, info_cache=None,
+                              fasta_cache=None):
     """
     From an assembly or contigset, this uses a data file util to build a FASTA file and return the
     path to it.
+    If fasta_cache (a FileCache) is given, the FASTA file is taken from there if it's already
+    cached, and added to it otherwise. Cached files are keyed on the exact version of the
+    assembly, and checked against the MD5 recorded when they were cached before being used.
     """
     allowed_types = ['KBaseFile.Assembly',
                      'KBaseGenomeAnnotations.Assembly',
                      'KBaseGenomes.ContigSet']
-    if not check_ref_type(assembly_ref, allowed_types, ws_url):
+    if not check_ref_type(assembly_ref, allowed_types, ws_url, info_cache=info_cache):
         raise ValueError("The reference {} cannot be used to fetch a FASTA file".format(
             assembly_ref))
-    au = AssemblyUtil(callback_url)
-    return au.get_assembly_as_fasta({'ref': assembly_ref})
+    if fasta_cache is None:
+        au = AssemblyUtil(callback_url)
+        return au.get_assembly_as_fasta({'ref': assembly_ref})
+
+    cache_key = FileCache.make_key("fasta", get_object_upa(assembly_ref, ws_url,
+                                                           info_cache=info_cache))
+    with fasta_cache.lock(cache_key):
+        fasta_dir = fasta_cache.get(cache_key)
+        if fasta_dir is not None:
+            fasta_path = os.path.join(fasta_dir, FASTA_FILE_NAME)
+            if _md5sum(fasta_path) == fasta_cache.get_info(cache_key).get("md5"):
+                print("Using cached FASTA file {}".format(fasta_path))
+                return {"path": fasta_path}
+            print("Cached FASTA file {} is corrupt, fetching it again".format(fasta_path))
+            fasta_cache.remove(cache_key)
+
+        au = AssemblyUtil(callback_url)
+        fasta_file = au.get_assembly_as_fasta({'ref': assembly_ref})
+        staging_dir = fasta_cache.make_staging_dir()
+        try:
+            fasta_path = os.path.join(staging_dir, FASTA_FILE_NAME)
+            shutil.move(fasta_file["path"], fasta_path)
+            fasta_info = {"source_ref": assembly_ref, "md5": _md5sum(fasta_path)}
+        except Exception:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+        fasta_dir = fasta_cache.publish(cache_key, staging_dir, info=fasta_info)
+        fasta_file["path"] = os.path.join(fasta_dir, FASTA_FILE_NAME)
+        return fasta_file
 
 
-def fetch_fasta_from_object(ref, ws_url, callback_url):
+def _md5sum(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def get_fasta_stats(fasta_path):
+    """
+    Returns a tuple of (number of bases, number of contigs) in a FASTA file. To keep this quick
+    for big genomes, header lines are counted as bases, so the number of bases is a slight
+    overestimate.
+    """
+    num_bases = 0
+    num_contigs = 0
+    with open(fasta_path, "rb") as f:
+        for chunk in iter(lambda: f.read(16 * 1024 * 1024), b""):
+            num_contigs += chunk.count(b">")
+            num_bases += len(chunk) - chunk.count(b"\n") - chunk.count(b"\r")
+    return (num_bases, num_contigs)
+
+
+def fetch_fasta_from_object(ref, ws_url, callback_url, info_cache=None, fasta_cache=None):
     """
     From the object given in ref, if it's either a KBaseGenomes.Genome or a
     KBaseGenomeAnnotations.Assembly, or a KBaseGenomes.ContigSet, this will download and return
     the path to a FASTA file made from its sequence.
     """
-    obj_type = get_object_type(ref, ws_url)
-    if "KBaseGenomes.Genome" in obj_type or "KBaseMetagenomes.AnnotatedMetagenomeAssembly" in obj_type:
-        return fetch_fasta_from_genome(ref, ws_url, callback_url)
-    elif "KBaseGenomeAnnotations.Assembly" in obj_type or "KBaseGenomes.ContigSet" in obj_type:
-        return fetch_fasta_from_assembly(ref, ws_url, callback_url)
-    else:
-        raise ValueError("Unable to fetch a FASTA file from an object of type {}".format(obj_type))
+    if _get_sequence_source_kind(ref, ws_url, info_cache=info_cache) == "genome":
+        return fetch_fasta_from_genome(ref, ws_url, callback_url, info_cache=info_cache,
+                                       fasta_cache=fasta_cache)
+    return fetch_fasta_from_assembly(ref, ws_url, callback_url, info_cache=info_cache,
+                                     fasta_cache=fasta_cache)
 
 
-def fetch_reads_refs_from_sampleset(ref, ws_url, srv_wiz_url):
+def fetch_reads_refs_from_sampleset(ref, ws_url, srv_wiz_url, info_cache=None):
     """
     From the given object ref, return a list of all reads objects that are a part of that
     object. E.g., if ref is a ReadsSet, return a list of all PairedEndLibrary or SingleEndLibrary
@@ -95,8 +204,9 @@ def fetch_reads_refs_from_sampleset(ref, ws_url, srv_wiz_url):
     for each reads object, but a single PairedEndLibrary may not have that info.
 
     If ref is already a Reads library, just returns a list with ref as a single element.
+    info_cache is an optional ObjectInfoCache to look up object refs with.
     """
-    obj_type = get_object_type(ref, ws_url)
+    obj_type = get_object_type(ref, ws_url, info_cache=info_cache)
     refs = list()
     if "KBaseSets.ReadsSet" in obj_type or "KBaseRNASeq.RNASeqSampleSet" in obj_type:
         print("Looking up reads references in ReadsSet object")
@@ -109,7 +219,7 @@ def fetch_reads_refs_from_sampleset(ref, ws_url, srv_wiz_url):
         print("Got results from ReadsSet object")
         pprint(reads_set)
         ref_list = [r["ref_path"] for r in reads_set["data"]["items"]]
-        reads_names = get_object_names(ref_list, ws_url)
+        reads_names = get_object_names(ref_list, ws_url, info_cache=info_cache)
         for reads in reads_set["data"]["items"]:
             ref = reads["ref_path"]
             refs.append({
@@ -123,7 +233,7 @@ def fetch_reads_refs_from_sampleset(ref, ws_url, srv_wiz_url):
           "KBaseFile.PairedEndLibrary" in obj_type):
         refs.append({
             "ref": ref,
-            "name": get_object_names([ref], ws_url)[ref]
+            "name": get_object_names([ref], ws_url, info_cache=info_cache)[ref]
         })
     else:
         raise ValueError("Unable to fetch reads reference from object {} "
@@ -163,3 +273,252 @@ def fetch_reads_from_reference(ref, callback_url):
     except:
         print(("Unable to fetch a file from expected reads object {}".format(ref)))
         raise
+
+
+def stream_reads_from_reference(ref, ws_url, callback_url, working_dir, token=None):
+    """
+    Like fetch_reads_from_reference, but instead of downloading the FASTQ file(s), this makes
+    a named pipe for each one, and starts a thread that streams the file from Shock into that
+    pipe, decompressing on the fly. Whatever reads from the pipes (i.e. HISAT2) can start
+    working on the first chunk of reads while the rest are still being downloaded.
+    Returns the same structure as fetch_reads_from_reference, with an extra key:
+    {
+        "streams": list of ReadsStream threads feeding the pipes. These need to be passed to
+                   close_reads_streams when whatever is reading them is done.
+    }
+    Interleaved paired-end reads can't be split up on the fly, so those are downloaded with
+    fetch_reads_from_reference instead (and "streams" is an empty list).
+    token is the auth token of the user the reads are fetched for, e.g. from the context of
+    the call, since a server may be running calls for several users at once.
+    """
+    print("Streaming reads from object {}".format(ref))
+    ws = Workspace(ws_url, token=token)
+    reads_obj = ws.get_objects2({"objects": [{"ref": ref}]})["data"][0]
+    obj_type = reads_obj["info"][2]
+    data = reads_obj["data"]
+    if "KBaseFile" in obj_type:
+        handle_fwd = data["lib"]["file"] if "lib" in data else data["lib1"]["file"]
+        handle_rev = data["lib2"]["file"] if "lib2" in data else None
+    elif "KBaseAssembly" in obj_type:
+        handle_fwd = data["handle"] if "handle" in data else data["handle_1"]
+        handle_rev = data.get("handle_2")
+    else:
+        raise ValueError("Unable to stream reads from object {} "
+                         "which is a {}".format(ref, obj_type))
+    if "PairedEndLibrary" in obj_type and (data.get("interleaved") or handle_rev is None):
+        print("Reads object {} is interleaved, downloading it instead".format(ref))
+        reads = fetch_reads_from_reference(ref, callback_url)
+        reads["streams"] = list()
+        return reads
+
+    ret_reads = {
+        "object_ref": ref,
+        "style": "single" if handle_rev is None else "paired",
+        "streams": list()
+    }
+    for (key, handle) in [("file_fwd", handle_fwd), ("file_rev", handle_rev)]:
+        if handle is None:
+            continue
+        fifo_path = os.path.join(working_dir, "reads_{}_{}.fq".format(
+            ref.replace("/", "_").replace(";", "-"), key))
+        if os.path.exists(fifo_path):
+            os.remove(fifo_path)
+        os.mkfifo(fifo_path)
+        stream = ReadsStream(handle["url"], handle["id"], fifo_path, token=token)
+        stream.start()
+        ret_reads[key] = fifo_path
+        ret_reads["streams"].append(stream)
+    return ret_reads
+
+
+def close_reads_streams(streams, raise_errors=True):
+    """
+    Waits for the given ReadsStream threads to finish. Any that are still waiting for a reader
+    (e.g. because HISAT2 failed before it opened its inputs) are shut down. If raise_errors is
+    True, this raises the first error any of the streams hit, since that means whatever was
+    reading them got an incomplete set of reads.
+    """
+    for stream in streams:
+        while stream.is_alive():
+            # open and close the read side of the pipe, so a writer blocked in open() gets
+            # through, then fails on its next write. The writer might not have got to open()
+            # yet, so this keeps at it until the writer is done.
+            try:
+                fd = os.open(stream.fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+                os.close(fd)
+            except OSError:
+                pass
+            stream.join(STREAM_CLOSE_INTERVAL)
+    for stream in streams:
+        if stream.error is not None and raise_errors:
+            raise RuntimeError("Failed while streaming reads from Shock node {}: {}".format(
+                stream.node_id, stream.error))
+
+
+def split_reads(reads, out_dir, num_shards, block_reads=SHARD_BLOCK_READS):
+    """
+    Splits the FASTQ file(s) of a reads info dict from fetch_reads_from_reference (or
+    stream_reads_from_reference, as they're read in a single pass) into num_shards smaller
+    sets of files in out_dir. Reads are dealt out to the shards in blocks of block_reads
+    records, and the forward and reverse files are split the same way, so mates stay paired.
+    Returns a list of reads info dicts like the one given, one per shard that got any reads,
+    each with an extra "shard" key holding its index.
+    """
+    keys = ["file_fwd", "file_rev"] if reads.get("file_rev") else ["file_fwd"]
+    shards = list()
+    for idx in range(num_shards):
+        shard = {"object_ref": reads["object_ref"], "style": reads["style"], "shard": idx}
+        for (mate, key) in enumerate(keys):
+            shard[key] = os.path.join(out_dir, "reads_shard_{}_{}.fq".format(idx, mate + 1))
+        shards.append(shard)
+    ins = [open(reads[key], "rb") for key in keys]
+    outs = [[open(shard[key], "wb") for key in keys] for shard in shards]
+    counts = [0] * num_shards
+    try:
+        for block_idx in itertools.count():
+            idx = block_idx % num_shards
+            blocks = [list(itertools.islice(f, 4 * block_reads)) for f in ins]
+            if not blocks[0]:
+                break
+            if any(len(block) != len(blocks[0]) for block in blocks):
+                raise ValueError("Paired-end reads files for {} don't have the same number of "
+                                 "reads".format(reads["object_ref"]))
+            for (out, block) in zip(outs[idx], blocks):
+                out.writelines(block)
+            counts[idx] += len(blocks[0]) // 4
+    finally:
+        for f in ins + [f for shard_outs in outs for f in shard_outs]:
+            f.close()
+    for (shard, count) in zip(shards, counts):
+        if count == 0:
+            for key in keys:
+                os.remove(shard[key])
+    return [shard for (shard, count) in zip(shards, counts) if count > 0]
+
+
+def upload_reads_shard(shard, callback_url):
+    """
+    Uploads the FASTQ file(s) of a shard from split_reads to Shock, gzipped, so a job on
+    another node can fetch it with download_reads_shard. Returns a dict describing the shard,
+    with the Shock node id of each file in place of its path.
+    """
+    dfu = DataFileUtil(callback_url)
+    shard_info = {"object_ref": shard["object_ref"], "style": shard["style"],
+                  "shard": shard["shard"]}
+    for key in ["file_fwd", "file_rev"]:
+        if shard.get(key) is not None:
+            shard_info[key] = dfu.file_to_shock({
+                "file_path": shard[key],
+                "make_handle": 0,
+                "pack": "gzip"
+            })["shock_id"]
+    return shard_info
+
+
+def download_reads_shard(shard_info, callback_url, out_dir):
+    """
+    Downloads a shard uploaded by upload_reads_shard into out_dir. Returns a reads info dict
+    like the ones from split_reads.
+    """
+    dfu = DataFileUtil(callback_url)
+    shard = dict(shard_info)
+    for key in ["file_fwd", "file_rev"]:
+        if shard_info.get(key) is not None:
+            shard[key] = dfu.shock_to_file({
+                "shock_id": shard_info[key],
+                "file_path": out_dir,
+                "unpack": "uncompress"
+            })["file_path"]
+    return shard
+
+
+class ReadsStream(threading.Thread):
+    """
+    Streams a (possibly gzip or bzip2 compressed) file from a Shock node, and writes it
+    uncompressed into a named pipe. The pipe always gets opened and closed, even if the
+    download fails before anything is written, so its reader sees EOF instead of waiting
+    forever. A reader can't tell that from the end of the file, so whatever reads it has to
+    check error afterward (see close_reads_streams).
+    token is the auth token to fetch the file with. If it's None, KB_AUTH_TOKEN is used.
+    """
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, shock_url, node_id, fifo_path, token=None):
+        super(ReadsStream, self).__init__()
+        self.daemon = True
+        self.shock_url = shock_url
+        self.node_id = node_id
+        self.fifo_path = fifo_path
+        if token is None:
+            token = os.environ.get("KB_AUTH_TOKEN", "")
+        self.token = token
+        self.error = None
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def run(self):
+        fifo = None
+        try:
+            headers = {"Authorization": "OAuth " + self.token}
+            node_url = "{}/node/{}?download_raw".format(self.shock_url.rstrip("/"), self.node_id)
+            with requests.get(node_url, headers=headers, stream=True) as resp:
+                resp.raise_for_status()
+                # this blocks until something opens the pipe for reading.
+                fifo = open(self.fifo_path, "wb")
+                decompressor = None
+                for chunk in resp.iter_content(chunk_size=self.CHUNK_SIZE):
+                    if decompressor is None:
+                        decompressor = _get_decompressor(chunk)
+                    self.bytes_read += len(chunk)
+                    out = decompressor.decompress(chunk)
+                    self.bytes_written += len(out)
+                    fifo.write(out)
+        except Exception as e:
+            self.error = e
+        finally:
+            try:
+                if fifo is None:
+                    # the reader might already be waiting in open(). close_reads_streams
+                    # gets this through, if nothing ever opens it.
+                    fifo = open(self.fifo_path, "wb")
+                fifo.close()
+            except OSError:
+                pass
+
+
+def _get_decompressor(first_chunk):
+    """
+    Picks a streaming decompressor based on the magic bytes at the start of a file.
+    """
+    if first_chunk[:2] == b"\x1f\x8b":
+        return _MultiMemberDecompressor(lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))
+    if first_chunk[:3] == b"BZh":
+        return _MultiMemberDecompressor(bz2.BZ2Decompressor)
+    return _PassThrough()
+
+
+class _MultiMemberDecompressor(object):
+    """
+    Wraps a zlib or bz2 decompressor, starting a new one each time a stream ends, so
+    concatenated compressed files (like the output of bgzip, or cat a.gz b.gz) are handled.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.decompressor = factory()
+
+    def decompress(self, data):
+        out = list()
+        while data:
+            out.append(self.decompressor.decompress(data))
+            if self.decompressor.eof:
+                data = self.decompressor.unused_data
+                self.decompressor = self.factory()
+            else:
+                data = b""
+        return b"".join(out)
+
+
+class _PassThrough(object):
+    def decompress(self, data):
+        return data
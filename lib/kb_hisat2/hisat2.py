@@ -7,30 +7,112 @@ This does all the heavy lifting of running HISAT2 to align reads against a refer
 
 import os
 import re
+import shutil
 import subprocess
+import traceback
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pipes import quote  # deprecated, but useful here for filenames
 from pprint import pprint
 
+from installed_clients.DataFileUtilClient import DataFileUtil
 from installed_clients.KBParallelClient import KBParallel
 from installed_clients.KBaseReportClient import KBaseReport
 from installed_clients.ReadsAlignmentUtilsClient import ReadsAlignmentUtils
 from installed_clients.SetAPIServiceClient import SetAPI
-from installed_clients.kb_QualiMapClient import kb_QualiMap
-from kb_hisat2.hisat2indexmanager import Hisat2IndexManager
-from kb_hisat2.file_util import fetch_reads_from_reference
-from kb_hisat2.util import package_directory, is_set, get_object_names
+from kb_hisat2.alignment_stats import (
+    AlignmentStats,
+    SamStatsTee,
+    merge_stats,
+    parse_hisat2_summary,
+    write_stats_html
+)
+from kb_hisat2.hisat2indexmanager import (
+    Hisat2IndexManager,
+    estimate_alignment_memory,
+    get_hisat2_index_size,
+    prewarm_hisat2_index
+)
+from kb_hisat2.manifest import (
+    BatchManifest,
+    get_checkpoint_key,
+    get_manifest_path,
+    get_memo_key,
+    get_memo_path
+)
+from kb_hisat2.multiplex import (
+    MULTIPLEX_SORT_MEMORY,
+    SamDemuxTee,
+    make_tag,
+    plan_multiplex_groups,
+    write_tagged_reads
+)
+from kb_hisat2.pipeline import Pipeline
+from kb_hisat2.process import MonitoredProcess, run_process, summarize_processes
+from kb_hisat2.qc import SampleQC
+from kb_hisat2.resources import (
+    get_scratch_budget,
+    plan_placement,
+    plan_resources,
+    plan_workers
+)
+from kb_hisat2.scratch import ScratchManager, estimate_reads_scratch
+from kb_hisat2.tracing import Tracer, format_bytes
+from kb_hisat2.file_util import (
+    close_reads_streams,
+    download_reads_shard,
+    fetch_reads_from_reference,
+    split_reads,
+    stream_reads_from_reference,
+    upload_reads_shard
+)
+from kb_hisat2.util import (
+    ObjectInfoCache,
+    copy_object,
+    get_object_names,
+    get_object_upa,
+    get_reads_counts,
+    is_set,
+    package_directory
+)
 
 HISAT_VERSION = "2.1.0"
+# number of times a failed alignment in a batch gets retried
+MAX_RETRIES = 2
+# number of samples downloaded (or uploaded) at once when running a batch locally
+NUM_TRANSFER_WORKERS = 2
 
 
 class Hisat2(object):
-    def __init__(self, callback_url, srv_wiz_url, workspace_url, working_dir, provenance):
+    def __init__(self, callback_url, srv_wiz_url, workspace_url, working_dir, provenance,
+                 info_cache=None, tracer=None, job_dir=None, token=None):
         self.callback_url = callback_url
         self.srv_wiz_url = srv_wiz_url
         self.workspace_url = workspace_url
+        # working_dir is shared scratch, with the caches and manifests that outlive a job.
+        # Everything else a job writes goes in its own job_dir, so jobs sharing scratch can run
+        # at the same time.
         self.working_dir = working_dir
+        if job_dir is None:
+            job_dir = working_dir
+        self.job_dir = job_dir
         self.provenance = provenance
+        # the caller's auth token, for fetching data directly (not through the callback server)
+        self.token = token
+        if info_cache is None:
+            info_cache = ObjectInfoCache(workspace_url)
+        self.info_cache = info_cache
+        if tracer is None:
+            tracer = Tracer()
+        self.tracer = tracer
+        self.qc = None
+        self.report_dir = None
+        self.index_manager = None
+        # reads ref -> {"placement": "local" or "remote", "total_bases": ...}, for the report
+        self.placements = dict()
+        self.memo = BatchManifest(get_memo_path(working_dir))
+        self.scratch = ScratchManager()
         self.my_version = 'release'
         if len(provenance) > 0:
             if 'subactions' in provenance[0]:
@@ -54,26 +136,372 @@ class Hisat2(object):
         # again, default to setting this to release
         return 'release'
 
-    def build_index(self, object_ref):
+    def build_index(self, object_ref, index_shock_id=None, num_threads=None):
         """
         Uses the Hisat2IndexManager to build/retrieve the HISAT2 index files
-        based on the object ref.
+        based on the object ref. If index_shock_id is given, the index is fetched from
+        there, instead of being built. num_threads is an optional upper bound on the threads
+        used to build it.
         """
-        idx_manager = Hisat2IndexManager(self.workspace_url, self.callback_url, self.working_dir)
-        return idx_manager.get_hisat2_index(object_ref)
+        with self.tracer.span("build_index", genome_ref=object_ref) as span:
+            span.add_ref(object_ref)
+            idx_manager = self._get_index_manager()
+            options = {
+                "num_threads": plan_resources(max_threads=num_threads)["build_threads"]
+            }
+            idx_prefix = idx_manager.get_hisat2_index(object_ref, options=options,
+                                                      index_shock_id=index_shock_id)
+            span.add_bytes(get_hisat2_index_size(idx_prefix))
+            return idx_prefix
+
+    def share_index(self, idx_prefix):
+        """
+        Uploads the index files with the given prefix so they can be used by subtasks on
+        other nodes. Returns the Shock node id to pass along as index_shock_id.
+        """
+        with self.tracer.span("share_index") as span:
+            idx_manager = self._get_index_manager()
+            index_shock_id = idx_manager.pack_hisat2_index(idx_prefix)
+            span.add_bytes(get_hisat2_index_size(idx_prefix))
+            span.set(index_shock_id=index_shock_id)
+            return index_shock_id
+
+    def close(self):
+        """
+        Releases what this run holds onto past its own steps, like the cached index files it
+        used. Call it when the job is done.
+        """
+        if self.index_manager is not None:
+            self.index_manager.close()
+            self.index_manager = None
+
+    def _get_index_manager(self):
+        # one per run, so the cached files it uses stay pinned until the run is closed.
+        if self.index_manager is None:
+            self.index_manager = Hisat2IndexManager(self.workspace_url, self.callback_url,
+                                                    self.working_dir, info_cache=self.info_cache,
+                                                    tracer=self.tracer)
+        return self.index_manager
+
+    def _get_report_dir(self):
+        if self.report_dir is None:
+            self.report_dir = os.path.join(self.job_dir, "hisat2_report_" + str(uuid.uuid4()))
+            os.makedirs(self.report_dir)
+        return self.report_dir
+
+    def _start_qc(self, params):
+        """
+        Gets ready to run QualiMap on each alignment as soon as it's uploaded, if this run
+        builds a report and params["qc_mode"] asks for QualiMap.
+        """
+        if params.get("build_report", 0) == 1 and params.get("qc_mode", "native") == "qualimap":
+            self.qc = SampleQC(self.callback_url, self._get_report_dir(), self.tracer)
+
+    def _submit_qc(self, alignment):
+        if self.qc is not None:
+            self.qc.submit(alignment)
+
+    def _get_object_name(self, ref):
+        return get_object_names([ref], self.workspace_url, info_cache=self.info_cache)[ref]
 
     def run_single(self, reads_ref, params):
         """
         Performs a single run of HISAT2 against a single reads reference. The rest of the info
         is taken from the params dict - see the spec for details.
         """
-        # 1. Get hisat2 index from genome.
-        #    a. If it exists in cache, use that.
-        #    b. Otherwise, build it
-        idx_prefix = self.build_index(params["genome_ref"])
+        with self.tracer.span("run_single", reads_ref=reads_ref["ref"]) as span:
+            try:
+                return self._run_single(reads_ref, params)
+            finally:
+                # whatever intermediate files are left (e.g. if it failed) go now.
+                self.scratch.release(reads_ref["ref"])
+                span.set(peak_scratch_bytes=self.scratch.peak)
+
+    def _run_single(self, reads_ref, params):
+        """
+        The body of run_single, inside its trace span.
+        """
+        self._start_qc(params)
+        # 0. If these reads were already aligned against this genome the same way, reuse
+        #    that alignment.
+        condition = reads_ref.get("condition", params.get("condition"))
+        memo_key = self._get_memo_key(reads_ref["ref"], condition, params)
+        alignment = self._reuse_alignment(memo_key, reads_ref["ref"], params)
+        if alignment is None:
+            # 1. Get hisat2 index from genome.
+            #    a. If it exists in cache, use that.
+            #    b. If a parent job shared one, fetch that.
+            #    c. Otherwise, build it
+            idx_prefix = self.build_index(params["genome_ref"],
+                                          index_shock_id=params.get("index_shock_id"),
+                                          num_threads=params.get("num_threads"))
 
-        # 2. Fetch the reads file and deal make sure input params are correct.
-        reads = fetch_reads_from_reference(reads_ref["ref"], self.callback_url)
+            # 2. Fetch the reads, align them, and upload the alignment. If the library is
+            #    to be split into shards, those get aligned in parallel, then merged.
+            if int(params.get("num_shards") or 1) > 1:
+                (alignment, reads) = self.align_reads_sharded(reads_ref, params, idx_prefix)
+            else:
+                (alignment, reads) = self.align_reads(reads_ref, params, idx_prefix)
+        self._submit_qc(alignment)
+        output_ref = alignment["ref"]
+        alignment_set_ref = None
+        if is_set(params["sampleset_ref"], self.workspace_url, info_cache=self.info_cache):
+            # alignment_items, alignmentset_name, ws_name
+            set_name = self._get_object_name(params["sampleset_ref"])
+            alignment_set_name = set_name + params["alignmentset_suffix"]
+            alignment_set_ref = self.upload_alignment_set(
+                [{
+                    "ref": output_ref,
+                    "label": condition
+                }],
+                alignment_set_name,
+                params["ws_name"]
+            )
+        alignments = dict()
+        alignments[reads_ref["ref"]] = alignment
+        return (alignments, output_ref, alignment_set_ref)
+
+    def align_reads(self, reads_ref, params, idx_prefix, output_file="accepted_hits"):
+        """
+        Fetches a single reads library, aligns it against the index with the given prefix, and
+        uploads the alignment. The alignment file is written with the given output_file prefix,
+        so multiple alignments can run at the same time.
+        Returns a tuple of the new alignment ({"ref": alignment ref, "name": alignment name})
+        and the reads info dict that went into it.
+        """
+        reads = self.fetch_reads(reads_ref, params)
+        alignment_file = self.align_fetched_reads(idx_prefix, reads, params, output_file)
+        alignment = self.upload_fetched_alignment(params, reads, alignment_file)
+        self._remove_alignment_files(alignment_file)
+        return (alignment, reads)
+
+    def align_reads_sharded(self, reads_ref, params, idx_prefix):
+        """
+        Like align_reads, but splits the reads library into params["num_shards"] shards, and
+        aligns those in parallel, with KBParallel subtasks or a local pool of workers, as
+        picked by params["runner"]. Their sorted BAM files get merged into a single alignment,
+        which is uploaded like any other.
+        """
+        num_shards = int(params["num_shards"])
+        reads = self.fetch_reads(reads_ref, params)
+        shard_dir = os.path.join(self.job_dir, "shards_" + str(uuid.uuid4()))
+        os.makedirs(shard_dir)
+        self.scratch.track(reads_ref["ref"], shard_dir)
+        try:
+            with self.tracer.span("split_reads", num_shards=num_shards) as span:
+                span.add_ref(reads["object_ref"])
+                try:
+                    shards = split_reads(reads, shard_dir, num_shards)
+                except Exception:
+                    # a failed download is what really went wrong, if there was one.
+                    close_reads_streams(reads.get("streams", []))
+                    raise
+                close_reads_streams(reads.get("streams", []))
+                span.add_bytes(_files_size([shard.get(key) for shard in shards
+                                            for key in ["file_fwd", "file_rev"]]))
+            self._remove_reads_files(reads)
+            self.scratch.update(reads_ref["ref"])
+            print("Split reads {} into {} shards".format(reads["object_ref"], len(shards)))
+            if params.get("runner", "parallel") == "local_pool":
+                shard_alignments = self._align_shards_local(shards, params, idx_prefix)
+            else:
+                shard_alignments = self._align_shards_parallel(shards, params, idx_prefix,
+                                                               shard_dir)
+            alignment_file = os.path.join(self.job_dir, "accepted_hits.bam")
+            with self.tracer.span("merge_shards", num_shards=len(shard_alignments)) as span:
+                self._merge_bam_files([a["file"] for a in shard_alignments], alignment_file,
+                                      plan_resources(params.get("num_threads"))["sort_threads"])
+                span.add_bytes(_files_size([alignment_file]))
+            self.scratch.track(reads_ref["ref"], alignment_file)
+            self.scratch.track(reads_ref["ref"], alignment_file + ".bai")
+            reads["alignment_stats"] = merge_stats(
+                [a["alignment_stats"] for a in shard_alignments])
+        finally:
+            self.scratch.free(shard_dir)
+        alignment = self.upload_fetched_alignment(params, reads, alignment_file)
+        self._remove_alignment_files(alignment_file)
+        return (alignment, reads)
+
+    def _align_shards_local(self, shards, params, idx_prefix):
+        """
+        Aligns the shards from split_reads on this node, with a pool of workers sized like the
+        local_pool batch runner's. Returns the results of _align_shard_files, in shard order.
+        """
+        (num_workers, threads_per_worker) = self._plan_local_workers(len(shards), params,
+                                                                     idx_prefix)
+        print("Aligning {} shards with {} local workers, {} threads each".format(
+            len(shards), num_workers, threads_per_worker))
+        shard_params = dict(params)
+        shard_params["num_threads"] = threads_per_worker
+        pipeline = Pipeline([
+            ("align_shard", partial(self._align_shard_files, idx_prefix, shard_params),
+             num_workers)
+        ], max_retries=MAX_RETRIES, tracer=self.tracer, parent=self.tracer.current())
+        (results, errors) = pipeline.run(shards)
+        if len(errors) > 0:
+            raise RuntimeError("Failed a sharded run of HISAT2! {}".format(
+                errors[sorted(errors.keys())[0]]))
+        return results
+
+    def _align_shards_parallel(self, shards, params, idx_prefix, shard_dir):
+        """
+        Aligns the shards from split_reads as KBParallel subtasks (see align_shard). Each
+        shard's reads go up to Shock for its subtask, and its sorted BAM file comes back down
+        to shard_dir. Returns a list of dicts like the ones from _align_shard_files, in shard
+        order.
+        """
+        index_shock_id = params.get("index_shock_id")
+        if index_shock_id is None:
+            index_shock_id = self.share_index(idx_prefix)
+
+        # the transfer threads have no open spans of their own, so each transfer's span goes
+        # under the span of all of them.
+        def upload(shard, parent):
+            with self.tracer.span("upload_reads_shard", parent=parent, shard=shard["shard"]):
+                return upload_reads_shard(shard, callback_url=self.callback_url)
+
+        with self.tracer.span("upload_shards") as span:
+            span.add_bytes(_files_size([shard.get(key) for shard in shards
+                                        for key in ["file_fwd", "file_rev"]]))
+            with ThreadPoolExecutor(max_workers=NUM_TRANSFER_WORKERS) as executor:
+                shard_infos = list(executor.map(partial(upload, parent=span), shards))
+        for shard in shards:
+            self._remove_reads_files(shard)
+
+        tasks = list()
+        for shard_info in shard_infos:
+            single_param = dict(params)  # need a copy of the params
+            single_param["build_report"] = 0
+            single_param["index_shock_id"] = index_shock_id
+            single_param["shard"] = shard_info
+            tasks.append({
+                "module_name": "kb_hisat2",
+                "function_name": "run_hisat2",
+                "version": self.my_version,
+                "parameters": single_param
+            })
+        results = self._run_kbparallel(tasks, params)
+        shard_results = list()
+        for idx, result in enumerate(results):
+            if result["is_error"] != 0:
+                raise RuntimeError("Failed a parallel run of HISAT2 on shard {}! {}".format(
+                    idx, result["result_package"]["error"]))
+            shard_results.append(result["result_package"]["result"][0]["shard_alignment"])
+
+        def download(shard_result, parent):
+            with self.tracer.span("download_shard", parent=parent, shard=shard_result["shard"]):
+                dfu = DataFileUtil(self.callback_url)
+                dl = dfu.shock_to_file({"shock_id": shard_result["shock_id"],
+                                        "file_path": shard_dir})
+                return {"shard": shard_result["shard"], "file": dl["file_path"],
+                        "alignment_stats": shard_result["alignment_stats"]}
+
+        with self.tracer.span("download_shards") as span:
+            with ThreadPoolExecutor(max_workers=NUM_TRANSFER_WORKERS) as executor:
+                shard_alignments = list(executor.map(partial(download, parent=span),
+                                                     shard_results))
+            span.add_bytes(_files_size([a["file"] for a in shard_alignments]))
+        self.scratch.update(shards[0]["object_ref"])
+        return shard_alignments
+
+    def align_shard(self, params):
+        """
+        Aligns one shard of a sharded reads library, as a KBParallel subtask started by
+        align_reads_sharded. params["shard"] describes the shard, as made by
+        upload_reads_shard. The sorted BAM file goes up to Shock for the parent job to merge.
+        Returns a dict like this:
+        {
+            "shard": index of the shard,
+            "shock_id": Shock node id of the BAM file,
+            "alignment_stats": stats of the shard's alignment
+        }
+        """
+        idx_prefix = self.build_index(params["genome_ref"],
+                                      index_shock_id=params.get("index_shock_id"),
+                                      num_threads=params.get("num_threads"))
+        with self.tracer.span("fetch_reads", shard=params["shard"]["shard"]) as span:
+            span.add_ref(params["shard"]["object_ref"])
+            shard = download_reads_shard(params["shard"], self.callback_url, self.job_dir)
+            span.add_bytes(_files_size([shard.get("file_fwd"), shard.get("file_rev")]))
+        shard_alignment = self._align_shard_files(idx_prefix, params, shard)
+        with self.tracer.span("upload_shard") as span:
+            span.add_bytes(_files_size([shard_alignment["file"]]))
+            dfu = DataFileUtil(self.callback_url)
+            shock_id = dfu.file_to_shock({
+                "file_path": shard_alignment["file"],
+                "make_handle": 0
+            })["shock_id"]
+        self._remove_alignment_files(shard_alignment["file"])
+        return {
+            "shard": shard["shard"],
+            "shock_id": shock_id,
+            "alignment_stats": shard_alignment["alignment_stats"]
+        }
+
+    def _align_shard_files(self, idx_prefix, params, shard):
+        """
+        Aligns a shard from split_reads (or download_reads_shard) into a sorted BAM file,
+        then removes the shard's reads files. Returns a dict like this:
+        {
+            "shard": index of the shard,
+            "file": path to the BAM file,
+            "alignment_stats": stats of the shard's alignment
+        }
+        """
+        stats = AlignmentStats()
+        with self.tracer.span("run_hisat2", shard=shard["shard"]) as span:
+            span.add_ref(shard["object_ref"])
+            alignment_file = self.run_hisat2(
+                idx_prefix, shard, params,
+                output_file="accepted_hits_shard_{}".format(shard["shard"]), stats=stats
+            )
+            span.add_bytes(_files_size([alignment_file]))
+        self.scratch.track(shard["object_ref"], alignment_file)
+        self.scratch.track(shard["object_ref"], alignment_file + ".bai")
+        self._remove_reads_files(shard)
+        return {"shard": shard["shard"], "file": alignment_file,
+                "alignment_stats": stats.to_dict()}
+
+    def _merge_bam_files(self, bam_files, output_file, num_threads):
+        """
+        Merges sorted BAM files into a single sorted and indexed BAM file.
+        """
+        span = self.tracer.current()
+        if len(bam_files) == 1:
+            shutil.move(bam_files[0], output_file)
+            self.scratch.free(bam_files[0])
+        else:
+            # -c and -p keep one copy of the read group and program lines all the shards share.
+            p = run_process(["samtools", "merge", "-f", "-c", "-p", "-@", str(num_threads),
+                             output_file] + bam_files, name="samtools merge", span=span,
+                            shell=False)
+            if p.returncode != 0:
+                raise RuntimeError("Failed to merge BAM files into {}!".format(output_file))
+            for f in bam_files:
+                self._remove_alignment_files(f)
+        p = run_process(["samtools", "index", output_file], name="samtools index", span=span,
+                        shell=False)
+        if p.returncode != 0:
+            raise RuntimeError('Failed to index BAM file {}!'.format(output_file))
+
+    def fetch_reads(self, reads_ref, params):
+        """
+        Fetches the reads file(s) for a single reads library, and makes sure the input params
+        are correct. Returns the reads info dict from fetch_reads_from_reference, with the name,
+        condition, and sampleset_ref for the alignment filled in.
+        """
+        # If we're streaming reads, this just sets up named pipes that HISAT2 reads from
+        # while the reads are still downloading.
+        with self.tracer.span("fetch_reads") as span:
+            span.add_ref(reads_ref["ref"])
+            if params.get("stream_reads", 0) == 1:
+                span.set(streamed=True)
+                reads = stream_reads_from_reference(reads_ref["ref"], self.workspace_url,
+                                                    self.callback_url, self.job_dir,
+                                                    token=self.token)
+            else:
+                reads = fetch_reads_from_reference(reads_ref["ref"], self.callback_url)
+                span.add_bytes(_files_size([reads.get("file_fwd"), reads.get("file_rev")]))
         # if the reads ref came from a different sample set, then we need to drop that
         # reference inside the reads info object so it can be linked in the alignment
         if reads_ref["ref"] != params["sampleset_ref"]:
@@ -84,36 +512,106 @@ class Hisat2(object):
         elif "condition" in params:
             reads["condition"] = params["condition"]
         reads["name"] = reads_ref["name"]
-        output_file = "accepted_hits"
+        for key in ["file_fwd", "file_rev"]:
+            self.scratch.track(reads_ref["ref"], reads.get(key))
+        return reads
 
-        # 3. Finally all set, do the alignment and upload the output.
-        alignment_file = self.run_hisat2(
-            idx_prefix, reads, params, output_file=output_file
-        )
+    def align_fetched_reads(self, idx_prefix, reads, params, output_file):
+        """
+        Aligns reads from fetch_reads against the index, then removes the reads files, since
+        they're not needed after that. The alignment's stats are added to reads as
+        "alignment_stats". Returns the path to the alignment file.
+        """
+        stats = AlignmentStats()
+        with self.tracer.span("run_hisat2") as span:
+            span.add_ref(reads["object_ref"])
+            try:
+                alignment_file = self.run_hisat2(
+                    idx_prefix, reads, params, output_file=output_file, stats=stats
+                )
+            except Exception:
+                # a failed download is what really went wrong, if there was one.
+                close_reads_streams(reads.get("streams", []))
+                raise
+            close_reads_streams(reads.get("streams", []))
+            # streamed reads only get counted once they've gone through
+            span.add_bytes(sum(stream.bytes_written for stream in reads.get("streams", [])))
+            span.add_bytes(_files_size([alignment_file]))
+        self.scratch.track(reads["object_ref"], alignment_file)
+        self.scratch.track(reads["object_ref"], alignment_file + ".bai")
+        self._remove_reads_files(reads)
+        reads["alignment_stats"] = stats.to_dict()
+        return alignment_file
+
+    def upload_fetched_alignment(self, params, reads, alignment_file):
+        """
+        Uploads an alignment of reads from fetch_reads. Returns the new alignment as
+        {"ref": alignment ref, "name": alignment name, "alignment_stats": its stats}.
+        """
         alignment_name = reads["name"] + params["alignment_suffix"]
         output_ref = self.upload_alignment(params, reads, alignment_name, alignment_file)
-        alignment_set_ref = None
-        if is_set(params["sampleset_ref"], self.workspace_url):
-            # alignment_items, alignmentset_name, ws_name
-            set_name = get_object_names([params["sampleset_ref"]], self.workspace_url)[params["sampleset_ref"]]
-            alignment_set_name = set_name + params["alignmentset_suffix"]
-            alignment_set_ref = self.upload_alignment_set(
-                [{
-                    "ref": output_ref,
-                    "label": reads["condition"]
-                }],
-                alignment_set_name,
-                params["ws_name"]
-            )
-        alignments = dict()
-        alignments[reads_ref["ref"]] = {
+        alignment = {
             "ref": output_ref,
-            "name": alignment_name
+            "name": alignment_name,
+            "alignment_stats": reads.get("alignment_stats")
         }
-        os.remove(reads["file_fwd"])
-        if "file_rev" in reads:
-            os.remove(reads["file_rev"])
-        return (alignments, output_ref, alignment_set_ref)
+        memo_key = self._get_memo_key(reads["object_ref"], reads.get("condition"), params)
+        self.memo.record(memo_key, reads["object_ref"], alignment)
+        return alignment
+
+    def _get_memo_key(self, reads_ref, condition, params):
+        """
+        Returns the memo key (see the manifest module) for aligning reads_ref, under the given
+        condition, with params.
+        """
+        self.info_cache.prefetch([reads_ref, params["genome_ref"]])
+        return get_memo_key(
+            get_object_upa(reads_ref, self.workspace_url, info_cache=self.info_cache),
+            get_object_upa(params["genome_ref"], self.workspace_url, info_cache=self.info_cache),
+            condition,
+            self._build_hisat2_options(params),
+            HISAT_VERSION
+        )
+
+    def _reuse_alignment(self, memo_key, reads_ref, params):
+        """
+        Looks up an alignment made from the same inputs, with the same options, under
+        memo_key. If there is one, and it's still in the Workspace, it gets returned as the
+        alignment of reads_ref with params, like the ones from upload_fetched_alignment. If it
+        isn't already saved under the name and workspace params asks for, it's copied there
+        first. If there isn't one, returns None.
+        """
+        alignment = self.memo.get(memo_key)
+        if alignment is None:
+            return None
+        try:
+            obj_info = self.info_cache.get_info(alignment["ref"])
+        except RuntimeError:
+            print("Memoized alignment {} of {} is gone, so it'll be aligned again".format(
+                alignment["ref"], reads_ref))
+            self.memo.discard(memo_key)
+            return None
+        alignment_name = self._get_object_name(reads_ref) + params["alignment_suffix"]
+        if obj_info[1] == alignment_name and params["ws_name"] in [obj_info[7], str(obj_info[6])]:
+            print("Reusing alignment {} of {}".format(alignment["ref"], reads_ref))
+            return alignment
+        with self.tracer.span("copy_alignment") as span:
+            span.add_ref(alignment["ref"])
+            output_ref = copy_object(alignment["ref"], params["ws_name"], alignment_name,
+                                     self.workspace_url, info_cache=self.info_cache)
+            span.add_ref(output_ref)
+        print("Copied alignment {} of {} to {}".format(alignment["ref"], reads_ref, output_ref))
+        alignment = {
+            "ref": output_ref,
+            "name": alignment_name,
+            "alignment_stats": alignment.get("alignment_stats")
+        }
+        self.memo.record(memo_key, reads_ref, alignment)
+        return alignment
+
+    def _remove_reads_files(self, reads):
+        for key in ["file_fwd", "file_rev"]:
+            self.scratch.free(reads.get(key))
 
     def run_batch(self, reads_refs, params):
         """
@@ -123,18 +621,181 @@ class Hisat2(object):
             "ref": reads object reference,
             "condition": condition for that ref (string)
         }
+        params["runner"] picks how the alignments get run:
+            "parallel" (default) - each reads library is aligned by a KBParallel subtask.
+            "local_pool" - all reads libraries are aligned on this node, by a pool of workers.
+            "hybrid" - small reads libraries are aligned on this node, and big ones by KBParallel
+                       subtasks, at the same time.
+        If params["multiplex"] is 1, small reads libraries are aligned in groups on this node,
+        each group through a single hisat2 process (see _run_multiplexed), one group after
+        another while the runner aligns the rest. The runner gets the biggest libraries first,
+        and runs at most params["max_concurrent_tasks"] alignments at once, if that's given.
+        Each alignment is checkpointed as soon as it's done (see the manifest module). Reads
+        libraries that were already aligned with the same parameters by an earlier run are
+        skipped, and if any fail, the rest are still kept for the next run.
+        """
+        runner = params.get("runner", "parallel")
+        if runner == "local_pool":
+            run_func = self._run_batch_local
+        elif runner == "parallel":
+            run_func = self._run_batch_parallel
+        elif runner == "hybrid":
+            run_func = self._run_batch_hybrid
+        else:
+            raise ValueError("Unknown batch runner '{}'".format(runner))
+        with self.tracer.span("run_batch", runner=runner, num_reads=len(reads_refs)) as span:
+            self._start_qc(params)
+            self.info_cache.prefetch([reads_ref["ref"] for reads_ref in reads_refs] +
+                                     [params["genome_ref"]])
+            manifest = BatchManifest(get_manifest_path(self.working_dir, params))
+            keys = [get_checkpoint_key(reads_ref["ref"], self._get_sample_params(params, reads_ref))
+                    for reads_ref in reads_refs]
+            alignments = self._load_checkpoints(manifest, reads_refs, keys)
+            span.set(num_checkpointed=len(alignments))
+            # the rest might have been aligned the same way by some other run. A reads library
+            # that's in the set more than once only gets aligned once.
+            pending = list()
+            pending_refs = set()
+            for (idx, reads_ref) in enumerate(reads_refs):
+                if reads_ref["ref"] in alignments or reads_ref["ref"] in pending_refs:
+                    continue
+                sample_params = self._get_sample_params(params, reads_ref)
+                memo_key = self._get_memo_key(reads_ref["ref"], sample_params["condition"],
+                                              sample_params)
+                alignment = self._reuse_alignment(memo_key, reads_ref["ref"], sample_params)
+                if alignment is None:
+                    pending.append(idx)
+                    pending_refs.add(reads_ref["ref"])
+                    continue
+                manifest.record(keys[idx], reads_ref["ref"], alignment)
+                self._submit_qc(alignment)
+                alignments[reads_ref["ref"]] = alignment
+            span.set(num_memoized=len(alignments) - span.attrs["num_checkpointed"])
+            print("{} of {} reads libraries left to align, the rest were already aligned or are "
+                  "repeats".format(len(pending), len(reads_refs)))
+            if len(pending) > 0:
+                # build (or fetch) the index once, up front, and share it with all the workers
+                # so they don't each build their own copy.
+                idx_prefix = self.build_index(params["genome_ref"],
+                                              index_shock_id=params.get("index_shock_id"),
+                                              num_threads=params.get("num_threads"))
+                errors = dict()
+                # small libraries get aligned a group at a time, through one hisat2 process
+                # per group, in the background while the runner aligns the rest.
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    multiplexed = list()
+                    if params.get("multiplex", 0) == 1:
+                        (groups, pending) = plan_multiplex_groups([
+                            {"idx": idx,
+                             "read_count": self._get_read_count(reads_refs[idx]["ref"])}
+                            for idx in pending
+                        ])
+                        span.set(num_multiplexed=sum(len(group) for group in groups))
+                        self.scratch.set_budget(get_scratch_budget(self.working_dir,
+                                                                   params.get("max_scratch_gb")))
+                        multiplexed = [
+                            executor.submit(self._run_multiplexed,
+                                            [reads_refs[idx] for idx in group], params,
+                                            idx_prefix, manifest, [keys[idx] for idx in group],
+                                            parent=span)
+                            for group in groups
+                        ]
+                    if len(pending) > 0:
+                        # the biggest libraries go first, so one that's much bigger than the
+                        # rest doesn't start last and hold up the whole batch.
+                        pending = self._schedule_largest_first(reads_refs, pending)
+                        span.set(schedule=[reads_refs[idx]["ref"] for idx in pending])
+                        (new_alignments, new_errors) = run_func(
+                            [reads_refs[idx] for idx in pending], params, idx_prefix, manifest,
+                            [keys[idx] for idx in pending])
+                        alignments.update(new_alignments)
+                        errors.update(new_errors)
+                    for future in multiplexed:
+                        (new_alignments, new_errors) = future.result()
+                        alignments.update(new_alignments)
+                        errors.update(new_errors)
+                if len(errors) > 0:
+                    failed = sorted(errors.keys())
+                    raise RuntimeError(
+                        "Failed to align {} of {} reads libraries ({}). The {} alignments that "
+                        "worked are checkpointed, so running this again with the same "
+                        "parameters only aligns the rest. The first error was: {}".format(
+                            len(failed), len(reads_refs), ", ".join(failed), len(alignments),
+                            errors[failed[0]]))
+
+            # they were aligned in whatever order they were scheduled or finished in, so they
+            # get put back in the same order as the reads, for the results and the set.
+            alignments = dict((reads_ref["ref"], alignments[reads_ref["ref"]])
+                              for reads_ref in reads_refs)
+            alignment_items = list()
+            for reads_ref in reads_refs:
+                alignment_items.append({
+                    "ref": alignments[reads_ref["ref"]]["ref"],
+                    "label": reads_ref.get(
+                        "condition",
+                        params.get("condition",
+                                   "unspecified"))
+                })
+            set_name = self._get_object_name(params["sampleset_ref"])
+            output_ref = self.upload_alignment_set(
+                alignment_items, set_name + params["alignmentset_suffix"], params["ws_name"]
+            )
+            span.set(peak_scratch_bytes=self.scratch.peak)
+            return (alignments, output_ref)
+
+    def _get_sample_params(self, params, reads_ref):
+        """
+        Returns a copy of the batch parameters for aligning the reads_ref item of a batch.
+        """
+        single_param = dict(params)  # need a copy of the params
+        single_param["build_report"] = 0
+        if "condition" in reads_ref:
+            single_param["condition"] = reads_ref["condition"]
+        else:
+            single_param["condition"] = "unspecified"
+        return single_param
+
+    def _load_checkpoints(self, manifest, reads_refs, keys):
+        """
+        Returns a dict of reads ref -> alignment, for each of reads_refs that has a checkpoint
+        under its key in the manifest, and whose alignment is still in the Workspace.
+        """
+        checkpoints = dict()
+        for (reads_ref, key) in zip(reads_refs, keys):
+            alignment = manifest.get(key)
+            if alignment is not None:
+                checkpoints[reads_ref["ref"]] = (key, alignment)
+        self.info_cache.prefetch([alignment["ref"] for (_, alignment) in checkpoints.values()])
+        alignments = dict()
+        for (reads_ref, (key, alignment)) in checkpoints.items():
+            try:
+                self.info_cache.get_info(alignment["ref"])
+            except RuntimeError:
+                print("Checkpointed alignment {} of {} is gone, so it'll be aligned again".format(
+                    alignment["ref"], reads_ref))
+                manifest.discard(key)
+                continue
+            alignments[reads_ref] = alignment
+            self._submit_qc(alignment)
+        return alignments
+
+    def _run_batch_parallel(self, reads_refs, params, idx_prefix, manifest, keys):
         """
+        Runs each alignment as a KBParallel subtask, which retries it on its own if it fails.
+        The index with the given prefix gets uploaded so the subtasks can use it without
+        building their own. Each alignment gets recorded in the manifest under its key from
+        keys. Returns a tuple of (dict of reads ref -> alignment, dict of reads ref -> error)
+        """
+        index_shock_id = params.get("index_shock_id")
+        if index_shock_id is None:
+            index_shock_id = self.share_index(idx_prefix)
+
         # build task list and send it to KBParallel
         tasks = list()
-        set_name = get_object_names([params["sampleset_ref"]], self.workspace_url)[params["sampleset_ref"]]
         for idx, reads_ref in enumerate(reads_refs):
-            single_param = dict(params)  # need a copy of the params
-            single_param["build_report"] = 0
+            single_param = self._get_sample_params(params, reads_ref)
+            single_param["index_shock_id"] = index_shock_id
             single_param["sampleset_ref"] = reads_ref["ref"]
-            if "condition" in reads_ref:
-                single_param["condition"] = reads_ref["condition"]
-            else:
-                single_param["condition"] = "unspecified"
 
             tasks.append({
                 "module_name": "kb_hisat2",
@@ -142,38 +803,413 @@ class Hisat2(object):
                 "version": self.my_version,
                 "parameters": single_param
             })
+        results = self._run_kbparallel(tasks, params)
+        alignments = dict()
+        errors = dict()
+        for idx, result in enumerate(results):
+            # idx of the result is the same as the idx of the inputs AND reads_refs
+            reads_ref = tasks[idx]["parameters"]["sampleset_ref"]
+            if result["is_error"] != 0:
+                errors[reads_ref] = result["result_package"]["error"]
+                continue
+            alignments[reads_ref] = result["result_package"]["result"][0]["alignment_objs"][reads_ref]
+            manifest.record(keys[idx], reads_ref, alignments[reads_ref])
+            memo_key = self._get_memo_key(reads_ref, tasks[idx]["parameters"]["condition"],
+                                          tasks[idx]["parameters"])
+            self.memo.record(memo_key, reads_ref, alignments[reads_ref])
+            self._submit_qc(alignments[reads_ref])
+        return (alignments, errors)
+
+    def _run_kbparallel(self, tasks, params):
+        """
+        Runs tasks as KBParallel subtasks, each retried up to MAX_RETRIES times, and at most
+        params["max_concurrent_tasks"] of them at once, if that's given. Returns their results,
+        in the same order as the tasks.
+        """
         # UNCOMMENT BELOW FOR LOCAL TESTING
         batch_run_params = {
             "tasks": tasks,
             "runner": "parallel",
             # "concurrent_local_tasks": 3,
             # "concurrent_njsw_tasks": 0,
-            "max_retries": 2
+            "max_retries": MAX_RETRIES
         }
-        parallel_runner = KBParallel(self.callback_url)
-        results = parallel_runner.run_batch(batch_run_params)["results"]
-        alignment_items = list()
+        if params.get("max_concurrent_tasks") is not None:
+            batch_run_params["concurrent_njsw_tasks"] = int(params["max_concurrent_tasks"])
+        with self.tracer.span("kbparallel", num_tasks=len(tasks)) as span:
+            span.set(concurrent_njsw_tasks=batch_run_params.get("concurrent_njsw_tasks"))
+            parallel_runner = KBParallel(self.callback_url)
+            return parallel_runner.run_batch(batch_run_params)["results"]
+
+    def _run_batch_local(self, reads_refs, params, idx_prefix, manifest, keys):
+        """
+        Runs all of the alignments on this node, as a pipeline: while one sample is being
+        aligned, the next ones are downloading, and the previous ones are uploading. Several
+        alignments run side by side, as many as fit in the CPUs and memory available, each
+        with an even share of the CPUs, and all using the index with the given prefix. New
+        samples aren't downloaded while the scratch space the samples in flight use, or are
+        projected to use from their read counts, would go over the scratch budget. Each
+        sample's files are removed as soon as the next stage is done with them. Like with
+        KBParallel, a failed sample is retried up to MAX_RETRIES times.
+        Each alignment gets recorded in the manifest under its key from keys as soon as it's
+        uploaded. Returns a tuple of (dict of reads ref -> alignment, dict of reads ref -> error)
+        """
+        (num_workers, threads_per_worker) = self._plan_local_workers(len(reads_refs), params,
+                                                                     idx_prefix)
+        self.scratch.set_budget(get_scratch_budget(self.working_dir, params.get("max_scratch_gb")))
+        print("Aligning {} reads libraries with {} local workers, {} threads each, "
+              "using up to {} bytes of scratch space".format(
+                len(reads_refs), num_workers, threads_per_worker, self.scratch.max_bytes))
+
+        samples = list()
+        for idx, reads_ref in enumerate(reads_refs):
+            single_param = self._get_sample_params(params, reads_ref)
+            single_param["num_threads"] = threads_per_worker
+            samples.append({
+                "idx": idx,
+                "reads_ref": reads_ref,
+                "params": single_param,
+                "output_file": "accepted_hits_{}".format(idx),
+                "checkpoint_key": keys[idx],
+                "projected_scratch": self._estimate_sample_scratch(reads_ref["ref"])
+            })
+        pipeline = Pipeline([
+            ("download_sample", self._fetch_sample, NUM_TRANSFER_WORKERS),
+            ("align_sample", partial(self._align_sample, idx_prefix), num_workers),
+            ("upload_sample", partial(self._upload_sample, manifest), NUM_TRANSFER_WORKERS)
+        ], max_retries=MAX_RETRIES, cleanup=self._clean_up_sample, tracer=self.tracer,
+            parent=self.tracer.current())
+        (results, errors) = pipeline.run(samples)
+        print("Done! Peak scratch usage was {} bytes".format(self.scratch.peak))
+
         alignments = dict()
-        for idx, result in enumerate(results):
-            # idx of the result is the same as the idx of the inputs AND reads_refs
-            if result["is_error"] != 0:
-                raise RuntimeError("Failed a parallel run of HISAT2! {}".format(result["result_package"]["error"]))
-            reads_ref = tasks[idx]["parameters"]["sampleset_ref"]
-            alignment_items.append({
-                "ref": result["result_package"]["result"][0]["alignment_objs"][reads_ref]["ref"],
-                "label": reads_refs[idx].get(
-                    "condition",
-                    params.get("condition",
-                               "unspecified"))
+        for idx, sample in enumerate(results):
+            if sample is not None:
+                alignments[reads_refs[idx]["ref"]] = sample["alignment"]
+        return (alignments, dict((reads_refs[idx]["ref"], error)
+                                 for (idx, error) in errors.items()))
+
+    def _run_batch_hybrid(self, reads_refs, params, idx_prefix, manifest, keys):
+        """
+        Splits the alignments between this node and KBParallel (see plan_placement), from the
+        total bases in each library's metadata. The small ones get aligned here against the
+        index with the given prefix, like with _run_batch_local, while the big ones are
+        aligned by KBParallel subtasks at the same time, like with _run_batch_parallel. The
+        plan is kept for the report. Returns a tuple of (dict of reads ref -> alignment, dict
+        of reads ref -> error)
+        """
+        resources = plan_resources(max_threads=params.get("num_threads"))
+        memory_per_alignment = estimate_alignment_memory(
+            idx_prefix, resources, shared_index=params.get("shared_index", 0) == 1)
+        sample_bases = list()
+        for reads_ref in reads_refs:
+            counts = get_reads_counts(self.info_cache.get_info(reads_ref["ref"]))
+            sample_bases.append(counts[1] if counts is not None else None)
+        placements = plan_placement(sample_bases, memory_per_alignment, resources)
+        for (reads_ref, total_bases, placement) in zip(reads_refs, sample_bases, placements):
+            self.placements[reads_ref["ref"]] = {
+                "placement": placement,
+                "total_bases": total_bases
+            }
+        runs = list()
+        for (placement, run_func) in [("remote", self._run_batch_parallel),
+                                      ("local", self._run_batch_local)]:
+            idxs = [idx for idx in range(len(reads_refs)) if placements[idx] == placement]
+            if len(idxs) > 0:
+                runs.append((placement, run_func, idxs))
+        self.tracer.current().set(num_local=placements.count("local"),
+                                  num_remote=placements.count("remote"))
+        print("Aligning {} reads libraries on this node, and {} with KBParallel".format(
+            placements.count("local"), placements.count("remote")))
+
+        alignments = dict()
+        errors = dict()
+        # the runs' threads have no open spans of their own, so theirs go under this one.
+        parent = self.tracer.current()
+        with ThreadPoolExecutor(max_workers=len(runs) or 1) as executor:
+            futures = [executor.submit(self._run_placed, placement, run_func, parent,
+                                       [reads_refs[idx] for idx in idxs], params, idx_prefix,
+                                       manifest, [keys[idx] for idx in idxs])
+                       for (placement, run_func, idxs) in runs]
+            for future in futures:
+                (new_alignments, new_errors) = future.result()
+                alignments.update(new_alignments)
+                errors.update(new_errors)
+        return (alignments, errors)
+
+    def _run_placed(self, placement, run_func, parent, reads_refs, params, idx_prefix, manifest,
+                    keys):
+        """
+        Runs the alignments that _run_batch_hybrid placed in one place with run_func, traced
+        in a span under parent.
+        """
+        with self.tracer.span("run_" + placement, parent=parent, num_reads=len(reads_refs)):
+            return run_func(reads_refs, params, idx_prefix, manifest, keys)
+
+    def _plan_local_workers(self, num_tasks, params, idx_prefix):
+        """
+        Decides how many alignments against the index with the given prefix to run side by
+        side on this node, as many as fit in the CPUs and memory available, and no more than
+        params["max_concurrent_tasks"], if that's given. Returns a tuple of (number of workers,
+        threads per worker).
+        """
+        resources = plan_resources(max_threads=params.get("num_threads"))
+        # with a shared index, the workers all use one copy of it, instead of one each.
+        shared_index = params.get("shared_index", 0) == 1
+        shared_memory = get_hisat2_index_size(idx_prefix) if shared_index else 0
+        # as many as the CPUs allow (a worker's memory doesn't count yet), then fewer until
+        # they fit in memory too. Each worker's memory comes from the plan for its own share
+        # of the CPUs, since it sorts with fewer threads than a single alignment on the whole
+        # node would.
+        max_workers = plan_workers(num_tasks, 0, resources)
+        if params.get("max_concurrent_tasks") is not None:
+            max_workers = min(max_workers, int(params["max_concurrent_tasks"]))
+        for num_workers in range(max_workers, 0, -1):
+            worker_resources = plan_resources(max_threads=resources["cpus"] // num_workers)
+            memory_per_alignment = estimate_alignment_memory(idx_prefix, worker_resources,
+                                                             shared_index=shared_index)
+            if plan_workers(num_workers, memory_per_alignment, resources,
+                            shared_memory=shared_memory) == num_workers:
+                break
+        return (num_workers, max(1, resources["cpus"] // num_workers))
+
+    def _estimate_sample_scratch(self, reads_ref):
+        """
+        Estimates the most scratch space aligning reads_ref takes, from the read count and
+        total bases in its metadata. Returns 0 if it doesn't have those.
+        """
+        counts = get_reads_counts(self.info_cache.get_info(reads_ref))
+        if counts is None:
+            return 0
+        return estimate_reads_scratch(*counts)
+
+    def _schedule_largest_first(self, reads_refs, pending):
+        """
+        Returns the indexes in pending (of reads_refs) in the order they should be aligned:
+        longest processing time first, by the total bases in each library's metadata, which
+        the time to align it goes up with. Libraries without that go first, since they might be
+        the biggest. Ties keep their order in the set.
+        """
+        costs = dict()
+        for idx in pending:
+            counts = get_reads_counts(self.info_cache.get_info(reads_refs[idx]["ref"]))
+            costs[idx] = counts[1] if counts is not None else None
+        return sorted(pending, key=lambda idx: (costs[idx] is not None, -(costs[idx] or 0)))
+
+    def _get_read_count(self, reads_ref):
+        """
+        Returns the number of reads in reads_ref, from its metadata, or None if it doesn't
+        have that.
+        """
+        counts = get_reads_counts(self.info_cache.get_info(reads_ref))
+        return counts[0] if counts is not None else None
+
+    def _run_multiplexed(self, reads_refs, params, idx_prefix, manifest, keys, parent=None):
+        """
+        Aligns a group of small reads libraries on this node, all through one hisat2 process
+        (see the multiplex module), instead of starting hisat2 and loading the index with the
+        given prefix once for each of them. Each library still gets its own alignment, with its
+        own stats, uploaded on its own and recorded in the manifest under its key from keys.
+        Like with the other runners, a failed group is retried up to MAX_RETRIES times. parent
+        is the span to trace it under, when it's run in another thread.
+        Returns a tuple of (dict of reads ref -> alignment, dict of reads ref -> error)
+        """
+        samples = list()
+        for idx, reads_ref in enumerate(reads_refs):
+            single_param = self._get_sample_params(params, reads_ref)
+            # the reads get rewritten on their way into hisat2, so they can't be streamed.
+            single_param["stream_reads"] = 0
+            samples.append({
+                "idx": idx,
+                "reads_ref": reads_ref,
+                "params": single_param,
+                "output_file": "accepted_hits_multiplexed_{}".format(idx),
+                "checkpoint_key": keys[idx]
             })
-            alignments[reads_ref] = result["result_package"]["result"][0]["alignment_objs"][reads_ref]
-        # build the final alignment set
-        output_ref = self.upload_alignment_set(
-            alignment_items, set_name + params["alignmentset_suffix"], params["ws_name"]
-        )
-        return (alignments, output_ref)
+        with self.tracer.span("run_hisat2_multiplexed", parent=parent,
+                              num_reads=len(samples)) as span:
+            for sample in samples:
+                span.add_ref(sample["reads_ref"]["ref"])
+            for attempt in range(MAX_RETRIES + 1):
+                try:
+                    self._align_multiplexed(idx_prefix, samples)
+                    break
+                except Exception as e:
+                    print("Multiplexed alignment of {} reads libraries failed (attempt {} of {}):"
+                          .format(len(samples), attempt + 1, MAX_RETRIES + 1))
+                    traceback.print_exc()
+                    for sample in samples:
+                        self._clean_up_sample(sample)
+                    error = e
+            else:
+                return (dict(), dict((sample["reads_ref"]["ref"], error) for sample in samples))
+            span.add_bytes(_files_size([sample["alignment_file"] for sample in samples]))
+
+            # the upload threads have no open spans of their own, so theirs go under this one.
+            def upload(sample, parent):
+                with self.tracer.span("upload_sample", parent=parent):
+                    return self._upload_sample(manifest, sample)
+
+            alignments = dict()
+            errors = dict()
+            with ThreadPoolExecutor(max_workers=NUM_TRANSFER_WORKERS) as executor:
+                uploads = [(sample, executor.submit(upload, sample, span))
+                           for sample in samples]
+                for (sample, future) in uploads:
+                    reads_ref = sample["reads_ref"]["ref"]
+                    try:
+                        alignments[reads_ref] = future.result()["alignment"]
+                    except Exception as e:
+                        print("Failed to upload the alignment of {}: {}".format(reads_ref, e))
+                        self._clean_up_sample(sample)
+                        errors[reads_ref] = e
+            return (alignments, errors)
+
+    def _align_multiplexed(self, idx_prefix, samples):
+        """
+        Fetches the reads of each sample, adds them to a combined FASTQ file (or pair of them)
+        for their type of reads, tagged with the sample's place in it, and frees them. Then
+        aligns each combined file against the index with the given prefix, with one hisat2
+        process. Like after _align_sample, each sample has its "reads", with their
+        "alignment_stats", and its sorted and indexed "alignment_file".
+        The group waits for room in the scratch budget for all of its samples at once, since
+        none of them are done until they've all been aligned.
+        """
+        owner = "multiplexed_" + str(uuid.uuid4())
+        combined = dict()  # reads style -> {"files": [...], "outs": [...], "samples": [...]}
+        self.scratch.admit(owner, sum(self._estimate_sample_scratch(sample["reads_ref"]["ref"])
+                                      for sample in samples))
+        try:
+            for sample in samples:
+                reads = self.fetch_reads(sample["reads_ref"], sample["params"])
+                sample["reads"] = reads
+                if reads["style"] not in combined:
+                    prefix = os.path.join(self.job_dir, "{}_{}".format(owner, reads["style"]))
+                    files = [prefix + "_1.fq"]
+                    if reads["style"] == "paired":
+                        files.append(prefix + "_2.fq")
+                    combined[reads["style"]] = {
+                        "files": [self.scratch.track(owner, f) for f in files],
+                        "outs": [open(f, "wb") for f in files],
+                        "samples": list()
+                    }
+                group = combined[reads["style"]]
+                sample["tag"] = make_tag(len(group["samples"]))
+                group["samples"].append(sample)
+                with self.tracer.span("tag_reads") as span:
+                    span.add_ref(reads["object_ref"])
+                    for (key, out) in zip(["file_fwd", "file_rev"], group["outs"]):
+                        span.add_bytes(_files_size([reads[key]]))
+                        write_tagged_reads(reads[key], out, sample["tag"])
+                self._remove_reads_files(reads)
+            for group in combined.values():
+                for out in group["outs"]:
+                    out.close()
+            self.scratch.update(owner)
+            for style in sorted(combined):
+                self._align_multiplexed_files(idx_prefix, style, combined[style]["files"],
+                                              combined[style]["samples"])
+        finally:
+            for group in combined.values():
+                for out in group["outs"]:
+                    out.close()
+            self.scratch.release(owner)
+
+    def _align_multiplexed_files(self, idx_prefix, style, files, samples):
+        """
+        Aligns combined reads files from _align_multiplexed against the index with the given
+        prefix, with one hisat2 process. Its output gets split up by tag, as it's written, into
+        a samtools sort for each sample, which makes that sample's alignment file.
+        """
+        params = samples[0]["params"]
+        resources = plan_resources(max_threads=params.get("num_threads"))
+        cmd = self._build_hisat2_cmd(idx_prefix, style, files[:1], files[1:], None,
+                                     self._build_exec_params(idx_prefix, params, resources))
+        span = self.tracer.current()
+        sort_procs = list()
+        sinks = dict()
+        stats = dict()
+        for sample in samples:
+            sample["alignment_file"] = os.path.join(self.job_dir, sample["output_file"] + ".bam")
+            sort_cmd = self._build_sort_cmd(sample["alignment_file"],
+                                            os.path.join(self.job_dir,
+                                                         sample["output_file"] + ".sort"),
+                                            num_threads=1, memory_per_thread=MULTIPLEX_SORT_MEMORY)
+            sort_p = MonitoredProcess(sort_cmd, name="samtools sort", span=span, shell=False,
+                                      stdin=subprocess.PIPE)
+            sort_procs.append(sort_p)
+            sinks[sample["tag"]] = sort_p.stdin
+            stats[sample["tag"]] = AlignmentStats()
+        print("Starting HISAT2 on {} multiplexed reads libraries with the following "
+              "command:".format(len(samples)))
+        print(cmd)
+        try:
+            p = MonitoredProcess(cmd, span=span, shell=False, stdout=subprocess.PIPE)
+        except Exception:
+            for sort_p in sort_procs:
+                sort_p.stdin.close()
+                sort_p.wait()
+            raise
+        # the tee closes every pipe when it's done, so each samtools sees EOF.
+        demux = SamDemuxTee(p.stdout, sinks, stats)
+        demux.start()
+        ret_code = p.wait()
+        demux.join()
+        sort_ret_codes = [sort_p.wait() for sort_p in sort_procs]
+        if ret_code != 0:
+            raise RuntimeError('Failed to execute HISAT2 alignment with the given parameters!')
+        if any(code != 0 for code in sort_ret_codes):
+            raise RuntimeError('Failed to sort HISAT2 alignment into a BAM file!')
+        if demux.error is not None:
+            raise RuntimeError('Failed to demultiplex HISAT2 alignment: {}'.format(demux.error))
+        for sample in samples:
+            p = run_process(["samtools", "index", sample["alignment_file"]],
+                            name="samtools index", span=span, shell=False)
+            if p.returncode != 0:
+                raise RuntimeError('Failed to index BAM file {}!'.format(sample["alignment_file"]))
+            self.scratch.track(sample["reads_ref"]["ref"], sample["alignment_file"])
+            self.scratch.track(sample["reads_ref"]["ref"], sample["alignment_file"] + ".bai")
+            # hisat2's own summary covers every library, so each gets one from its records.
+            sample_stats = stats[sample["tag"]]
+            sample_stats.set_summary(sample_stats.read_summary())
+            sample["reads"]["alignment_stats"] = sample_stats.to_dict()
 
-    def run_hisat2(self, idx_prefix, reads, input_params, output_file="accepted_hits"):
+    def _fetch_sample(self, sample):
+        self.scratch.admit(sample["reads_ref"]["ref"], sample["projected_scratch"])
+        sample["reads"] = self.fetch_reads(sample["reads_ref"], sample["params"])
+        return sample
+
+    def _align_sample(self, idx_prefix, sample):
+        sample["alignment_file"] = self.align_fetched_reads(
+            idx_prefix, sample["reads"], sample["params"], sample["output_file"])
+        return sample
+
+    def _upload_sample(self, manifest, sample):
+        sample["alignment"] = self.upload_fetched_alignment(
+            sample["params"], sample["reads"], sample["alignment_file"])
+        manifest.record(sample["checkpoint_key"], sample["reads_ref"]["ref"], sample["alignment"])
+        # QC of this sample starts now, alongside the ones still being aligned.
+        self._submit_qc(sample["alignment"])
+        self.scratch.release(sample["reads_ref"]["ref"])
+        return sample
+
+    def _clean_up_sample(self, sample):
+        """
+        Clears out whatever files a failed sample left behind, so it can start over.
+        """
+        if "reads" in sample:
+            close_reads_streams(sample["reads"].get("streams", []), raise_errors=False)
+            self._remove_reads_files(sample.pop("reads"))
+        if "alignment_file" in sample:
+            self._remove_alignment_files(sample.pop("alignment_file"))
+        self.scratch.release(sample["reads_ref"]["ref"])
+
+    def _remove_alignment_files(self, alignment_file):
+        for f in [alignment_file, alignment_file + ".bai"]:
+            self.scratch.free(f)
+
+    def run_hisat2(self, idx_prefix, reads, input_params, output_file="accepted_hits",
+                   output_format="bam", stats=None):
         """
         Runs HISAT2 on the data with the given parameters. Only operates on a single set of
         single-end or paired-end reads.
@@ -183,7 +1219,7 @@ class Hisat2(object):
 
         Before this is run...
         1. the index file(s) should be present in the file system (in idx_prefix)
-        2. the reads file(s) should be present in the file system, too (in self.working_dir/reads)
+        2. the reads file(s) should be present in the file system, too (in self.job_dir/reads)
 
         idx_prefix = absolute path to index files, with the file prefix.
                      E.g. /kb/scratch/idx/genome_index.
@@ -194,9 +1230,14 @@ class Hisat2(object):
         object_ref = ...something?
         input_params = original dictionary of inputs and parameters from the Narrative App. This
                        gets munged into HISAT2 flags.
-        output_file = the file prefix (before ".sam") for the generated reads. Default =
-                      "accepted_hits". Used for doing multiple alignments over a set of
-                      reads (a ReadsSet or SampleSet).
+        output_file = the file prefix (before ".bam" or ".sam") for the generated reads.
+                      Default = "accepted_hits". Used for doing multiple alignments over a set
+                      of reads (a ReadsSet or SampleSet).
+        output_format = "bam" or "sam". Default = "bam". For "bam", the HISAT2 output is
+                        streamed straight into samtools sort, so only a coordinate-sorted and
+                        indexed BAM file gets written, never the much larger SAM file.
+        stats = an AlignmentStats to add the alignment's statistics to, gathered from the
+                HISAT2 summary and its output records as they're written.
         """
         # from the inputs, we need the sets of reads.
         # cases:
@@ -228,16 +1269,98 @@ class Hisat2(object):
 
         # 2. Set up a list of parameters to feed into the command builder
         print("Building HISAT2 execution parameters...")
-        exec_params = list()
-        exec_params.extend(["-p", str(input_params.get('num_threads', 2))])
+        resources = plan_resources(max_threads=input_params.get("num_threads"))
+        exec_params = self._build_exec_params(idx_prefix, input_params, resources)
+        print("Done!")
+        print("Building HISAT2 command...")
+        if output_format not in ["bam", "sam"]:
+            raise ValueError("HISAT2 output format must be 'bam' or 'sam', "
+                             "not '{}'".format(output_format))
+        alignment_file = os.path.join(self.job_dir, "{}.{}".format(output_file, output_format))
+        summary_file = os.path.join(self.job_dir, output_file + ".summary.txt")
+        exec_params.extend(["--new-summary", "--summary-file", summary_file])
+        if stats is None:
+            stats = AlignmentStats()
+        cmd = self._build_hisat2_cmd(idx_prefix,
+                                     style,
+                                     files_fwd,
+                                     files_rev,
+                                     alignment_file if output_format == "sam" else None,
+                                     exec_params)
+        print("Done!")
+        print("Starting HISAT2 with the following command:")
+        print(cmd)
+        # resource use of each process gets recorded in the current trace span.
+        span = self.tracer.current()
+        if output_format == "sam":
+            p = MonitoredProcess(cmd, span=span, shell=False)
+            ret_code = p.wait()
+            if ret_code != 0:
+                raise RuntimeError('Failed to execute HISAT2 alignment with the given parameters!')
+            stats.add_file(alignment_file)
+        else:
+            sort_cmd = self._build_sort_cmd(alignment_file,
+                                            os.path.join(self.job_dir, output_file + ".sort"),
+                                            num_threads=resources["sort_threads"],
+                                            memory_per_thread=resources["sort_memory_per_thread"])
+            print("Streaming HISAT2 output into samtools with the following command:")
+            print(sort_cmd)
+            p = MonitoredProcess(cmd, span=span, shell=False, stdout=subprocess.PIPE)
+            sort_p = MonitoredProcess(sort_cmd, name="samtools sort", span=span, shell=False,
+                                      stdin=subprocess.PIPE)
+            # the SAM records get counted on their way from hisat2 to samtools. The tee closes
+            # both pipes when it's done, so samtools sees EOF, and hisat2 sees SIGPIPE if
+            # samtools dies.
+            tee = SamStatsTee(p.stdout, sort_p.stdin, stats)
+            tee.start()
+            ret_code = p.wait()
+            tee.join()
+            sort_ret_code = sort_p.wait()
+            if ret_code != 0:
+                raise RuntimeError('Failed to execute HISAT2 alignment with the given parameters!')
+            if sort_ret_code != 0:
+                raise RuntimeError('Failed to sort HISAT2 alignment into a BAM file!')
+            if tee.error is not None:
+                raise RuntimeError('Failed to gather alignment stats: {}'.format(tee.error))
+            p = run_process(["samtools", "index", alignment_file], name="samtools index",
+                            span=span, shell=False)
+            if p.returncode != 0:
+                raise RuntimeError('Failed to index BAM file {}!'.format(alignment_file))
+        stats.set_summary(parse_hisat2_summary(summary_file))
+        os.remove(summary_file)
+        print("Done!")
+        return alignment_file
+
+    def _build_exec_params(self, idx_prefix, input_params, resources):
+        """
+        Returns the HISAT2 execution parameters for an alignment against the index with the
+        given prefix: the threads from resources (from plan_resources), then the options
+        input_params asks for. With a shared index, that index gets read into the page cache.
+        """
+        exec_params = ["-p", str(resources["align_threads"])]
+        exec_params.extend(self._build_hisat2_options(input_params))
+        if input_params.get("shared_index", 0) == 1:
+            # memory-map the index, so every hisat2 on the node shares the copy in the page
+            # cache. It gets read in once up front, so hisat2 doesn't wait on the disk.
+            exec_params.append("--mm")
+            with self.tracer.span("prewarm_index") as span:
+                span.add_bytes(prewarm_hisat2_index(idx_prefix))
+        return exec_params
+
+    def _build_hisat2_options(self, input_params):
+        """
+        Returns the list of HISAT2 options that input_params asks for, that change what the
+        alignment comes out like. That leaves out the files, threads, and memory-mapping options.
+        """
+        options = list()
         if input_params.get("quality_score", None) is not None:
-            exec_params.append("--" + input_params["quality_score"])
+            options.append("--" + input_params["quality_score"])
         if input_params.get("orientation", None) is not None:
-            exec_params.append("--" + input_params["orientation"])
+            options.append("--" + input_params["orientation"])
         if input_params.get("no_spliced_alignment", False):
-            exec_params.append("--no-spliced-alignment")
+            options.append("--no-spliced-alignment")
         if input_params.get("tailor_alignments", None) is not None:
-            exec_params.append("--" + str(input_params["tailor_alignments"]))
+            options.append("--" + str(input_params["tailor_alignments"]))
 
         kbase_hisat_params = {
             "skip": "--skip",
@@ -251,28 +1374,11 @@ class Hisat2(object):
         }
         for param in kbase_hisat_params:
             if input_params.get(param, None) is not None:
-                exec_params.extend([
+                options.extend([
                     kbase_hisat_params[param],
                     str(input_params[param])
                 ])
-        print("Done!")
-        print("Building HISAT2 command...")
-        alignment_file = os.path.join(self.working_dir, "{}.sam".format(output_file))
-        cmd = self._build_hisat2_cmd(idx_prefix,
-                                     style,
-                                     files_fwd,
-                                     files_rev,
-                                     alignment_file,
-                                     exec_params)
-        print("Done!")
-        print("Starting HISAT2 with the following command:")
-        print(cmd)
-        p = subprocess.Popen(cmd, shell=False)
-        ret_code = p.wait()
-        if ret_code != 0:
-            raise RuntimeError('Failed to execute HISAT2 alignment with the given parameters!')
-        print("Done!")
-        return alignment_file
+        return options
 
     # def upload_alignment_set(self, input_params, alignment_info, reads_info, alignmentset_name):
     def upload_alignment_set(self, alignment_items, alignmentset_name, ws_name):
@@ -305,13 +1411,15 @@ class Hisat2(object):
             "description": "Alignments using HISAT2, v.{}".format(HISAT_VERSION),
             "items": alignment_items
         }
-        set_api = SetAPI(self.srv_wiz_url)
-        set_info = set_api.save_reads_alignment_set_v1({
-            "workspace": ws_name,
-            "output_object_name": alignmentset_name,
-            "data": alignment_set
-        })
-        return set_info["set_ref"]
+        with self.tracer.span("upload_alignment_set") as span:
+            set_api = SetAPI(self.srv_wiz_url)
+            set_info = set_api.save_reads_alignment_set_v1({
+                "workspace": ws_name,
+                "output_object_name": alignmentset_name,
+                "data": alignment_set
+            })
+            span.add_ref(set_info["set_ref"])
+            return set_info["set_ref"]
 
     def upload_alignment(self, input_params, reads_info, alignment_name, alignment_file):
         """
@@ -338,61 +1446,98 @@ class Hisat2(object):
         print("Uploading completed alignment")
         pprint(align_upload_params)
 
-        ra_util = ReadsAlignmentUtils(self.callback_url, service_ver="dev")
-        alignment_ref = ra_util.upload_alignment(align_upload_params)["obj_ref"]
+        with self.tracer.span("upload_alignment") as span:
+            span.add_ref(reads_info["object_ref"])
+            span.add_bytes(_files_size([alignment_file]))
+            ra_util = ReadsAlignmentUtils(self.callback_url, service_ver="dev")
+            alignment_ref = ra_util.upload_alignment(align_upload_params)["obj_ref"]
+            span.add_ref(alignment_ref)
         print("Done! New alignment uploaded as object {}".format(alignment_ref))
         return alignment_ref
 
     def build_report(self, params, reads_refs, alignments, alignment_set=None):
         """
-        Builds and uploads the HISAT2 report.
+        Builds and uploads the HISAT2 report. Its page shows the alignment stats gathered
+        while HISAT2 ran. If params["qc_mode"] is "qualimap", it also links to QualiMap's BAM
+        QC of each alignment, which started as each one was uploaded (or starts now, for any
+        that didn't). The report message ends with a table of the time spent in each stage of
+        the run (up to the report itself).
         """
-        report_client = KBaseReport(self.callback_url)
-        report_text = None
-        created_objects = list()
-        for k in alignments:
-            created_objects.append({
-                "ref": alignments[k]["ref"],
-                "description": "Reads {} aligned to Genome {}".format(k, params["genome_ref"])
-            })
-        if alignment_set is not None:
-            created_objects.append({
-                "ref": alignment_set,
-                "description": "Set of all new alignments"
-            })
+        with self.tracer.span("build_report") as span:
+            report_client = KBaseReport(self.callback_url)
+            report_text = None
+            created_objects = list()
+            for k in alignments:
+                created_objects.append({
+                    "ref": alignments[k]["ref"],
+                    "description": "Reads {} aligned to Genome {}".format(k, params["genome_ref"])
+                })
+            if alignment_set is not None:
+                created_objects.append({
+                    "ref": alignment_set,
+                    "description": "Set of all new alignments"
+                })
 
-        report_text = "Created {} alignments from the given alignment set.".format(len(alignments))
+            report_text = "Created {} alignments from the given alignment set.".format(
+                len(alignments))
 
-        qm = kb_QualiMap(self.callback_url, service_ver='dev')
-        qc_ref = alignment_set
-        if qc_ref is None:  # then there's only one alignment...
-            qc_ref = alignments[list(alignments.keys())[0]]["ref"]
-        bamqc_params = {
-            "create_report": 0,
-            "input_ref": qc_ref
-        }
-        result = qm.run_bamqc(bamqc_params)
-        index_file = None
-        for f in os.listdir(result["qc_result_folder_path"]):
-            if f.endswith(".html"):
-                index_file = f
-        if index_file is None:
-            raise RuntimeError("QualiMap failed - no HTML file was found in the generated output.")
-        html_zipped = package_directory(self.callback_url,
-                                        result["qc_result_folder_path"],
-                                        index_file,
-                                        'QualiMap Results')
-        report_params = {
-            "message": report_text,
-            "direct_html_link_index": 0,
-            "html_links": [html_zipped],
-            "report_object_name": "QualiMap-" + str(uuid.uuid4()),
-            "workspace_name": params["ws_name"],
-            "objects_created": created_objects
-        }
+            stats_by_name = dict()
+            for k in alignments:
+                stats_by_name[alignments[k]["name"]] = alignments[k].get("alignment_stats")
+            for name in sorted(stats_by_name):
+                if stats_by_name[name] and stats_by_name[name]["hisat2_summary"]:
+                    report_text += "\n{}: {}% overall alignment rate".format(
+                        name, stats_by_name[name]["hisat2_summary"].get("Overall alignment rate"))
+
+            qc_pages = None
+            if params.get("qc_mode", "native") == "qualimap":
+                if self.qc is None:
+                    self.qc = SampleQC(self.callback_url, self._get_report_dir(), self.tracer)
+                for k in alignments:
+                    self._submit_qc(alignments[k])
+                with self.tracer.span("wait_for_qc"):
+                    qc_pages = self.qc.wait()
+            report_dir = self._get_report_dir()
+            html_zipped = package_directory(self.callback_url,
+                                            report_dir,
+                                            write_stats_html(stats_by_name, report_dir,
+                                                             qc_pages=qc_pages),
+                                            'HISAT2 Alignment Statistics')
+            self.scratch.track("report", report_dir)
 
-        report_info = report_client.create_extended_report(report_params)
-        return report_info
+            if len(self.placements) > 0:
+                report_text += "\n\nWhere each reads library was aligned (small ones on this " \
+                               "node, big ones by KBParallel subtasks):"
+                for k in alignments:
+                    placement = self.placements.get(k)
+                    if placement is None:
+                        continue
+                    report_text += "\n{}: {} ({})".format(
+                        alignments[k]["name"], placement["placement"],
+                        "{} bases".format(placement["total_bases"])
+                        if placement["total_bases"] is not None else "unknown size")
+            report_text += "\n\nPeak scratch space used by intermediate files: {}".format(
+                format_bytes(self.scratch.peak))
+            report_text += "\n\nRun profile:\n" + self.tracer.summary()
+            process_stats = [p for s in self.tracer.spans for p in s.attrs.get("processes", [])]
+            if len(process_stats) > 0:
+                report_text += "\n\nResources used by each program:\n" + \
+                    summarize_processes(process_stats)
+            report_params = {
+                "message": report_text,
+                "direct_html_link_index": 0,
+                "html_links": [html_zipped],
+                "report_object_name": "HISAT2-" + str(uuid.uuid4()),
+                "workspace_name": params["ws_name"],
+                "objects_created": created_objects
+            }
+
+            report_info = report_client.create_extended_report(report_params)
+            span.add_ref(report_info["ref"])
+            # the report pages were packaged up and uploaded, so they're not needed any more.
+            self.scratch.free(report_dir)
+            self.report_dir = None
+            return report_info
 
     def _build_hisat2_cmd(self, idx_prefix, style, files_fwd, files_rev, output_file, exec_params):
         """
@@ -402,6 +1547,7 @@ class Hisat2(object):
         files_rev = list of paired file names in the case of paired-end reads. Note that this
                        *MUST* be the same length as the first files list, and each element
                        corresponds to the pairing element from the other list.
+        output_file = path to the SAM file to write, or None to write to stdout.
         examples:
         _build_hisat2_cmd("foo", "single", ["file1.fq", "file2.fq"])
         _build_hisat2_cmd("z", "paired", ["fileA_1.fq", "fileB_1.fq"], ["fileA_2.fq", "fileB_2.fq"])
@@ -431,8 +1577,31 @@ class Hisat2(object):
                              "'{}' is not allowed".format(style))
 
         cmd.extend(exec_params)
-        cmd.extend([
-            "-S",
-            quote(output_file)
-        ])
+        if output_file is not None:
+            cmd.extend([
+                "-S",
+                quote(output_file)
+            ])
         return cmd
+
+    def _build_sort_cmd(self, output_file, tmp_prefix, num_threads, memory_per_thread):
+        """
+        Builds a samtools sort command that reads SAM records from stdin, and writes a
+        coordinate-sorted BAM file to output_file. samtools keeps at most memory_per_thread
+        bytes of records in memory per thread, and spills the rest to temp files starting
+        with tmp_prefix.
+        """
+        return [
+            "samtools",
+            "sort",
+            "-@", str(num_threads),
+            "-m", memory_per_thread,
+            "-T", tmp_prefix,
+            "-O", "bam",
+            "-o", output_file,
+            "-"
+        ]
+
+
+def _files_size(paths):
+    return sum(os.path.getsize(p) for p in paths if p is not None and os.path.isfile(p))
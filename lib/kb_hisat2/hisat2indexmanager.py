@@ -4,18 +4,98 @@ Module: hisat2indexmanager
 This module handles manipulation of index files for HISAT2. The main use is as follows:
 manager = Hisat2IndexManager(inputs)
 idx_prefix = manager.get_hisat2_index(source_ref)
+... align with idx_prefix ...
+manager.close()
 
 This will get onto the local filesystem (either from a datastore or by direct generation), the
 HISAT2 index files from either a genome or assembly (or contigset) object. If generated, these
-are also stored somewhere and associated with the genome ref.
+are also stored in a local cache, keyed on the exact version of the assembly they were built
+from, so they can be found again by later runs on the same node. Cached files stay pinned, so
+they can't be evicted while they're in use, until the manager is closed.
 """
 
 
 import os
-import subprocess
-import uuid
+import shutil
+import threading
 
-from kb_hisat2.file_util import fetch_fasta_from_object
+from installed_clients.DataFileUtilClient import DataFileUtil
+from kb_hisat2.file_cache import FileCache
+from kb_hisat2.file_util import fetch_fasta_from_assembly, get_fasta_stats, resolve_assembly_ref
+from kb_hisat2.process import is_out_of_memory, run_process
+from kb_hisat2.resources import plan_index_build, plan_resources
+from kb_hisat2.util import ObjectInfoCache, get_object_upa
+
+INDEX_CACHE_DIR = "kb_hisat2_idx_cache"
+INDEX_CACHE_SIZE = 50 * 1024 ** 3  # 50 GB
+FASTA_CACHE_DIR = "kb_hisat2_fasta_cache"
+FASTA_CACHE_SIZE = 20 * 1024 ** 3  # 20 GB
+INDEX_PREFIX = "kb_hisat2_idx"
+INDEX_EXTENSIONS = (".ht2", ".ht2l")
+# options that change how hisat2-build runs, but not the index it makes.
+BUILD_ONLY_OPTIONS = ["num_threads", "bmaxdivn", "dcv"]
+# memory hisat2 uses on top of the loaded index, for buffers, reads, and so on.
+ALIGNMENT_MEMORY_OVERHEAD = 512 * 1024 ** 2
+PREWARM_CHUNK_SIZE = 16 * 1024 ** 2
+
+# index prefixes already read into the page cache by this process, and a lock for each one
+# being read, so concurrent aligners wait for the first to finish instead of all reading it.
+_prewarmed = set()
+_prewarm_locks = dict()
+_prewarm_lock = threading.Lock()
+
+
+def get_hisat2_index_size(idx_prefix):
+    """
+    Returns the total size in bytes of the index files with the given prefix.
+    """
+    idx_dir, idx_name = os.path.split(idx_prefix)
+    return sum(os.path.getsize(os.path.join(idx_dir, f)) for f in os.listdir(idx_dir)
+               if f.startswith(idx_name + ".") and f.endswith(INDEX_EXTENSIONS))
+
+
+def estimate_alignment_memory(idx_prefix, resources, shared_index=False):
+    """
+    Estimates how many bytes of memory one hisat2 | samtools sort alignment against the index
+    with the given prefix needs. hisat2 loads the whole index into memory, and samtools sort
+    holds up to its memory limit per thread. resources is a plan from
+    kb_hisat2.resources.plan_resources.
+    If shared_index is True, hisat2 memory-maps the index, so one copy of it in the page cache
+    is shared by every alignment on the node, and isn't counted here.
+    """
+    sort_memory = int(resources["sort_memory_per_thread"].rstrip("M")) * 1024 ** 2
+    index_memory = 0 if shared_index else get_hisat2_index_size(idx_prefix)
+    return index_memory + ALIGNMENT_MEMORY_OVERHEAD + sort_memory * resources["sort_threads"]
+
+
+def prewarm_hisat2_index(idx_prefix):
+    """
+    Reads the index files with the given prefix into the page cache, so hisat2 processes that
+    memory-map them (with --mm) start aligning right away, instead of each faulting in pages
+    from disk. Only the first call for a prefix in this process reads the files; the rest
+    return 0 (waiting for the first to finish, if it's still going).
+    Returns the number of bytes read.
+    """
+    with _prewarm_lock:
+        if idx_prefix in _prewarmed:
+            return 0
+        lock = _prewarm_locks.setdefault(idx_prefix, threading.Lock())
+    with lock:
+        if idx_prefix in _prewarmed:
+            return 0
+        num_bytes = 0
+        idx_dir, idx_name = os.path.split(idx_prefix)
+        for f in sorted(os.listdir(idx_dir)):
+            if not (f.startswith(idx_name + ".") and f.endswith(INDEX_EXTENSIONS)):
+                continue
+            with open(os.path.join(idx_dir, f), "rb") as index_file:
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(index_file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                for chunk in iter(lambda: index_file.read(PREWARM_CHUNK_SIZE), b""):
+                    num_bytes += len(chunk)
+        with _prewarm_lock:
+            _prewarmed.add(idx_prefix)
+        return num_bytes
 
 
 class Hisat2IndexManager(object):
@@ -24,75 +104,213 @@ class Hisat2IndexManager(object):
     fetches them from SHOCK or a cache service as available.
     """
 
-    def __init__(self, workspace_url, callback_url, working_dir):
+    def __init__(self, workspace_url, callback_url, working_dir, cache_dir=None,
+                 max_cache_size=INDEX_CACHE_SIZE, info_cache=None, fasta_cache_dir=None,
+                 max_fasta_cache_size=FASTA_CACHE_SIZE, tracer=None):
         self.workspace_url = workspace_url
         self.callback_url = callback_url
         self.working_dir = working_dir
+        if info_cache is None:
+            info_cache = ObjectInfoCache(workspace_url)
+        self.info_cache = info_cache
+        if cache_dir is None:
+            cache_dir = os.path.join(working_dir, INDEX_CACHE_DIR)
+        self.cache = FileCache(cache_dir, max_cache_size)
+        if fasta_cache_dir is None:
+            fasta_cache_dir = os.path.join(working_dir, FASTA_CACHE_DIR)
+        self.fasta_cache = FileCache(fasta_cache_dir, max_fasta_cache_size)
+        self.tracer = tracer
+
+    def close(self):
+        """
+        Releases the cached index and FASTA files this manager has used, so they can be
+        evicted again.
+        """
+        self.cache.close()
+        self.fasta_cache.close()
 
-    def get_hisat2_index(self, source_ref):
+    def get_hisat2_index(self, source_ref, options=None, index_shock_id=None):
         """
         Builds or fetches the index file(s) as necessary, unpacks them in a directory.
         Returns a string representing the path and prefix of the index files.
         E.g. if there are a set of files like "foo.1.ht2", "foo.2.ht2", etc. all in the
         "my_reads" directory, this will return "my_reads/foo"
-        """
-        idx_prefix = self._fetch_hisat2_index(source_ref, {})
-        if idx_prefix:
-            return idx_prefix
-        else:
-            return self._build_hisat2_index(source_ref, {})
 
-    def inspect_hisat2_index(self):
-        pass
+        Only one process at a time will build the index for a given assembly; any others
+        asking for the same index wait for that build to finish, then use it.
 
-    def _build_hisat2_index(self, source_ref, options):
+        If index_shock_id is given, it should be the Shock node of an index packed by
+        pack_hisat2_index. That gets downloaded instead of building the index from scratch.
         """
-        Runs hisat2-build to build the index files and directory for use in HISAT2.
-        It creates a directory called "kb_hisat2_idx" and places the index files within.
-        This also caches them, um, elsewhere so they can be found again.
-        """
-        # check options and raise ValueError here as needed.
         if source_ref is None:
             raise ValueError("Missing reference object needed to build a HISAT2 index.")
-        print("Building HISAT2 index files for {}".format(source_ref))
-        idx_dir = "kb_hisat2_idx"
-        idx_prefix = "kb_hisat2_idx-" + str(uuid.uuid4())
+        if options is None:
+            options = dict()
         try:
-            os.mkdir(os.path.join(self.working_dir, idx_dir))
-        except OSError:
-            print("Ignoring error for already existing {} directory".format(idx_dir))
-        try:
-            print("Fetching FASTA file from object {}".format(source_ref))
-            fasta_file = fetch_fasta_from_object(source_ref, self.workspace_url, self.callback_url)
-            print("Done fetching FASTA file! Path = {}".format(fasta_file.get("path", None)))
+            assembly_ref = resolve_assembly_ref(source_ref, self.workspace_url,
+                                                info_cache=self.info_cache)
         except ValueError:
             print("Incorrect object type for fetching a FASTA file!")
             raise
+        cache_key = self._get_cache_key(assembly_ref, options)
+        with self.cache.lock(cache_key):
+            idx_prefix = self._fetch_hisat2_index(cache_key, options, index_shock_id)
+            if idx_prefix:
+                return idx_prefix
+            else:
+                return self._build_hisat2_index(assembly_ref, options, cache_key)
+
+    def pack_hisat2_index(self, idx_prefix):
+        """
+        Packs up the index files with the given prefix and uploads them to Shock, so they can
+        be shared with jobs running on other nodes. Returns the Shock node id.
+        """
+        # hard link the index files into their own directory, so only those get packed up,
+        # and the packed file doesn't land in the cache.
+        pack_dir = self.cache.make_staging_dir()
+        try:
+            idx_dir, idx_name = os.path.split(idx_prefix)
+            for f in os.listdir(idx_dir):
+                if f.startswith(idx_name + ".") and f.endswith(INDEX_EXTENSIONS):
+                    os.link(os.path.join(idx_dir, f), os.path.join(pack_dir, f))
+            print("Uploading HISAT2 index files with prefix {}".format(idx_prefix))
+            dfu = DataFileUtil(self.callback_url)
+            output = dfu.file_to_shock({
+                "file_path": os.path.join(pack_dir, idx_name),
+                "make_handle": 0,
+                "pack": "targz"
+            })
+        finally:
+            shutil.rmtree(pack_dir, ignore_errors=True)
+        print("Done! HISAT2 index files uploaded to Shock node {}".format(output["shock_id"]))
+        return output["shock_id"]
+
+    def inspect_hisat2_index(self):
+        pass
+
+    def _get_cache_key(self, assembly_ref, options):
+        """
+        The cache key for an index is made from the permanent address (with version) of the
+        assembly it's built from, and whatever build options change the index files.
+        """
+        assembly_upa = get_object_upa(assembly_ref, self.workspace_url, info_cache=self.info_cache)
+        key_options = {k: v for k, v in options.items() if k not in BUILD_ONLY_OPTIONS}
+        return FileCache.make_key(assembly_upa, key_options)
+
+    def _build_hisat2_index(self, assembly_ref, options, cache_key):
+        """
+        Runs hisat2-build to build the index files and directory for use in HISAT2.
+        The index files are built in a staging directory, then published to the index cache
+        so they can be found again.
+
+        The build is planned to fit in the memory this job has, from the size of the FASTA
+        file and its number of contigs (see kb_hisat2.resources.plan_index_build), using at
+        most options["num_threads"] threads. If it runs out of memory anyway, it's retried
+        with the next smaller plan, until there are none left. Any of the planned settings
+        (large_index, bmaxdivn, dcv) given in options are used as is.
+        """
+        # check options and raise ValueError here as needed.
+        print("Building HISAT2 index files for {}".format(assembly_ref))
+        print("Fetching FASTA file from object {}".format(assembly_ref))
+        fasta_file = fetch_fasta_from_assembly(assembly_ref, self.workspace_url, self.callback_url,
+                                               info_cache=self.info_cache,
+                                               fasta_cache=self.fasta_cache)
+        print("Done fetching FASTA file! Path = {}".format(fasta_file.get("path", None)))
 
         fasta_path = fasta_file.get("path", None)
         if fasta_path is None:
             raise RuntimeError("FASTA file fetched from object {} doesn't seem to "
-                               "exist!".format(source_ref))
-        build_hisat2_cmd = [
+                               "exist!".format(assembly_ref))
+        (num_bases, num_contigs) = get_fasta_stats(fasta_path)
+        resources = plan_resources(max_threads=options.get("num_threads"))
+        plans = plan_index_build(num_bases, num_contigs, resources)
+        print("Planned HISAT2 index build for {} bases in {} contigs, with {} bytes of "
+              "memory: {}".format(num_bases, num_contigs, resources["memory"], plans[0]))
+        span = self.tracer.current() if self.tracer is not None else None
+        if span is not None:
+            span.set(num_bases=num_bases, num_contigs=num_contigs, build_plans=list())
+        for (attempt, plan) in enumerate(plans):
+            plan = dict(plan, **{k: options[k] for k in ["large_index", "bmaxdivn", "dcv"]
+                                 if options.get(k) is not None})
+            staging_dir = self.cache.make_staging_dir()
+            build_hisat2_cmd = self._build_index_cmd(fasta_path,
+                                                     os.path.join(staging_dir, INDEX_PREFIX),
+                                                     plan)
+            print("Executing build-hisat2 command: {}".format(build_hisat2_cmd))
+            p = run_process(build_hisat2_cmd, span=span, shell=False)
+            if span is not None:
+                span.attrs["build_plans"].append(dict(plan, returncode=p.returncode))
+            if p.returncode == 0:
+                break
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            if not is_out_of_memory(p, resources["memory"]):
+                raise RuntimeError('Failed to generate HISAT2 index files!')
+            if attempt == len(plans) - 1:
+                raise RuntimeError('Failed to generate HISAT2 index files! hisat2-build ran '
+                                   'out of memory, even with the smallest settings.')
+            print("hisat2-build ran out of memory, retrying with {}".format(plans[attempt + 1]))
+        idx_dir = self.cache.publish(cache_key, staging_dir, info={"source_ref": assembly_ref})
+        idx_prefix_path = os.path.join(idx_dir, INDEX_PREFIX)
+        print("Done! HISAT2 index files created with prefix {}".format(idx_prefix_path))
+        return idx_prefix_path
+
+    def _build_index_cmd(self, fasta_path, idx_prefix, plan):
+        """
+        Builds the hisat2-build command for a plan from kb_hisat2.resources.plan_index_build.
+        """
+        cmd = [
             "hisat2-build",
             "-f",
-            fasta_path
+            "-p", str(plan["num_threads"])
         ]
-        if options.get('num_threads', None) is not None:
-            build_hisat2_cmd.extend(["-p", options['num_threads']])
-        idx_prefix_path = os.path.join(self.working_dir, idx_dir, idx_prefix)
-        build_hisat2_cmd.append(idx_prefix_path)
-        print("Executing build-hisat2 command: {}".format(build_hisat2_cmd))
-        p = subprocess.Popen(build_hisat2_cmd, shell=False)
-        ret_code = p.wait()
-        if ret_code != 0:
-            raise RuntimeError('Failed to generate HISAT2 index files!')
-        print("Done! HISAT2 index files created with prefix {}".format(idx_prefix_path))
+        if plan.get("large_index"):
+            cmd.append("--large-index")
+        # hisat2-build's automatic tuning would put back its own block size and dcv.
+        if plan.get("bmaxdivn") is not None or plan.get("dcv") is not None:
+            cmd.append("--noauto")
+        if plan.get("bmaxdivn") is not None:
+            cmd.extend(["--bmaxdivn", str(plan["bmaxdivn"])])
+        if plan.get("dcv") is not None:
+            cmd.extend(["--dcv", str(plan["dcv"])])
+        cmd.extend([fasta_path, idx_prefix])
+        return cmd
+
+    def _fetch_hisat2_index(self, cache_key, options, index_shock_id=None):
+        """
+        Fetches HISAT2 indexes from the local index cache, if they're available. Failing that,
+        if index_shock_id is given, downloads the packed index from there and adds it to the
+        cache.
+        """
+        idx_dir = self.cache.get(cache_key)
+        if idx_dir is None and index_shock_id is not None:
+            idx_dir = self._download_hisat2_index(cache_key, index_shock_id)
+        if idx_dir is None:
+            return None
+        idx_prefix_path = os.path.join(idx_dir, INDEX_PREFIX)
+        print("Using cached HISAT2 index files with prefix {}".format(idx_prefix_path))
         return idx_prefix_path
 
-    def _fetch_hisat2_index(self, source_ref, options):
+    def _download_hisat2_index(self, cache_key, index_shock_id):
         """
-        Fetches HISAT2 indexes from a remote location, if they're available.
+        Downloads and unpacks an index made by pack_hisat2_index, then publishes it to the
+        index cache. Returns the cache entry directory.
         """
-        # TODO: insert fetch code from file cache HERE.
-        return None
+        print("Fetching HISAT2 index files from Shock node {}".format(index_shock_id))
+        staging_dir = self.cache.make_staging_dir()
+        try:
+            dfu = DataFileUtil(self.callback_url)
+            dl = dfu.shock_to_file({
+                "shock_id": index_shock_id,
+                "file_path": staging_dir,
+                "unpack": "unpack"
+            })
+            if os.path.isfile(dl["file_path"]):
+                os.remove(dl["file_path"])
+            if not any(os.path.exists(os.path.join(staging_dir, INDEX_PREFIX + ".1" + ext))
+                       for ext in INDEX_EXTENSIONS):
+                raise RuntimeError("Shock node {} doesn't contain HISAT2 index files with "
+                                   "prefix {}".format(index_shock_id, INDEX_PREFIX))
+        except Exception:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+        return self.cache.publish(cache_key, staging_dir, info={"index_shock_id": index_shock_id})
@@ -4,10 +4,13 @@
 
 
 import os
+import uuid
 
 from kb_hisat2.file_util import fetch_reads_refs_from_sampleset
 from kb_hisat2.hisat2 import Hisat2
-from kb_hisat2.util import check_hisat2_parameters
+from kb_hisat2.scratch import job_directory
+from kb_hisat2.tracing import Tracer, get_profile_path
+from kb_hisat2.util import ObjectInfoCache, check_hisat2_parameters
 #END_HEADER
 
 
@@ -45,7 +48,6 @@ class kb_hisat2:
         self.srv_wiz_url = config['srv-wiz-url']
         self.workspace_url = config['workspace-url']
         self.shared_folder = config['scratch']
-        self.num_threads = 2
 
         #END_CONSTRUCTOR
         pass
@@ -61,12 +63,13 @@ class kb_hisat2:
            KBaseAssembly.SingleEndLibrary, KBaseAssembly.PairedEndLibrary,
            KBaseFile.SingleEndLibrary, KBaseFile.PairedEndLibrary genome_ref
            = the workspace reference for the reference genome that HISAT2
-           will align against. num_threads = the number of threads to tell
-           hisat to use (default 2) quality_score = one of phred33 or phred64
-           skip = number of initial reads to skip (default 0) trim3 = number
-           of bases to trim off of the 3' end of each read (default 0) trim5
-           = number of bases to trim off of the 5' end of each read (default
-           0) np = penalty for positions wither the read and/or the reference
+           will align against. num_threads = the maximum number of threads to
+           tell hisat to use (default is every CPU the job's container is
+           allowed to use) quality_score = one of phred33 or phred64 skip =
+           number of initial reads to skip (default 0) trim3 = number of
+           bases to trim off of the 3' end of each read (default 0) trim5 =
+           number of bases to trim off of the 5' end of each read (default 0)
+           np = penalty for positions wither the read and/or the reference
            are an ambiguous character (default 1) minins = minimum fragment
            length for valid paired-end alignments. only used if
            no_spliced_alignment is true maxins = maximum fragment length for
@@ -76,13 +79,51 @@ class kb_hisat2:
            intron length (default 20) max_intron_length = sets maximum intron
            length (default 500,000) no_spliced_alignment = disable spliced
            alignment tailor_alignments = report alignments tailored for
-           either cufflinks or stringtie condition = a string stating the
-           experimental condition of the reads. REQUIRED for single reads,
-           ignored for sets. build_report = 1 if we build a report, 0
-           otherwise. (default 1) (shouldn't be user set - mainly used for
-           subtasks) output naming: alignment_suffix is appended to the name
-           of each individual reads object name (just the one if it's a
-           simple input of a single reads library, but to each if it's a set)
+           either cufflinks or stringtie stream_reads = 1 to stream reads
+           straight from Shock into HISAT2 through named pipes, so alignment
+           starts while they're still downloading and the uncompressed FASTQ
+           files never land in scratch. (default 0) shared_index = 1 to have
+           HISAT2 memory-map the index, after reading it into the page cache
+           once, so every HISAT2 process aligning against it on the node
+           shares one copy in memory. With the "local_pool" runner, that lets
+           more libraries align at once. (default 0) num_shards = number of
+           shards to split a single reads library into, to align them in
+           parallel and merge the results into one alignment. Ignored for
+           sets. (default 1, no splitting) multiplex = 1 to align the small
+           libraries in a set (by the read counts in their metadata) in
+           groups, each group through a single HISAT2 process that loads the
+           index once, then split its output back into an alignment per
+           library. Only used for sets. (default 0) condition = a string
+           stating the experimental condition of the reads. REQUIRED for
+           single reads, ignored for sets. runner = how to run the alignments
+           when sampleset_ref is a set of reads libraries, or a library is
+           split into shards. One of "parallel" - align each library (or
+           shard) in its own KBParallel subtask (default) "local_pool" -
+           align all libraries (or shards) on this node, with a pool of
+           workers sized to its CPUs and memory "hybrid" - align the small
+           libraries in a set (by the total bases in their metadata) on this
+           node, and the big ones in KBParallel subtasks at the same time.
+           Shards always go to KBParallel. The report lists where each
+           library was aligned. max_concurrent_tasks = the most alignments of
+           a set's libraries (or a library's shards) to run at once, as
+           KBParallel subtasks or local workers. The biggest libraries always
+           start first. (default is as many as the runner allows)
+           max_scratch_gb = the most scratch space, in GB, that the samples
+           in flight may use at once when running with the "local_pool"
+           runner (default is 80% of the free space) qc_mode = how the report
+           checks the quality of the alignments. One of "native" - report the
+           stats HISAT2 gathers while aligning (default) "qualimap" - also
+           run QualiMap's BAM QC on each alignment, starting as soon as it's
+           uploaded build_report = 1 if we build a report, 0 otherwise.
+           (default 1) (shouldn't be user set - mainly used for subtasks)
+           index_shock_id = Shock node id of a packed HISAT2 index built by a
+           parent job, so subtasks don't each rebuild the index. (shouldn't
+           be user set - mainly used for subtasks) shard = a shard of a reads
+           library uploaded by a parent job, for a subtask to align on its
+           own. (shouldn't be user set - mainly used for subtasks) output
+           naming: alignment_suffix is appended to the name of each
+           individual reads object name (just the one if it's a simple input
+           of a single reads library, but to each if it's a set)
            alignmentset_suffix is appended to the name of the reads set, if a
            set is passed.) -> structure: parameter "ws_name" of String,
            parameter "alignment_suffix" of String, parameter
@@ -96,19 +137,36 @@ class kb_hisat2:
            parameter "max_intron_length" of Long, parameter
            "no_spliced_alignment" of type "bool" (indicates true or false
            values, false <= 0, true >=1), parameter "tailor_alignments" of
-           String, parameter "build_report" of type "bool" (indicates true or
-           false values, false <= 0, true >=1)
+           String, parameter "stream_reads" of type "bool" (indicates true or
+           false values, false <= 0, true >=1), parameter "shared_index" of
+           type "bool" (indicates true or false values, false <= 0, true
+           >=1), parameter "num_shards" of Long, parameter "multiplex" of
+           type "bool" (indicates true or false values, false <= 0, true
+           >=1), parameter "runner" of String, parameter
+           "max_concurrent_tasks" of Long, parameter "max_scratch_gb" of
+           Long, parameter "qc_mode" of String, parameter "build_report" of
+           type "bool" (indicates true or false values, false <= 0, true
+           >=1), parameter "index_shock_id" of String, parameter "shard" of
+           unspecified object
         :returns: instance of type "Hisat2Output" (Output for hisat2.
            alignmentset_ref if an alignment set is created alignment_objs for
            each individual alignment created. The keys are the references to
-           the reads object being aligned.) -> structure: parameter
-           "report_name" of String, parameter "report_ref" of String,
-           parameter "alignmentset_ref" of String, parameter "alignment_objs"
-           of mapping from String to type "AlignmentObj" (Created alignment
-           object returned. alignment_ref = the workspace reference of the
-           new alignment object name = the name of the new object, for
-           convenience.) -> structure: parameter "alignment_ref" of String,
-           parameter "name" of String
+           the reads object being aligned. shard_alignment is only set by
+           subtasks aligning a shard - its index, the Shock node id of its
+           BAM file, and its alignment stats. profile_file is the path, in
+           scratch, of the JSON profile of the run. Each run gets its own.)
+           -> structure: parameter "report_name" of String, parameter
+           "report_ref" of String, parameter "alignmentset_ref" of String,
+           parameter "alignment_objs" of mapping from String to type
+           "AlignmentObj" (Created alignment object returned. alignment_ref =
+           the workspace reference of the new alignment object name = the
+           name of the new object, for convenience. alignment_stats = the
+           stats gathered while aligning: HISAT2's summary, mapped counts per
+           contig, and MAPQ, splice, and insert size counts.) -> structure:
+           parameter "alignment_ref" of String, parameter "name" of String,
+           parameter "alignment_stats" of unspecified object, parameter
+           "shard_alignment" of unspecified object, parameter "profile_file"
+           of String
         """
         # ctx is the context object
         # return variables are: returnVal
@@ -118,46 +176,73 @@ class kb_hisat2:
             "report_name": None
         }
 
-        # steps to cover.
-        # 0. check the parameters
-        param_err = check_hisat2_parameters(params, self.workspace_url)
-        if len(param_err) > 0:
-            for err in param_err:
-                print(err)
-            raise ValueError("Errors found in parameters, see logs for details.")
-        hs_runner = Hisat2(self.callback_url,
-                           self.srv_wiz_url,
-                           self.workspace_url,
-                           self.shared_folder,
-                           ctx.provenance())
-        # 1. Get list of reads object references
-        reads_refs = fetch_reads_refs_from_sampleset(
-            params["sampleset_ref"], self.workspace_url, self.srv_wiz_url
-        )
-        # 2. Run hisat with index and reads.
-        alignments = dict()
-        output_ref = None
-
-        # If there's only one, run it locally right now.
-        # If there's more than one:
-        #  1. make a list of tasks to send to KBParallel.
-        #  2. add a flag to not make a report for each subtask.
-        #  3. make the report when it's all done.
-        alignmentset_ref = None
-        if len(reads_refs) == 1:
-            # if params["sampleset_ref"] is a Set type, this will make a set on output.
-            # otherwise, it doesn't.
-            (alignments, output_ref, alignmentset_ref) = hs_runner.run_single(reads_refs[0], params)
-        else:
-            (alignments, alignmentset_ref) = hs_runner.run_batch(reads_refs, params)
-
-        if params.get("build_report", 0) == 1:
-            report_info = hs_runner.build_report(params, reads_refs, alignments,
-                                                 alignment_set=alignmentset_ref)
-            returnVal["report_ref"] = report_info["ref"]
-            returnVal["report_name"] = report_info["name"]
-        returnVal["alignment_objs"] = alignments
-        returnVal["alignmentset_ref"] = alignmentset_ref
+        # every stage of the run is traced, and the profile is left in scratch whether
+        # the run works or not. The run's own files go in a directory of its own, which is
+        # removed when it's done, and its profile gets a name of its own, so several runs can
+        # share scratch at once.
+        tracer = Tracer()
+        returnVal["profile_file"] = get_profile_path(self.shared_folder, str(uuid.uuid4()))
+        with tracer.profile(returnVal["profile_file"]), \
+                job_directory(self.shared_folder) as job_dir:
+            # steps to cover.
+            # 0. check the parameters. Object info is looked up once, and shared for the rest
+            #    of the run.
+            info_cache = ObjectInfoCache(self.workspace_url)
+            param_err = check_hisat2_parameters(params, self.workspace_url,
+                                                info_cache=info_cache)
+            if len(param_err) > 0:
+                for err in param_err:
+                    print(err)
+                raise ValueError("Errors found in parameters, see logs for details.")
+            hs_runner = Hisat2(self.callback_url,
+                               self.srv_wiz_url,
+                               self.workspace_url,
+                               self.shared_folder,
+                               ctx.provenance(),
+                               info_cache=info_cache,
+                               tracer=tracer,
+                               job_dir=job_dir,
+                               token=ctx["token"])
+            # the run holds onto cached files (like its index) while it's going. Let them go
+            # when it's done, however it ends.
+            try:
+                # a subtask aligning one shard of a library that a parent job split up just
+                # aligns it, and hands the BAM file back.
+                if "shard" in params:
+                    returnVal["shard_alignment"] = hs_runner.align_shard(params)
+                else:
+                    # 1. Get list of reads object references
+                    reads_refs = fetch_reads_refs_from_sampleset(
+                        params["sampleset_ref"], self.workspace_url, self.srv_wiz_url,
+                        info_cache=info_cache
+                    )
+                    # 2. Run hisat with index and reads.
+                    alignments = dict()
+                    output_ref = None
+
+                    # If there's only one, run it locally right now.
+                    # If there's more than one:
+                    #  1. make a list of tasks to send to KBParallel.
+                    #  2. add a flag to not make a report for each subtask.
+                    #  3. make the report when it's all done.
+                    alignmentset_ref = None
+                    if len(reads_refs) == 1:
+                        # if params["sampleset_ref"] is a Set type, this will make a set on output.
+                        # otherwise, it doesn't.
+                        (alignments, output_ref, alignmentset_ref) = hs_runner.run_single(
+                            reads_refs[0], params)
+                    else:
+                        (alignments, alignmentset_ref) = hs_runner.run_batch(reads_refs, params)
+
+                    if params.get("build_report", 0) == 1:
+                        report_info = hs_runner.build_report(params, reads_refs, alignments,
+                                                             alignment_set=alignmentset_ref)
+                        returnVal["report_ref"] = report_info["ref"]
+                        returnVal["report_name"] = report_info["name"]
+                    returnVal["alignment_objs"] = alignments
+                    returnVal["alignmentset_ref"] = alignmentset_ref
+            finally:
+                hs_runner.close()
         #END run_hisat2
 
         # At some point might do deeper type checking...
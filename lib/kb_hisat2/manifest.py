@@ -0,0 +1,172 @@
+"""
+Module: manifest
+
+Keeps checkpoints of a batch run, so a run that fails partway doesn't lose the alignments that
+already worked. Each reads library that gets aligned is recorded in a JSON manifest in scratch,
+under a hash of the reads ref and every parameter that changes its alignment. A re-run of the
+same set with the same parameters reuses those alignments, as long as they're still in the
+Workspace, and only aligns the libraries that are missing. The main use is as follows:
+
+manifest = BatchManifest(get_manifest_path(scratch_dir, params))
+for reads_ref in reads_refs:
+    key = get_checkpoint_key(reads_ref["ref"], params)
+    alignment = manifest.get(key)
+    if alignment is None:
+        alignment = align(reads_ref)  # whatever it takes
+        manifest.record(key, reads_ref["ref"], alignment)
+
+The same kind of manifest also memoizes alignments across runs, whatever set they're part of
+or whatever they're named. Its keys only cover what goes into the alignment itself: the exact
+versions of the reads and genome, the condition, HISAT2's options, and its version. A run with
+a matching key can reuse (or copy) that alignment instead of making it again.
+"""
+
+
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+MANIFEST_DIR = "hisat2_manifests"
+MEMO_FILE = "alignment_memo.json"
+# parameters that don't change the alignment of a reads library, only how it gets made or
+# what else gets made alongside it.
+CHECKPOINT_IGNORED_PARAMS = [
+    "sampleset_ref",
+    "alignmentset_suffix",
+    "num_threads",
+    "stream_reads",
+    "shared_index",
+    "num_shards",
+    "multiplex",
+    "runner",
+    "max_concurrent_tasks",
+    "max_scratch_gb",
+    "qc_mode",
+    "build_report",
+    "index_shock_id",
+    "shard"
+]
+
+
+def get_manifest_path(scratch_dir, params):
+    """
+    Returns the path of the manifest for a batch run of the given parameters. Every run over the
+    same set, saving to the same workspace, shares a manifest.
+    """
+    key = "{}:{}".format(params["ws_name"], params["sampleset_ref"])
+    name = "manifest_{}.json".format(hashlib.sha1(key.encode("utf-8")).hexdigest())
+    return os.path.join(scratch_dir, MANIFEST_DIR, name)
+
+
+def get_memo_path(scratch_dir):
+    """
+    Returns the path of the alignment memo, which is shared by every run using scratch_dir.
+    """
+    return os.path.join(scratch_dir, MANIFEST_DIR, MEMO_FILE)
+
+
+def get_memo_key(reads_upa, genome_upa, condition, hisat2_options, hisat2_version):
+    """
+    Returns a memo key for aligning the reads at reads_upa against the genome (or assembly) at
+    genome_upa, both fully versioned, with a list of HISAT2 options like the ones from
+    Hisat2._build_hisat2_options.
+    """
+    key_json = json.dumps([reads_upa, genome_upa, condition, hisat2_options, hisat2_version])
+    return hashlib.sha1(key_json.encode("utf-8")).hexdigest()
+
+
+def get_checkpoint_key(reads_ref, params):
+    """
+    Returns a key for the alignment of reads_ref with the given parameters (the ones for that
+    library, with its condition set). It only changes if something that affects the
+    alignment changes.
+    """
+    key_params = dict((k, v) for (k, v) in params.items() if k not in CHECKPOINT_IGNORED_PARAMS)
+    key_params["reads_ref"] = reads_ref
+    key_json = json.dumps(key_params, sort_keys=True)
+    return hashlib.sha1(key_json.encode("utf-8")).hexdigest()
+
+
+class BatchManifest(object):
+    """
+    A JSON file of key (a checkpoint or memo key) -> alignment, for each reads library that's
+    been aligned. It's written out again after every change, so it's up to date if the job
+    dies. Several BatchManifests (in one process or several) can share a file: each change is
+    made to what's in the file at the time, under a lock, so none of them lose the others'
+    changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = self._read()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the alignment recorded under key, as a dict like the ones made by
+        Hisat2.upload_fetched_alignment, or None if there isn't one.
+        """
+        with self._lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return None
+        return entry["alignment"]
+
+    def record(self, key, reads_ref, alignment):
+        """
+        Records an alignment of reads_ref under key.
+        """
+        def add(entries):
+            entries[key] = {
+                "reads_ref": reads_ref,
+                "alignment": alignment,
+                "time": time.time()
+            }
+        self._update(add)
+
+    def discard(self, key):
+        """
+        Forgets the alignment recorded under key, e.g. because it's been deleted.
+        """
+        self._update(lambda entries: entries.pop(key, None))
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return dict()
+        try:
+            with open(self.path) as f:
+                return json.load(f).get("alignments", dict())
+        except ValueError:
+            print("WARNING: ignoring unreadable manifest {}".format(self.path))
+            return dict()
+
+    def _update(self, change):
+        """
+        Applies change (a function that changes a dict of entries in place) to the entries in
+        the file, and writes them back, all while holding a lock on the file. Then those are
+        the entries here, too, along with whatever anything else has recorded.
+        """
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        with self._lock, open(self.path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                entries = self._read()
+                change(entries)
+                (fd, tmp_path) = tempfile.mkstemp(dir=directory,
+                                                  prefix=os.path.basename(self.path) + ".",
+                                                  suffix=".tmp")
+                try:
+                    with os.fdopen(fd, "w") as f:
+                        json.dump({"alignments": entries}, f, indent=2)
+                    os.replace(tmp_path, self.path)
+                except Exception:
+                    os.remove(tmp_path)
+                    raise
+                self.entries = entries
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,153 @@
+"""
+Module: multiplex
+
+Aligns many small reads libraries through a single hisat2 process, so they share one process
+start and one load of the index, instead of each paying for their own. Each library's reads
+get tagged with a read name prefix on their way into a combined FASTQ file, and hisat2's SAM
+output gets split back up by that tag (which is taken off again) into a samtools sort per
+library. The main use is as follows:
+
+(groups, rest) = plan_multiplex_groups(libraries)
+for group in groups:
+    with open(combined_file, "wb") as out:
+        for (idx, reads) in enumerate(group_reads):
+            write_tagged_reads(reads["file_fwd"], out, make_tag(idx))
+    ... start hisat2 on combined_file, and a samtools sort per library ...
+    demux = SamDemuxTee(hisat2_proc.stdout, {tag: sort_proc.stdin}, {tag: AlignmentStats()})
+    demux.start()
+    ... wait for hisat2, then demux.join() ...
+
+HISAT2 can only give all of its input one read group (--rg-id), so the tag goes in the read
+names, which HISAT2 passes through untouched to both mates of a pair.
+"""
+
+
+import itertools
+import threading
+
+from kb_hisat2.alignment_stats import CHUNK_SIZE
+
+# libraries with more reads than this are worth a hisat2 process of their own.
+MULTIPLEX_MAX_READS = 2 * 1000 ** 2
+# most reads, and libraries, that go through a single hisat2 process. Each library in a group
+# gets its own samtools sort while hisat2 is running.
+MULTIPLEX_GROUP_READS = 20 * 1000 ** 2
+MULTIPLEX_MAX_LIBRARIES = 16
+# memory for each library's samtools sort, which only holds a small library's records.
+MULTIPLEX_SORT_MEMORY = "256M"
+# goes between a read's tag and its original name. Tags never contain it, so the first one in
+# a read name always ends the tag.
+TAG_SEPARATOR = b"|"
+TAGGED_BLOCK_READS = 100000
+
+
+def plan_multiplex_groups(libraries):
+    """
+    Picks which libraries get aligned together. libraries is a list of dicts, each like
+    {"idx": index of the library, "read_count": number of reads, or None if unknown}.
+    Libraries with up to MULTIPLEX_MAX_READS reads are packed into groups, in order, of up to
+    MULTIPLEX_GROUP_READS reads and MULTIPLEX_MAX_LIBRARIES libraries. A group of one isn't
+    worth it, so a lone library is left out, like the big ones and the ones of unknown size.
+    Returns a tuple of (list of groups, each a list of library indexes, list of the indexes
+    left out).
+    """
+    groups = list()
+    rest = list()
+    group = list()
+    group_reads = 0
+    for library in libraries:
+        read_count = library.get("read_count")
+        if read_count is None or read_count > MULTIPLEX_MAX_READS:
+            rest.append(library["idx"])
+            continue
+        if len(group) == MULTIPLEX_MAX_LIBRARIES or \
+                group_reads + read_count > MULTIPLEX_GROUP_READS:
+            groups.append(group)
+            group = list()
+            group_reads = 0
+        group.append(library["idx"])
+        group_reads += read_count
+    if len(group) > 0:
+        groups.append(group)
+    for group in [g for g in groups if len(g) == 1]:
+        groups.remove(group)
+        rest.extend(group)
+    return (groups, sorted(rest))
+
+
+def make_tag(idx):
+    """
+    Returns the read name tag for the library at idx in a group.
+    """
+    return "L{}".format(idx).encode("utf-8")
+
+
+def write_tagged_reads(fastq_file, out, tag):
+    """
+    Copies the records of a FASTQ file to the open (binary) file out, with tag and
+    TAG_SEPARATOR put in front of each read name. Returns the number of records copied.
+    """
+    prefix = b"@" + tag + TAG_SEPARATOR
+    count = 0
+    with open(fastq_file, "rb") as f:
+        while True:
+            block = list(itertools.islice(f, 4 * TAGGED_BLOCK_READS))
+            if not block:
+                break
+            for i in range(0, len(block), 4):
+                block[i] = prefix + block[i][1:]
+            out.writelines(block)
+            count += len(block) // 4
+    return count
+
+
+class SamDemuxTee(threading.Thread):
+    """
+    Splits SAM data from src (e.g. hisat2's stdout) by the tag at the start of each read name.
+    Each record goes, without its tag, to the sink for that tag (e.g. the stdin of a samtools
+    sort for that library), and gets added to the AlignmentStats for that tag. Header lines go
+    to every sink. All of the sinks and src get closed when it's done.
+    """
+
+    def __init__(self, src, sinks, stats):
+        super(SamDemuxTee, self).__init__(name="sam-demux")
+        self.daemon = True
+        self.src = src
+        self.sinks = sinks
+        self.stats = stats
+        self.error = None
+
+    def run(self):
+        try:
+            partial = b""
+            for chunk in iter(lambda: self.src.read1(CHUNK_SIZE), b""):
+                lines = (partial + chunk).split(b"\n")
+                partial = lines.pop()
+                self._route(lines)
+            if partial:
+                self._route([partial])
+        except Exception as e:
+            self.error = e
+        finally:
+            for f in list(self.sinks.values()) + [self.src]:
+                try:
+                    f.close()
+                except Exception:
+                    pass
+
+    def _route(self, lines):
+        headers = list()
+        records = dict((tag, list()) for tag in self.sinks)
+        for line in lines:
+            if not line:
+                continue
+            if line[:1] == b"@":
+                headers.append(line)
+                continue
+            (tag, line) = line.split(TAG_SEPARATOR, 1)
+            records[tag].append(line)
+        for tag in self.sinks:
+            tag_lines = headers + records[tag]
+            if tag_lines:
+                self.sinks[tag].write(b"\n".join(tag_lines) + b"\n")
+                self.stats[tag].add_lines(tag_lines)
@@ -0,0 +1,137 @@
+"""
+Module: pipeline
+
+Runs a list of items through a chain of stages (e.g. download -> align -> upload), with each
+stage working on a different item at the same time. The main use is as follows:
+
+pipeline = Pipeline([
+    ("download", fetch_func, 2),
+    ("align", align_func, 4),
+    ("upload", upload_func, 2)
+], max_retries=2, cleanup=cleanup_func, tracer=tracer, parent=tracer.current())
+(results, errors) = pipeline.run(items)
+
+Each stage has its own pool of worker threads, and a bounded queue in front of it. A stage that
+gets ahead of the next one waits for room in that queue, instead of piling up finished work
+(and the scratch files that go with it). The worker threads have no open spans of their own,
+so with a tracer, each stage's work on an item gets a span of its own under the caller's.
+"""
+
+
+import queue
+import threading
+import traceback
+
+_STOP = object()
+
+
+class Pipeline(object):
+    """
+    A chain of stages that items flow through. Each stage is a tuple of (name, function,
+    number of worker threads). The first stage's function gets called with an item, and each
+    later stage's function gets called with whatever the stage before it returned.
+
+    If a stage fails on an item, cleanup (if given) is called with that item, and the item is
+    started over from the first stage, up to max_retries times.
+
+    If tracer (a kb_hisat2.tracing.Tracer) is given, each stage's work on an item is traced in
+    a span named after the stage, under parent, so the spans opened by the stage functions
+    nest under the run that started the pipeline.
+    """
+
+    def __init__(self, stages, max_retries=0, queue_size=1, cleanup=None, tracer=None,
+                 parent=None):
+        if len(stages) == 0:
+            raise ValueError("A pipeline needs at least one stage.")
+        self.stages = stages
+        self.max_retries = max_retries
+        self.queue_size = queue_size
+        self.cleanup = cleanup
+        self.tracer = tracer
+        self.parent = parent
+
+    def run(self, items):
+        """
+        Runs all items through the pipeline, and waits for them to finish.
+        Returns a tuple of (results, errors). results is a list of what the last stage returned
+        for each item, in the same order as items (None for items that failed). errors maps
+        the index of each item that failed (after all retries) to the last exception it raised.
+        """
+        # the first queue is unbounded so failed items can always be put back at the start
+        # without waiting on the rest of the pipeline.
+        self._queues = [queue.Queue()]
+        for _ in self.stages[1:]:
+            self._queues.append(queue.Queue(maxsize=self.queue_size))
+        self._results = [None] * len(items)
+        self._errors = dict()
+        self._remaining = len(items)
+        self._done = threading.Condition()
+
+        workers = list()
+        for stage_idx, (name, _, num_workers) in enumerate(self.stages):
+            for worker_idx in range(max(1, num_workers)):
+                worker = threading.Thread(target=self._work, args=(stage_idx,),
+                                          name="{}-{}".format(name, worker_idx))
+                worker.daemon = True
+                worker.start()
+                workers.append((stage_idx, worker))
+
+        for idx, item in enumerate(items):
+            self._queues[0].put((idx, 0, item, item))
+
+        with self._done:
+            while self._remaining > 0:
+                self._done.wait()
+
+        for (stage_idx, _) in workers:
+            self._queues[stage_idx].put(_STOP)
+        for (_, worker) in workers:
+            worker.join()
+        return (self._results, self._errors)
+
+    def _work(self, stage_idx):
+        (name, func, _) = self.stages[stage_idx]
+        is_last = stage_idx == len(self.stages) - 1
+        while True:
+            job = self._queues[stage_idx].get()
+            if job is _STOP:
+                return
+            (idx, attempt, item, value) = job
+            try:
+                value = self._call(name, func, idx, attempt, value)
+            except Exception as e:
+                self._fail(name, idx, attempt, item, e)
+                continue
+            if is_last:
+                self._finish(idx, value)
+            else:
+                self._queues[stage_idx + 1].put((idx, attempt, item, value))
+
+    def _call(self, name, func, idx, attempt, value):
+        if self.tracer is None:
+            return func(value)
+        with self.tracer.span(name, parent=self.parent, item=idx, attempt=attempt):
+            return func(value)
+
+    def _fail(self, name, idx, attempt, item, error):
+        print("Pipeline stage {} failed on item {} (attempt {} of {}):".format(
+            name, idx, attempt + 1, self.max_retries + 1))
+        traceback.print_exc()
+        if self.cleanup is not None:
+            try:
+                self.cleanup(item)
+            except Exception:
+                traceback.print_exc()
+        if attempt < self.max_retries:
+            self._queues[0].put((idx, attempt + 1, item, item))
+        else:
+            with self._done:
+                self._errors[idx] = error
+                self._remaining -= 1
+                self._done.notify_all()
+
+    def _finish(self, idx, value):
+        with self._done:
+            self._results[idx] = value
+            self._remaining -= 1
+            self._done.notify_all()
@@ -0,0 +1,234 @@
+"""
+Module: process
+
+Runs external programs (hisat2, hisat2-build, samtools) and keeps track of the resources
+they use. When a process finishes, it's reaped with os.wait4, which gives its CPU time,
+peak RSS, and block I/O (including the children it waited on, like hisat2-align under the
+hisat2 wrapper). While it runs, a thread samples /proc for the live RSS, thread count, and
+CPU use of the whole process tree. The main use is as follows:
+
+proc = MonitoredProcess(["hisat2-build", ...], span=tracer.current())
+if proc.wait() != 0:
+    raise RuntimeError(...)
+print(proc.stats["parallelism"])
+
+If a tracing span is given, the stats are added to its "processes" list, so they end up in
+the run profile and report.
+"""
+
+
+import os
+import signal
+import subprocess
+import threading
+import time
+
+SAMPLE_INTERVAL = 1.0  # seconds between /proc samples
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+BLOCK_SIZE = 512  # the unit of ru_inblock and ru_oublock
+# a failed process that used at least this fraction of its memory limit probably ran out.
+OOM_MEMORY_FRACTION = 0.9
+
+
+class MonitoredProcess(object):
+    """
+    A subprocess.Popen that records what resources the process used. Takes the same
+    arguments as Popen, plus an optional name (the program name if not given), an optional
+    tracing span to record the stats in, and the /proc sampling interval.
+    Once wait() returns, stats is a dict like this:
+    {
+        "name": "hisat2",
+        "cmd": the command line,
+        "returncode": exit code (negative for the signal that killed it),
+        "wall": seconds from start to finish,
+        "user_cpu": seconds of user CPU time,
+        "sys_cpu": seconds of system CPU time,
+        "parallelism": CPU time / wall time, i.e. the average number of busy CPUs,
+        "max_rss": peak resident memory in bytes, from wait4,
+        "sampled_max_rss": peak resident memory of the whole process tree, from /proc,
+        "max_threads": most threads seen at once in the process tree,
+        "mean_threads": average threads seen in the process tree,
+        "thread_utilization": parallelism / mean_threads, i.e. the fraction of the time
+                              an average thread was actually running, rather than waiting
+                              (e.g. on I/O),
+        "peak_parallelism": the most CPUs seen busy at once between two /proc samples,
+        "block_read_bytes": bytes read from block devices,
+        "block_write_bytes": bytes written to block devices
+    }
+    """
+
+    def __init__(self, cmd, name=None, span=None, interval=SAMPLE_INTERVAL, **popen_kwargs):
+        self.cmd = cmd
+        self.name = name or os.path.basename(cmd[0])
+        self.span = span
+        self.interval = interval
+        self.stats = None
+        self._samples = list()
+        self._done = threading.Event()
+        self.start = time.time()
+        self.popen = subprocess.Popen(cmd, **popen_kwargs)
+        self.pid = self.popen.pid
+        self.stdin = self.popen.stdin
+        self.stdout = self.popen.stdout
+        self._sampler = threading.Thread(target=self._sample, name="sample-" + self.name)
+        self._sampler.daemon = True
+        self._sampler.start()
+
+    @property
+    def returncode(self):
+        return self.popen.returncode
+
+    def wait(self):
+        """
+        Waits for the process to finish, and gathers its stats. Returns its exit code.
+        """
+        if self.stats is not None:
+            return self.popen.returncode
+        (_, status, usage) = _wait4(self.pid)
+        end = time.time()
+        self._done.set()
+        self._sampler.join()
+        returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        # we reaped the process ourselves, so Popen needs to be told how it went.
+        self.popen.returncode = returncode
+        self.stats = self._make_stats(returncode, end - self.start, usage)
+        if self.span is not None:
+            self.span.attrs.setdefault("processes", list()).append(self.stats)
+        print("{} finished with code {} in {:.1f} s: {:.1f} CPUs busy on average, "
+              "peak RSS {} MB".format(self.name, returncode, self.stats["wall"],
+                                      self.stats["parallelism"],
+                                      self.stats["max_rss"] // 1024 ** 2))
+        return returncode
+
+    def _make_stats(self, returncode, wall, usage):
+        cpu = usage.ru_utime + usage.ru_stime
+        parallelism = cpu / wall if wall > 0 else 0.0
+        thread_counts = [s["threads"] for s in self._samples]
+        mean_threads = float(sum(thread_counts)) / len(thread_counts) if thread_counts else 0.0
+        return {
+            "name": self.name,
+            "cmd": " ".join(str(c) for c in self.cmd),
+            "returncode": returncode,
+            "wall": wall,
+            "user_cpu": usage.ru_utime,
+            "sys_cpu": usage.ru_stime,
+            "parallelism": parallelism,
+            # ru_maxrss is in kilobytes on Linux
+            "max_rss": usage.ru_maxrss * 1024,
+            "sampled_max_rss": max([s["rss"] for s in self._samples] or [0]),
+            "max_threads": max(thread_counts or [0]),
+            "mean_threads": mean_threads,
+            "thread_utilization": parallelism / mean_threads if mean_threads > 0 else None,
+            "peak_parallelism": self._peak_parallelism(),
+            "block_read_bytes": usage.ru_inblock * BLOCK_SIZE,
+            "block_write_bytes": usage.ru_oublock * BLOCK_SIZE
+        }
+
+    def _peak_parallelism(self):
+        peak = 0.0
+        for (prev, cur) in zip(self._samples, self._samples[1:]):
+            elapsed = cur["time"] - prev["time"]
+            # ticks go down when a process in the tree exits, so skip those intervals.
+            if elapsed > 0 and cur["cpu_ticks"] >= prev["cpu_ticks"]:
+                busy = (cur["cpu_ticks"] - prev["cpu_ticks"]) / float(CLOCK_TICKS) / elapsed
+                peak = max(peak, busy)
+        return peak
+
+    def _sample(self):
+        while not self._done.wait(self.interval):
+            sample = _sample_tree(self.pid)
+            if sample is not None:
+                self._samples.append(sample)
+
+
+def run_process(cmd, name=None, span=None, **popen_kwargs):
+    """
+    Runs cmd to completion as a MonitoredProcess. Returns the finished process, so the
+    caller can check its returncode and stats.
+    """
+    proc = MonitoredProcess(cmd, name=name, span=span, **popen_kwargs)
+    proc.wait()
+    return proc
+
+
+def is_out_of_memory(proc, memory_limit):
+    """
+    Guesses whether a finished MonitoredProcess failed by running out of memory: either the
+    OOM killer killed it, or it failed after using nearly all of memory_limit bytes (e.g. when
+    a C++ program dies of std::bad_alloc).
+    """
+    if proc.returncode == 0:
+        return False
+    if proc.returncode == -signal.SIGKILL:
+        return True
+    peak = max(proc.stats["max_rss"], proc.stats["sampled_max_rss"])
+    return peak >= memory_limit * OOM_MEMORY_FRACTION
+
+
+def _wait4(pid):
+    while True:
+        try:
+            return os.wait4(pid, 0)
+        except InterruptedError:
+            continue
+
+
+def _sample_tree(root_pid):
+    """
+    Returns the total RSS (bytes), thread count, and CPU ticks of root_pid and all of its
+    descendants, or None if root_pid is gone.
+    """
+    procs = dict()
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(pid)) as f:
+                # the command name can have spaces in it, so split after its closing paren.
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (IOError, IndexError):
+            continue
+        # fields (counting from the state, field 3 in proc(5)): ppid, utime, stime,
+        # num_threads, and rss in pages.
+        procs[int(pid)] = (int(fields[1]), int(fields[11]) + int(fields[12]), int(fields[17]),
+                           int(fields[21]) * PAGE_SIZE)
+    if root_pid not in procs:
+        return None
+    sample = {"time": time.time(), "rss": 0, "threads": 0, "cpu_ticks": 0}
+    for pid, (_, ticks, threads, rss) in procs.items():
+        p = pid
+        while p in procs and p != root_pid and p > 1:
+            p = procs[p][0]
+        if p == root_pid:
+            sample["rss"] += rss
+            sample["threads"] += threads
+            sample["cpu_ticks"] += ticks
+    return sample
+
+
+def summarize_processes(process_stats):
+    """
+    Returns a plain text table of the given process stats, totalled by program name.
+    """
+    programs = dict()
+    order = list()
+    for stats in process_stats:
+        if stats["name"] not in programs:
+            order.append(stats["name"])
+            programs[stats["name"]] = {"runs": 0, "wall": 0.0, "cpu": 0.0, "max_rss": 0,
+                                       "max_threads": 0}
+        p = programs[stats["name"]]
+        p["runs"] += 1
+        p["wall"] += stats["wall"]
+        p["cpu"] += stats["user_cpu"] + stats["sys_cpu"]
+        p["max_rss"] = max(p["max_rss"], stats["max_rss"], stats["sampled_max_rss"])
+        p["max_threads"] = max(p["max_threads"], stats["max_threads"])
+    lines = ["{:<16} {:>5} {:>10} {:>10} {:>8} {:>8} {:>12}".format(
+        "Program", "Runs", "Wall (s)", "CPU (s)", "CPUs", "Threads", "Peak RSS")]
+    for name in order:
+        p = programs[name]
+        lines.append("{:<16} {:>5} {:>10.1f} {:>10.1f} {:>8.1f} {:>8} {:>9} MB".format(
+            name, p["runs"], p["wall"], p["cpu"], p["cpu"] / p["wall"] if p["wall"] else 0.0,
+            p["max_threads"], p["max_rss"] // 1024 ** 2))
+    return "\n".join(lines)
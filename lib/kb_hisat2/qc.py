@@ -0,0 +1,121 @@
+"""
+Module: qc
+
+Runs QualiMap's BAM QC on each alignment as soon as it's uploaded, in the background, so the
+QC of one sample overlaps with the alignment of the rest, instead of QualiMap running over
+the whole set once everything is done. Each sample's QualiMap pages get gathered into one
+report directory as they finish, leaving out the raw data files QualiMap writes next to them,
+so the merged report stays small enough to package quickly. The main use is as follows:
+
+qc = SampleQC(callback_url, report_dir, tracer)
+for alignment in uploaded_alignments:  # as each one is uploaded
+    qc.submit(alignment)
+...
+pages = qc.wait()  # {alignment name: its QualiMap page, relative to report_dir}
+"""
+
+
+import os
+import re
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from installed_clients.kb_QualiMapClient import kb_QualiMap
+
+# number of QualiMap runs going at once
+NUM_QC_WORKERS = 4
+# subdirectory of the report directory that each sample's QualiMap pages go in
+QC_DIR = "qualimap"
+# QualiMap's raw data directories (raw_data_qualimapReport) hold the tables behind its plots,
+# which are much bigger than the pages themselves, and aren't needed to view them.
+RAW_DATA_PREFIX = "raw_data"
+
+
+class SampleQC(object):
+    """
+    Runs QualiMap on alignments in a pool of background threads. Each alignment is a dict
+    with at least "ref" and "name" keys, like those made by Hisat2.upload_fetched_alignment.
+    """
+
+    def __init__(self, callback_url, report_dir, tracer, num_workers=NUM_QC_WORKERS):
+        self.callback_url = callback_url
+        self.report_dir = report_dir
+        self.tracer = tracer
+        self._executor = ThreadPoolExecutor(max_workers=num_workers)
+        self._futures = OrderedDict()
+        self._dir_names = set()
+        self._lock = threading.Lock()
+
+    def submit(self, alignment):
+        """
+        Starts the QC of an alignment, and returns right away. Alignments that were already
+        submitted are skipped.
+        """
+        # the QC thread has no open spans of its own, so its span goes under the caller's.
+        parent = self.tracer.current()
+        with self._lock:
+            if alignment["name"] in self._futures:
+                return
+            dir_name = self._make_dir_name(alignment["name"])
+            self._futures[alignment["name"]] = self._executor.submit(
+                self._run, alignment, dir_name, parent)
+
+    def wait(self):
+        """
+        Waits for every submitted QC run to finish. Returns a dict of each alignment name to
+        the path of its QualiMap page, relative to the report directory. Raises the error of
+        the first run that failed, if any did.
+        """
+        with self._lock:
+            futures = list(self._futures.items())
+        try:
+            return dict((name, future.result()) for (name, future) in futures)
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def _run(self, alignment, dir_name, parent):
+        with self.tracer.span("qualimap", parent=parent) as span:
+            span.add_ref(alignment["ref"])
+            qm = kb_QualiMap(self.callback_url, service_ver='dev')
+            result = qm.run_bamqc({
+                "create_report": 0,
+                "input_ref": alignment["ref"]
+            })
+        index_file = None
+        for f in os.listdir(result["qc_result_folder_path"]):
+            if f.endswith(".html"):
+                index_file = f
+        if index_file is None:
+            raise RuntimeError("QualiMap failed on {} - no HTML file was found in the generated "
+                               "output.".format(alignment["ref"]))
+        copy_qc_pages(result["qc_result_folder_path"],
+                      os.path.join(self.report_dir, QC_DIR, dir_name))
+        return "/".join([QC_DIR, dir_name, index_file])
+
+    def _make_dir_name(self, name):
+        base = re.sub(r"[^\w.-]", "_", name)
+        dir_name = base
+        idx = 1
+        while dir_name in self._dir_names:
+            idx += 1
+            dir_name = "{}_{}".format(base, idx)
+        self._dir_names.add(dir_name)
+        return dir_name
+
+
+def copy_qc_pages(src_dir, dest_dir):
+    """
+    Copies QualiMap's output from src_dir to dest_dir, without its raw data directories.
+    Files are hard linked instead of copied where possible.
+    """
+    for (root, dirs, files) in os.walk(src_dir):
+        dirs[:] = [d for d in dirs if not d.startswith(RAW_DATA_PREFIX)]
+        out_dir = os.path.join(dest_dir, os.path.relpath(root, src_dir))
+        os.makedirs(out_dir, exist_ok=True)
+        for f in files:
+            try:
+                os.link(os.path.join(root, f), os.path.join(out_dir, f))
+            except OSError:
+                shutil.copy2(os.path.join(root, f), os.path.join(out_dir, f))
@@ -0,0 +1,270 @@
+"""
+Module: resources
+
+Figures out how much CPU and memory this job can actually use, and how to split that up
+between the programs we run. Inside a container, os.cpu_count() and the amount of physical
+memory describe the whole node, not what the job is allowed, so this reads the cgroup CPU
+quota, cpuset, and memory limit instead. The main use is as follows:
+
+plan = plan_resources(max_threads=params.get("num_threads"))
+cmd.extend(["-p", str(plan["align_threads"])])
+
+It also plans how to build a HISAT2 index within the memory limit, since hisat2-build left
+to its own defaults can need several times the memory of the finished index.
+"""
+
+
+import math
+import os
+import shutil
+
+# cgroup v2 files, then their cgroup v1 equivalents
+CGROUP_V2_CPU_MAX = "/sys/fs/cgroup/cpu.max"
+CGROUP_V1_CPU_QUOTA = "/sys/fs/cgroup/cpu/cpu.cfs_quota_us"
+CGROUP_V1_CPU_PERIOD = "/sys/fs/cgroup/cpu/cpu.cfs_period_us"
+CGROUP_V2_MEMORY_MAX = "/sys/fs/cgroup/memory.max"
+CGROUP_V1_MEMORY_LIMIT = "/sys/fs/cgroup/memory/memory.limit_in_bytes"
+
+# fraction of the memory limit samtools sort is allowed to hold in memory, before it spills
+# records to temp files.
+SORT_MEMORY_FRACTION = 0.25
+MIN_SORT_MEMORY_PER_THREAD = 256 * 1024 ** 2
+MAX_SORT_MEMORY_PER_THREAD = 2 * 1024 ** 3
+# fraction of the free scratch space a job uses, unless it's told otherwise.
+SCRATCH_BUDGET_FRACTION = 0.8
+# fewest threads worth giving a single alignment, when running several side by side.
+MIN_THREADS_PER_WORKER = 4
+# reads libraries with up to this many bases get aligned on this node when alignments are
+# placed, since starting a remote worker, and fetching the index there, takes about as long as
+# aligning them.
+LOCAL_MAX_BASES = 2 * 1000 ** 3
+
+# hisat2-build has to make a large index (with 64 bit offsets, in .ht2l files) for genomes
+# with more bases than this.
+LARGE_INDEX_THRESHOLD = 4 * 1000 ** 3
+# fraction of the memory limit a hisat2-build run is planned to use.
+BUILD_MEMORY_FRACTION = 0.8
+# a rough model of hisat2-build's memory use. It keeps the packed reference, the BWT, and its
+# samples for the whole build (about BUILD_BYTES_PER_BASE), and some bookkeeping per contig.
+# On top of that, each thread holds the suffix offsets of the block it's sorting, which is up
+# to 1/bmaxdivn of the genome, and there's the difference cover sample, which shrinks as dcv
+# grows.
+BUILD_BYTES_PER_BASE = 1.5
+BUILD_BYTES_PER_CONTIG = 1024
+BUILD_MEMORY_OVERHEAD = 256 * 1024 ** 2
+# hisat2-build's defaults, which it also tunes automatically when a block doesn't fit.
+DEFAULT_BMAXDIVN = 4
+DEFAULT_DCV = 1024
+# build settings, from fastest to most memory-frugal. Each one sorts smaller blocks and a
+# sparser difference cover sample than the one before. Neither changes the finished index.
+BUILD_SETTINGS = [
+    {"bmaxdivn": None, "dcv": None},
+    {"bmaxdivn": 8, "dcv": 1024},
+    {"bmaxdivn": 16, "dcv": 2048},
+    {"bmaxdivn": 32, "dcv": 4096}
+]
+
+
+def get_cpu_limit():
+    """
+    Returns the number of CPUs this process can use. That's the number of CPUs in its cpuset,
+    or its cgroup CPU quota (rounded down), whichever is smaller. Always at least 1.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = _read_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, int(math.floor(quota)))
+    return max(1, cpus)
+
+
+def get_memory_limit():
+    """
+    Returns the number of bytes of memory this process can use. That's its cgroup memory limit,
+    or the physical memory of the node, whichever is smaller.
+    """
+    memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    limit = _read_memory_limit()
+    if limit is not None:
+        memory = min(memory, limit)
+    return memory
+
+
+def plan_resources(max_threads=None):
+    """
+    Decides how many threads (and how much sort memory) to give each program we run.
+    max_threads is an optional upper bound on the number of threads, e.g. the num_threads
+    parameter set by the user, or the share of a node given to one of several concurrent
+    alignments.
+    Returns a dict like this:
+    {
+        "cpus": number of CPUs available,
+        "memory": bytes of memory available,
+        "build_threads": threads for hisat2-build,
+        "align_threads": threads for hisat2,
+        "sort_threads": threads for samtools sort (and BAM compression),
+        "sort_memory_per_thread": memory per samtools sort thread, as a string like "768M"
+    }
+    """
+    cpus = get_cpu_limit()
+    if max_threads is not None and int(max_threads) > 0:
+        cpus = min(cpus, int(max_threads))
+    memory = get_memory_limit()
+    # samtools sort mostly just buffers records while hisat2 is running, and only really
+    # uses its threads for the final merge and compression, after hisat2 is done. So hisat2
+    # gets all of the CPUs, and sort gets a share to use afterward.
+    sort_threads = max(1, cpus // 4)
+    sort_memory = int(memory * SORT_MEMORY_FRACTION / sort_threads)
+    sort_memory = max(MIN_SORT_MEMORY_PER_THREAD, min(MAX_SORT_MEMORY_PER_THREAD, sort_memory))
+    return {
+        "cpus": cpus,
+        "memory": memory,
+        "build_threads": cpus,
+        "align_threads": cpus,
+        "sort_threads": sort_threads,
+        "sort_memory_per_thread": "{}M".format(sort_memory // 1024 ** 2)
+    }
+
+
+def plan_workers(num_tasks, memory_per_task, resources, shared_memory=0):
+    """
+    Decides how many tasks (e.g. alignments) to run at the same time on this node, given how
+    many there are, how much memory each one needs, and a plan from plan_resources. Each
+    worker should get at least MIN_THREADS_PER_WORKER CPUs, and all of them have to fit in
+    memory, along with shared_memory bytes used once by all of them (e.g. a memory-mapped
+    index). Always at least 1.
+    """
+    by_cpu = resources["cpus"] // MIN_THREADS_PER_WORKER
+    by_memory = max(0, resources["memory"] - shared_memory) // max(1, memory_per_task)
+    return max(1, min(num_tasks, by_cpu, by_memory))
+
+
+def plan_placement(sample_bases, memory_per_task, resources, max_local_bases=LOCAL_MAX_BASES):
+    """
+    Decides where to run each of a batch of alignments: "local", on this node, or "remote", on
+    a worker of its own. sample_bases has the total bases of each sample, or None if that isn't
+    known. Samples with up to max_local_bases bases stay local, as long as an alignment
+    (needing memory_per_task bytes) fits in this node's memory from plan_resources at all. The
+    rest, including the ones of unknown size, go remote. Returns a list with "local" or
+    "remote" for each sample.
+    """
+    if memory_per_task > resources["memory"]:
+        return ["remote"] * len(sample_bases)
+    return ["local" if bases is not None and bases <= max_local_bases else "remote"
+            for bases in sample_bases]
+
+
+def estimate_build_memory(num_bases, num_contigs, num_threads, bmaxdivn=None, dcv=None,
+                          large_index=False):
+    """
+    Estimates how many bytes of memory hisat2-build needs to index a genome with the given
+    number of bases and contigs, with the given settings (None means hisat2-build's default).
+    """
+    offset_bytes = 8 if large_index else 4
+    bmaxdivn = bmaxdivn or DEFAULT_BMAXDIVN
+    dcv = dcv or DEFAULT_DCV
+    blocks = num_threads * float(num_bases) / bmaxdivn * offset_bytes
+    # a difference cover of dcv has about sqrt(1.5 * dcv) members, so that fraction of the
+    # suffixes gets sampled.
+    dcv_sample = float(num_bases) * offset_bytes * math.sqrt(1.5 * dcv) / dcv
+    return int(BUILD_BYTES_PER_BASE * num_bases + blocks + dcv_sample +
+               BUILD_BYTES_PER_CONTIG * num_contigs + BUILD_MEMORY_OVERHEAD)
+
+
+def plan_index_build(num_bases, num_contigs, resources):
+    """
+    Plans how to run hisat2-build on a genome with the given number of bases and contigs,
+    with the CPUs and memory in a plan from plan_resources. Fewer threads and more
+    memory-frugal settings make for a slower build, so the fastest one that's estimated to
+    fit in the memory limit comes first. The rest of the list are ever smaller ones to retry
+    with if that still runs out of memory. If none are estimated to fit, the list is just
+    the smallest one.
+    Each plan is a dict like this:
+    {
+        "num_threads": threads for hisat2-build,
+        "large_index": True to make a large index,
+        "bmaxdivn": split the suffixes into at least this many blocks, or None for the default,
+        "dcv": period of the difference cover sample, or None for the default,
+        "estimated_memory": bytes of memory it's expected to need
+    }
+    """
+    budget = resources["memory"] * BUILD_MEMORY_FRACTION
+    large_index = num_bases > LARGE_INDEX_THRESHOLD
+    # losing threads slows the build down far more than smaller blocks do, so every setting
+    # gets tried with all the threads before any get taken away.
+    candidates = list()
+    num_threads = resources["build_threads"]
+    while True:
+        for settings in BUILD_SETTINGS:
+            plan = dict(settings, num_threads=num_threads, large_index=large_index)
+            plan["estimated_memory"] = estimate_build_memory(num_bases, num_contigs, **plan)
+            candidates.append(plan)
+        if num_threads == 1:
+            break
+        num_threads = max(1, num_threads // 2)
+
+    plans = list()
+    for plan in candidates:
+        if len(plans) == 0:
+            if plan["estimated_memory"] <= budget:
+                plans.append(plan)
+        elif plan["estimated_memory"] < plans[-1]["estimated_memory"]:
+            plans.append(plan)
+    if len(plans) == 0:
+        smallest = min(candidates, key=lambda p: p["estimated_memory"])
+        print("WARNING: building a HISAT2 index of {} bases is estimated to need {} bytes of "
+              "memory, even with the smallest settings, which is more than the {} bytes it "
+              "should use".format(num_bases, smallest["estimated_memory"], int(budget)))
+        plans.append(smallest)
+    return plans
+
+
+def get_scratch_budget(scratch_dir, max_gb=None):
+    """
+    Returns the number of bytes of scratch space a job should use at most. That's max_gb
+    (if given), or SCRATCH_BUDGET_FRACTION of the space currently free, whichever is smaller.
+    """
+    budget = int(shutil.disk_usage(scratch_dir).free * SCRATCH_BUDGET_FRACTION)
+    if max_gb is not None and int(max_gb) > 0:
+        budget = min(budget, int(max_gb) * 1024 ** 3)
+    return budget
+
+
+def _read_cpu_quota():
+    """
+    Returns the cgroup CPU quota as a (possibly fractional) number of CPUs, or None if
+    there's no quota.
+    """
+    if os.path.exists(CGROUP_V2_CPU_MAX):
+        quota, period = _read_file(CGROUP_V2_CPU_MAX).split()
+        if quota == "max":
+            return None
+        return float(quota) / float(period)
+    if os.path.exists(CGROUP_V1_CPU_QUOTA) and os.path.exists(CGROUP_V1_CPU_PERIOD):
+        quota = int(_read_file(CGROUP_V1_CPU_QUOTA))
+        if quota <= 0:
+            return None
+        return float(quota) / float(_read_file(CGROUP_V1_CPU_PERIOD))
+    return None
+
+
+def _read_memory_limit():
+    """
+    Returns the cgroup memory limit in bytes, or None if there's no limit.
+    """
+    for path in [CGROUP_V2_MEMORY_MAX, CGROUP_V1_MEMORY_LIMIT]:
+        if os.path.exists(path):
+            limit = _read_file(path)
+            if limit == "max":
+                return None
+            # cgroup v1 reports "no limit" as a huge number, which the min() with physical
+            # memory takes care of.
+            return int(limit)
+    return None
+
+
+def _read_file(path):
+    with open(path) as f:
+        return f.read().strip()
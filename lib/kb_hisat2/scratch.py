@@ -0,0 +1,189 @@
+"""
+Module: scratch
+
+Keeps track of the intermediate files a job writes to scratch (reads files, alignment files,
+shards, report pages), frees each one as soon as the stage that reads it is done, and holds
+back new work while the scratch space it's projected to need would go over the budget. The
+main use is as follows:
+
+scratch = ScratchManager(max_bytes=get_scratch_budget(scratch_dir))
+scratch.admit(sample_key, projected_bytes)  # waits for room in the budget
+scratch.track(sample_key, reads_file)
+...
+scratch.free(reads_file)  # as soon as it's been aligned
+...
+scratch.release(sample_key)  # frees whatever the sample has left
+print(scratch.peak)
+
+Sizes are measured from the files themselves when they're tracked (and again on update), so
+the peak is what was actually on disk, not an estimate.
+
+Each job also gets its own directory in scratch for those files, from job_directory(), so
+jobs sharing a scratch volume (or a server process) don't write over each other's files.
+"""
+
+
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+# rough size of an uncompressed FASTQ record, apart from its bases and qualities: the header,
+# the "+" line, and four newlines.
+FASTQ_BYTES_PER_READ = 60
+# a sorted BAM file (and its index) is usually well under this fraction of the size of the
+# FASTQ it came from.
+BAM_SIZE_FRACTION = 0.5
+JOB_DIR_PREFIX = "hisat2_job_"
+
+
+@contextmanager
+def job_directory(scratch_dir):
+    """
+    Context manager that makes a new, uniquely named directory in scratch_dir for the files
+    of one job, and removes it with everything in it when the job is done, whether or not the
+    job worked.
+    """
+    job_dir = tempfile.mkdtemp(prefix=JOB_DIR_PREFIX, dir=scratch_dir)
+    try:
+        yield job_dir
+    finally:
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+
+def estimate_reads_scratch(read_count, total_bases):
+    """
+    Estimates the most scratch space aligning a reads library takes, from its read count and
+    total number of bases: its uncompressed FASTQ files, plus the BAM file that gets written
+    before they're removed.
+    """
+    fastq_bytes = 2 * total_bases + FASTQ_BYTES_PER_READ * read_count
+    return int(fastq_bytes * (1 + BAM_SIZE_FRACTION))
+
+
+class ScratchManager(object):
+    """
+    Tracks paths (files or directories) in scratch under an owner key, like a sample, and the
+    total size of all of them. admit() holds back new owners while the space in use, plus what
+    the owners in flight are still projected to need, would go over max_bytes (if given). At
+    least one owner is always let through, so things can't get stuck if a single one needs
+    more than the whole budget.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.peak = 0
+        self._paths = dict()  # path -> (owner, size)
+        self._projected = dict()  # owner -> projected bytes
+        self._cond = threading.Condition()
+
+    def set_budget(self, max_bytes):
+        """
+        Sets the most scratch space the owners in flight may use at once (None for no limit).
+        """
+        with self._cond:
+            self.max_bytes = max_bytes
+            self._cond.notify_all()
+
+    def usage(self):
+        """
+        Returns the number of bytes used by all tracked paths, as of their last update.
+        """
+        with self._cond:
+            return self._usage()
+
+    def admit(self, owner, projected_bytes=0):
+        """
+        Waits until there's room in the budget for owner to use projected_bytes, then starts
+        tracking it.
+        """
+        with self._cond:
+            while self._projected and self.max_bytes is not None and \
+                    self._committed() + projected_bytes > self.max_bytes:
+                self._cond.wait()
+            self._projected[owner] = projected_bytes
+
+    def track(self, owner, path):
+        """
+        Starts tracking path (if it's not None) as belonging to owner, and measures its size.
+        Returns the path.
+        """
+        if path is not None:
+            size = _path_size(path)
+            with self._cond:
+                self._paths[path] = (owner, size)
+                self._update_peak()
+        return path
+
+    def update(self, owner):
+        """
+        Measures all of owner's paths again, e.g. after they've been written to.
+        """
+        with self._cond:
+            paths = [p for (p, (o, _)) in self._paths.items() if o == owner]
+        sizes = dict((p, _path_size(p)) for p in paths)
+        with self._cond:
+            for (p, size) in sizes.items():
+                if p in self._paths:
+                    self._paths[p] = (owner, size)
+            self._update_peak()
+
+    def free(self, path):
+        """
+        Deletes path (a file or directory) if it exists, and stops tracking it. Paths that
+        were never tracked get deleted all the same.
+        """
+        if path is None:
+            return
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.lexists(path):
+            os.remove(path)
+        with self._cond:
+            self._paths.pop(path, None)
+            self._cond.notify_all()
+
+    def release(self, owner):
+        """
+        Frees all of owner's paths that are left, and stops tracking it, making room for
+        the next owner to be admitted.
+        """
+        with self._cond:
+            paths = [p for (p, (o, _)) in self._paths.items() if o == owner]
+        for path in paths:
+            self.free(path)
+        with self._cond:
+            self._projected.pop(owner, None)
+            self._cond.notify_all()
+
+    def _usage(self):
+        return sum(size for (_, size) in self._paths.values())
+
+    def _committed(self):
+        """
+        Bytes in use, plus what each admitted owner is projected to need on top of what it's
+        already using.
+        """
+        used = dict()
+        for (owner, size) in self._paths.values():
+            used[owner] = used.get(owner, 0) + size
+        return self._usage() + sum(max(0, projected - used.get(owner, 0))
+                                   for (owner, projected) in self._projected.items())
+
+    def _update_peak(self):
+        self.peak = max(self.peak, self._usage())
+
+
+def _path_size(path):
+    if os.path.isdir(path):
+        total = 0
+        for (root, _, files) in os.walk(path):
+            for f in files:
+                f_path = os.path.join(root, f)
+                if os.path.isfile(f_path):
+                    total += os.path.getsize(f_path)
+        return total
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return 0
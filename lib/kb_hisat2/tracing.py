@@ -0,0 +1,207 @@
+"""
+Module: tracing
+
+A lightweight way to see where the time in a job goes. Each step of a run is wrapped in a
+span, which records when it started and ended, how many bytes it moved, and the objects it
+worked on. Spans nest: a span started while another one is open (in the same thread) becomes
+its child. The main use is as follows:
+
+tracer = Tracer()
+with tracer.span("fetch_reads", ref=reads_ref) as span:
+    reads = fetch_reads_from_reference(reads_ref, callback_url)
+    span.add_bytes(os.path.getsize(reads["file_fwd"]))
+...
+tracer.write_profile(get_profile_path(scratch_dir, job_id))
+print(tracer.summary())
+"""
+
+
+import itertools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+PROFILE_FILE_PREFIX = "kb_hisat2_profile_"
+
+
+def get_profile_path(scratch_dir, job_id):
+    """
+    Returns the path of the profile of the job with the given id, in scratch_dir. Each job has
+    its own, so jobs sharing scratch don't write over each other's.
+    """
+    return os.path.join(scratch_dir, "{}{}.json".format(PROFILE_FILE_PREFIX, job_id))
+
+
+class Tracer(object):
+    """
+    Collects the spans of a single job.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.spans = list()
+        self._ids = itertools.count(1)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def span(self, name, parent=None, **attrs):
+        """
+        Returns a new span, to be used as a context manager. Its parent is the given span, or
+        the innermost open span in this thread if not given. Any extra keyword arguments are
+        stored with the span (e.g. ref="1/2/3").
+        """
+        return Span(self, next(self._ids), name, parent, attrs)
+
+    def current(self):
+        """
+        Returns the innermost open span in this thread, or None.
+        """
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def summary(self):
+        """
+        Returns a plain text table of the time spent and bytes moved in each kind of span.
+        Nested spans are counted in their parents too, so the times don't add up to the total.
+        """
+        stages = OrderedDict()
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        for span in spans:
+            stage = stages.setdefault(span.name, {"count": 0, "seconds": 0.0, "bytes": 0,
+                                                  "errors": 0})
+            stage["count"] += 1
+            stage["seconds"] += span.duration
+            stage["bytes"] += span.bytes
+            stage["errors"] += 1 if span.error is not None else 0
+        lines = ["{:<24} {:>5} {:>10} {:>10}".format("Stage", "Runs", "Time (s)", "Data")]
+        for name, stage in stages.items():
+            lines.append("{:<24} {:>5} {:>10.1f} {:>10}".format(
+                name + (" (failed)" if stage["errors"] else ""), stage["count"],
+                stage["seconds"], format_bytes(stage["bytes"]) if stage["bytes"] else "-"))
+        lines.append("Total wall time: {:.1f} s".format(time.time() - self.start))
+        return "\n".join(lines)
+
+    @contextmanager
+    def profile(self, path):
+        """
+        Context manager that traces everything inside it as a single "job" span, then writes
+        the profile to path and prints the summary, whether or not the job failed.
+        """
+        try:
+            with self.span("job"):
+                yield self
+        finally:
+            self.write_profile(path)
+            print("Run profile written to {}".format(path))
+            print(self.summary())
+
+    def to_dict(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        return {
+            "start": self.start,
+            "end": time.time(),
+            "spans": [span.to_dict() for span in spans]
+        }
+
+    def write_profile(self, path):
+        """
+        Writes all finished spans to a JSON file at path.
+        """
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        return path
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = list()
+        return self._local.stack
+
+    def _finish(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+
+class Span(object):
+    """
+    A single timed step. Use it as a context manager, and record what it did with
+    add_bytes(), add_ref(), and set().
+    """
+
+    def __init__(self, tracer, span_id, name, parent, attrs):
+        self.tracer = tracer
+        self.id = span_id
+        self.name = name
+        self.parent = parent
+        self.attrs = dict(attrs)
+        self.refs = list()
+        self.bytes = 0
+        self.start = None
+        self.end = None
+        self.error = None
+        self.thread = None
+
+    @property
+    def duration(self):
+        if self.start is None:
+            return 0.0
+        return (self.end or time.time()) - self.start
+
+    def add_bytes(self, num_bytes):
+        self.bytes += int(num_bytes or 0)
+
+    def add_ref(self, ref):
+        if ref is not None and ref not in self.refs:
+            self.refs.append(ref)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        stack = self.tracer._stack()
+        if self.parent is None and len(stack) > 0:
+            self.parent = stack[-1]
+        stack.append(self)
+        self.thread = threading.current_thread().name
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.end = time.time()
+        if exc_value is not None:
+            self.error = "{}: {}".format(exc_type.__name__, exc_value)
+        stack = self.tracer._stack()
+        if self in stack:
+            stack.remove(self)
+        self.tracer._finish(self)
+        print("[trace] {} {} in {:.1f} s{}".format(
+            self.name, "failed" if self.error else "done", self.duration,
+            " ({})".format(format_bytes(self.bytes)) if self.bytes else ""))
+        return False
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "parent_id": self.parent.id if self.parent is not None else None,
+            "name": self.name,
+            "thread": self.thread,
+            "start": self.start,
+            "end": self.end,
+            "duration": self.duration,
+            "bytes": self.bytes,
+            "refs": self.refs,
+            "attrs": self.attrs,
+            "error": self.error
+        }
+
+
+def format_bytes(num_bytes):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(num_bytes) < 1024:
+            return "{:.1f} {}".format(num_bytes, unit)
+        num_bytes /= 1024.0
+    return "{:.1f} TB".format(num_bytes)
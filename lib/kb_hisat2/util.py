@@ -6,17 +6,19 @@ There's also some parameter checking and munging functions.
 
 
 import re
+import threading
 from pprint import pprint
 
 from installed_clients.DataFileUtilClient import DataFileUtil
 from installed_clients.WorkspaceClient import Workspace
 
 
-def check_hisat2_parameters(params, ws_url):
+def check_hisat2_parameters(params, ws_url, info_cache=None):
     """
     Checks to ensure that the hisat2 parameter set is correct and has the right
     mash of options.
     Returns a list of error strings if there's a problem, or just an empty list otherwise.
+    info_cache is an optional ObjectInfoCache to look up object refs with.
     """
     errors = list()
     # parameter keys and rules:
@@ -38,8 +40,17 @@ def check_hisat2_parameters(params, ws_url):
     # int max_intron_length - int, >= 0, required
     # bool no_spliced_alignment - 0 or 1, optional (default 0)
     # string tailor_alignments - string ...?
+    # int num_shards - int, >= 1, optional (default 1)
+    # string runner - one of parallel, local_pool, or hybrid, optional (default parallel)
+    # int max_concurrent_tasks - int, >= 1, optional
+    # string qc_mode - one of native or qualimap, optional (default native)
     print("Checking input parameters")
     pprint(params)
+    if info_cache is None:
+        info_cache = ObjectInfoCache(ws_url)
+    # look up all of the object refs at once, instead of one at a time below.
+    info_cache.prefetch([params[k] for k in ["sampleset_ref", "genome_ref"]
+                         if valid_string(params.get(k), is_ref=True)])
     if "ws_name" not in params or not valid_string(params["ws_name"]):
         errors.append("Parameter ws_name must be a valid workspace "
                       "name, not {}".format(params.get("ws_name", None)))
@@ -49,13 +60,34 @@ def check_hisat2_parameters(params, ws_url):
     if "sampleset_ref" not in params or not valid_string(params["sampleset_ref"], is_ref=True):
         errors.append("Parameter sampleset_ref must be a valid Workspace object reference, "
                       "not {}".format(params.get("sampleset_ref", None)))
-    elif check_ref_type(params["sampleset_ref"], ["PairedEndLibary", "SingleEndLibrary"], ws_url):
+    elif check_ref_type(params["sampleset_ref"], ["PairedEndLibary", "SingleEndLibrary"], ws_url,
+                        info_cache=info_cache):
         if "condition" not in params or not valid_string(params["condition"]):
             errors.append("Parameter condition is required for a single "
                           "PairedEndLibrary or SingleEndLibrary")
     if "genome_ref" not in params or not valid_string(params["genome_ref"], is_ref=True):
         errors.append("Parameter genome_ref must be a valid Workspace object reference, "
                       "not {}".format(params.get("genome_ref", None)))
+    if "num_shards" in params:
+        try:
+            if int(params["num_shards"]) < 1:
+                raise ValueError()
+        except (TypeError, ValueError):
+            errors.append("Parameter num_shards must be an integer >= 1, "
+                          "not {}".format(params["num_shards"]))
+    if params.get("max_concurrent_tasks") is not None:
+        try:
+            if int(params["max_concurrent_tasks"]) < 1:
+                raise ValueError()
+        except (TypeError, ValueError):
+            errors.append("Parameter max_concurrent_tasks must be an integer >= 1, "
+                          "not {}".format(params["max_concurrent_tasks"]))
+    if params.get("runner", "parallel") not in ["parallel", "local_pool", "hybrid"]:
+        errors.append("Parameter runner must be one of parallel, local_pool, or hybrid, "
+                      "not {}".format(params.get("runner")))
+    if params.get("qc_mode", "native") not in ["native", "qualimap"]:
+        errors.append("Parameter qc_mode must be one of native or qualimap, "
+                      "not {}".format(params.get("qc_mode")))
     return errors
 
 
@@ -79,11 +111,11 @@ def check_reference(ref):
     return True
 
 
-def is_set(ref, ws_url):
-    return check_ref_type(ref, ["sampleset", "readsset"], ws_url)
+def is_set(ref, ws_url, info_cache=None):
+    return check_ref_type(ref, ["sampleset", "readsset"], ws_url, info_cache=info_cache)
 
 
-def check_ref_type(ref, allowed_types, ws_url):
+def check_ref_type(ref, allowed_types, ws_url, info_cache=None):
     """
     Validates the object type of ref against the list of allowed types. If it passes, this
     returns True, otherwise False.
@@ -98,43 +130,140 @@ def check_ref_type(ref, allowed_types, ws_url):
     allowed_types = ["assembly", "genome"]
     returns True
     """
-    obj_type = get_object_type(ref, ws_url).lower()
+    obj_type = get_object_type(ref, ws_url, info_cache=info_cache).lower()
     for t in allowed_types:
         if t.lower() in obj_type:
             return True
     return False
 
 
-def get_object_type(ref, ws_url):
+class ObjectInfoCache(object):
+    """
+    Looks up Workspace object info (with metadata), and remembers it for the life of a job, so
+    each ref only gets fetched once. prefetch() looks up any number of refs with a single
+    get_object_info3 call, so refs that are known up front should be passed to that first.
+    """
+
+    def __init__(self, ws_url):
+        self.ws_url = ws_url
+        self._infos = dict()
+        self._lock = threading.Lock()
+
+    def prefetch(self, refs):
+        """
+        Fetches the info for all of the given refs that aren't already known, in one call.
+        Refs that can't be found are remembered as missing.
+        """
+        with self._lock:
+            new_refs = list()
+            for ref in refs:
+                if ref not in self._infos and ref not in new_refs:
+                    new_refs.append(ref)
+        if len(new_refs) == 0:
+            return
+        # the lock isn't held during the call, so lookups of refs that are already known
+        # don't wait on it. Two threads might both fetch the same new ref, which is harmless.
+        ws = Workspace(self.ws_url)
+        info = ws.get_object_info3({
+            "objects": [{"ref": ref} for ref in new_refs],
+            "includeMetadata": 1,
+            "ignoreErrors": 1
+        })
+        with self._lock:
+            # infos come back in the same order as the refs that were passed.
+            for (ref, obj_info) in zip(new_refs, info.get("infos", [])):
+                self._infos.setdefault(ref, obj_info)
+
+    def add(self, ref, obj_info):
+        """
+        Remembers object info for ref that was looked up some other way.
+        """
+        with self._lock:
+            self._infos[ref] = obj_info
+
+    def get_info(self, ref):
+        """
+        Returns the object info tuple of ref. If that object doesn't exist, or there's another
+        Workspace error, this raises a RuntimeError exception.
+        """
+        self.prefetch([ref])
+        obj_info = self._infos.get(ref)
+        if not obj_info:
+            raise RuntimeError("An error occurred while fetching type info from the Workspace. "
+                               "No information returned for reference {}".format(ref))
+        return obj_info
+
+
+def get_object_info(ref, ws_url, info_cache=None):
+    """
+    Fetches and returns the Workspace object info tuple of ref from the given workspace url,
+    or from info_cache, if given.
+    If that object doesn't exist, or there's another Workspace error, this raises a
+    RuntimeError exception.
+    """
+    if info_cache is None:
+        info_cache = ObjectInfoCache(ws_url)
+    return info_cache.get_info(ref)
+
+
+def get_object_type(ref, ws_url, info_cache=None):
     """
     Fetches and returns the typed object name of ref from the given workspace url.
     If that object doesn't exist, or there's another Workspace error, this raises a
     RuntimeError exception.
     """
+    return get_object_info(ref, ws_url, info_cache=info_cache)[2]
+
+
+def get_object_upa(ref, ws_url, info_cache=None):
+    """
+    Resolves ref (which might be a name, lack a version, or be a ref path) to the permanent
+    wsid/objid/version address of the object it points to.
+    """
+    obj_info = get_object_info(ref, ws_url, info_cache=info_cache)
+    return "{}/{}/{}".format(obj_info[6], obj_info[0], obj_info[4])
+
+
+def copy_object(ref, ws_name, name, ws_url, info_cache=None):
+    """
+    Copies the object at ref to a new object with the given name in workspace ws_name. Returns
+    the wsid/objid/version address of the copy.
+    """
     ws = Workspace(ws_url)
-    info = ws.get_object_info3({"objects": [{"ref": ref}]})
-    obj_info = info.get("infos", [[]])[0]
-    if len(obj_info) == 0:
-        raise RuntimeError("An error occurred while fetching type info from the Workspace. "
-                           "No information returned for reference {}".format(ref))
-    return obj_info[2]
+    obj_info = ws.copy_object({
+        "from": {"ref": ref},
+        "to": {"workspace": ws_name, "name": name}
+    })
+    upa = "{}/{}/{}".format(obj_info[6], obj_info[0], obj_info[4])
+    if info_cache is not None:
+        info_cache.add(upa, obj_info)
+    return upa
 
 
-def get_object_names(ref_list, ws_url):
+def get_reads_counts(obj_info):
+    """
+    Returns a tuple of (read count, total bases) of a reads library, from the metadata in its
+    object info tuple, or None if the metadata doesn't have them.
+    """
+    meta = obj_info[10] or dict()
+    try:
+        return (int(meta["read_count"]), int(meta["total_bases"]))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def get_object_names(ref_list, ws_url, info_cache=None):
     """
     From a list of workspace references, returns a mapping from ref -> name of the object.
     """
-    ws = Workspace(ws_url)
-    obj_ids = list()
-    for ref in ref_list:
-        obj_ids.append({"ref": ref})
-    info = ws.get_object_info3({"objects": obj_ids})
-    name_map = dict()
+    if info_cache is None:
+        info_cache = ObjectInfoCache(ws_url)
     # might be in a data palette, so we can't just use the ref.
-    # we already have the refs as passed previously, so use those for mapping, as they're in
-    # the same order as what's returned.
-    for i in range(len(info["infos"])):
-        name_map[ref_list[i]] = info["infos"][i][1]
+    # we already have the refs as passed previously, so use those for mapping.
+    info_cache.prefetch(ref_list)
+    name_map = dict()
+    for ref in ref_list:
+        name_map[ref] = info_cache.get_info(ref)[1]
     return name_map
 
 
@@ -0,0 +1,443 @@
+"""
+Local stand-ins for the KBase services kb_hisat2 talks to, so the whole pipeline can run on
+one box without a callback server, Workspace, or Shock. Everything is served from a single
+JSON-RPC endpoint (which doubles as the callback URL, Workspace URL, Service Wizard URL, and
+Shock URL), backed by an in-memory object store and a directory of "Shock" files.
+
+fake = FakeKBase(scratch_dir, shock_dir)
+fake.start()
+genome_ref = fake.save_genome("my_genome", fasta_path)
+reads_ref = fake.save_reads("my_reads", fwd_path)
+... point kb_hisat2 at fake.url ...
+(the reads and genome have to be saved after start(), since they point at fake.url)
+fake.stop()
+
+Callback (SDK job) methods run synchronously when they're submitted, so _check_job always
+finds them finished. File transfers are real copies, so they show up in the benchmark's
+wall time and scratch space the same way downloads and uploads would.
+"""
+
+
+import gzip
+import json
+import os
+import shutil
+import tarfile
+import threading
+import time
+import traceback
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+GENOME_TYPE = "KBaseGenomes.Genome-17.0"
+ASSEMBLY_TYPE = "KBaseGenomeAnnotations.Assembly-6.0"
+SINGLE_END_TYPE = "KBaseFile.SingleEndLibrary-2.2"
+PAIRED_END_TYPE = "KBaseFile.PairedEndLibrary-2.2"
+READS_SET_TYPE = "KBaseSets.ReadsSet-2.0"
+ALIGNMENT_TYPE = "KBaseRNASeq.RNASeqAlignment-12.0"
+ALIGNMENT_SET_TYPE = "KBaseSets.ReadsAlignmentSet-2.0"
+REPORT_TYPE = "KBaseReport.Report-3.0"
+WS_ID = 1
+WS_NAME = "benchmark"
+COPY_CHUNK = 1024 * 1024
+
+
+class FakeKBase(object):
+    """
+    An in-memory Workspace and Shock, plus the SDK modules kb_hisat2 calls, served over HTTP.
+    """
+
+    def __init__(self, scratch_dir, shock_dir, task_runner=None):
+        """
+        scratch_dir is where downloaded files go, like the callback server's shared scratch.
+        shock_dir is where the fake Shock keeps its files. It should be outside of scratch_dir,
+        so uploads don't count as scratch space.
+        task_runner, if given, is called by the KBParallel stand-in with (task, scratch_dir)
+        for each task, and should return that task's result list.
+        """
+        self.scratch_dir = scratch_dir
+        self.shock_dir = shock_dir
+        os.makedirs(self.shock_dir, exist_ok=True)
+        self.task_runner = task_runner
+        self.objects = dict()  # obj id -> list of (info, data, refs), one per version
+        self.names = dict()  # obj name -> obj id
+        self.shock_nodes = dict()  # node id -> file path
+        self.jobs = dict()
+        self.calls = dict()  # method name -> number of calls
+        self._lock = threading.Lock()
+        self._server = None
+        self.url = None
+
+    def start(self):
+        handler = _make_handler(self)
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self._server.daemon_threads = True
+        self.url = "http://127.0.0.1:{}".format(self._server.server_address[1])
+        thread = threading.Thread(target=self._server.serve_forever, name="fake-kbase")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    # ---- loading data ----
+
+    def save_genome(self, name, fasta_path):
+        """
+        Saves a FASTA file as an Assembly, and a Genome pointing at it. Returns the genome ref.
+        """
+        assembly_ref = self.save_object(name + "_assembly", ASSEMBLY_TYPE, {
+            "fasta_handle_ref": self.add_shock_file(fasta_path)
+        })
+        return self.save_object(name, GENOME_TYPE, {"assembly_ref": assembly_ref},
+                                refs=[assembly_ref])
+
+    def save_reads(self, name, fwd_path, rev_path=None, read_count=0, total_bases=0):
+        """
+        Saves one or two FASTQ files as a SingleEndLibrary or PairedEndLibrary.
+        Returns the reads ref.
+        """
+        meta = {"read_count": str(read_count), "total_bases": str(total_bases)}
+        if rev_path is None:
+            return self.save_object(name, SINGLE_END_TYPE, {
+                "lib": self._make_lib(fwd_path),
+                "read_count": read_count,
+                "total_bases": total_bases
+            }, meta=meta)
+        return self.save_object(name, PAIRED_END_TYPE, {
+            "lib1": self._make_lib(fwd_path),
+            "lib2": self._make_lib(rev_path),
+            "interleaved": 0,
+            "read_count": read_count,
+            "total_bases": total_bases
+        }, meta=meta)
+
+    def save_reads_set(self, name, items):
+        """
+        Saves a ReadsSet. items is a list of {"ref": reads ref, "label": condition}.
+        Returns the set ref.
+        """
+        return self.save_object(name, READS_SET_TYPE, {
+            "description": "benchmark reads set",
+            "items": items
+        }, refs=[i["ref"] for i in items])
+
+    def save_object(self, name, obj_type, data, refs=None, meta=None):
+        with self._lock:
+            obj_id = self.names.get(name)
+            if obj_id is None:
+                obj_id = len(self.objects) + 1
+                self.names[name] = obj_id
+                self.objects[obj_id] = list()
+            version = len(self.objects[obj_id]) + 1
+            info = [obj_id, name, obj_type, time.strftime("%Y-%m-%dT%H:%M:%S+0000"), version,
+                    "benchmark", WS_ID, WS_NAME, uuid.uuid4().hex, len(json.dumps(data)),
+                    meta or {}]
+            self.objects[obj_id].append((info, data, list(refs or [])))
+            return "{}/{}/{}".format(WS_ID, obj_id, version)
+
+    def add_shock_file(self, path, copy=False):
+        """
+        Adds a file to the fake Shock. Returns its node id.
+        """
+        node_id = str(uuid.uuid4())
+        node_path = os.path.join(self.shock_dir, node_id)
+        if copy:
+            _copy_file(path, node_path)
+        else:
+            os.symlink(os.path.abspath(path), node_path)
+        with self._lock:
+            self.shock_nodes[node_id] = node_path
+        return node_id
+
+    def _make_lib(self, path):
+        return {
+            "file": {
+                "id": self.add_shock_file(path),
+                "url": self.url,
+                "file_name": os.path.basename(path),
+                "type": "shock"
+            },
+            "encoding": "ascii",
+            "type": "fq",
+            "size": os.path.getsize(path)
+        }
+
+    def get_object(self, ref):
+        """
+        Returns (info, data, refs) for the last object in a ref path.
+        """
+        ref = ref.split(";")[-1]
+        parts = ref.split("/")
+        obj_id = int(parts[1]) if parts[1].isdigit() else self.names[parts[1]]
+        versions = self.objects[obj_id]
+        if len(parts) > 2:
+            return versions[int(parts[2]) - 1]
+        return versions[-1]
+
+    def _upa(self, info):
+        return "{}/{}/{}".format(info[6], info[0], info[4])
+
+    def _scratch_file(self, name):
+        return os.path.join(self.scratch_dir, "{}_{}".format(uuid.uuid4().hex[:8], name))
+
+    def _shock_to_file(self, node_id, file_path):
+        _copy_file(self.shock_nodes[node_id], file_path)
+        return file_path
+
+    # ---- Workspace ----
+
+    def ws_get_object_info3(self, params):
+        infos = list()
+        paths = list()
+        for obj in params["objects"]:
+            try:
+                info = self.get_object(obj["ref"])[0]
+            except (KeyError, IndexError, ValueError):
+                if params.get("ignoreErrors"):
+                    infos.append(None)
+                    paths.append(None)
+                    continue
+                raise
+            infos.append(info)
+            paths.append(obj["ref"].split(";")[:-1] + [self._upa(info)])
+        return {"infos": infos, "paths": paths}
+
+    def ws_get_objects2(self, params):
+        data = list()
+        for obj in params["objects"]:
+            (info, obj_data, refs) = self.get_object(obj["ref"])
+            item = {"info": info, "refs": refs, "path": [self._upa(info)]}
+            if not params.get("no_data"):
+                item["data"] = obj_data
+            data.append(item)
+        return {"data": data}
+
+    # ---- SetAPI ----
+
+    def set_get_reads_set_v1(self, params):
+        (info, data, _) = self.get_object(params["ref"])
+        items = list()
+        for item in data["items"]:
+            items.append({
+                "ref": item["ref"],
+                "label": item.get("label"),
+                "ref_path": params["ref"] + ";" + item["ref"]
+            })
+        return {"data": {"description": data["description"], "items": items}, "info": info}
+
+    def set_save_reads_alignment_set_v1(self, params):
+        set_ref = self.save_object(params["output_object_name"], ALIGNMENT_SET_TYPE,
+                                   params["data"], refs=[i["ref"] for i in params["data"]["items"]])
+        return {"set_ref": set_ref, "set_info": self.get_object(set_ref)[0]}
+
+    # ---- SDK modules ----
+
+    def AssemblyUtil_get_assembly_as_fasta(self, params):
+        (info, data, _) = self.get_object(params["ref"])
+        path = self._shock_to_file(data["fasta_handle_ref"],
+                                   self._scratch_file(info[1] + ".fa"))
+        return {"path": path, "assembly_name": info[1]}
+
+    def ReadsUtils_download_reads(self, params):
+        files = dict()
+        for ref in params["read_libraries"]:
+            (info, data, _) = self.get_object(ref)
+            ret = {"type": "single", "fwd": None, "rev": None}
+            if "lib" in data:
+                ret["fwd"] = self._shock_to_file(data["lib"]["file"]["id"],
+                                                 self._scratch_file(info[1] + ".fq"))
+            else:
+                ret["type"] = "paired"
+                ret["fwd"] = self._shock_to_file(data["lib1"]["file"]["id"],
+                                                 self._scratch_file(info[1] + "_1.fq"))
+                ret["rev"] = self._shock_to_file(data["lib2"]["file"]["id"],
+                                                 self._scratch_file(info[1] + "_2.fq"))
+            files[ref] = {"files": ret, "ref": ref}
+        return {"files": files}
+
+    def ReadsAlignmentUtils_upload_alignment(self, params):
+        node_id = self.add_shock_file(params["file_path"], copy=True)
+        name = params["destination_ref"].split("/")[-1]
+        obj_ref = self.save_object(name, ALIGNMENT_TYPE, {
+            "file": {"id": node_id},
+            "library_type": params["library_type"],
+            "condition": params["condition"],
+            "genome_id": params["assembly_or_genome_ref"],
+            "read_sample_id": params["read_library_ref"],
+            "aligned_using": params["aligned_using"],
+            "aligner_version": params["aligner_version"],
+            "aligner_opts": params["aligner_opts"]
+        }, refs=[params["assembly_or_genome_ref"], params["read_library_ref"]])
+        return {"obj_ref": obj_ref}
+
+    def DataFileUtil_file_to_shock(self, params):
+        path = params["file_path"]
+        pack = params.get("pack")
+        if pack == "gzip":
+            gz_path = self._scratch_file(os.path.basename(path) + ".gz")
+            with open(path, "rb") as f_in, gzip.open(gz_path, "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            path = gz_path
+        elif pack:
+            src_dir = path if os.path.isdir(path) else os.path.dirname(path)
+            base = self._scratch_file(os.path.basename(src_dir.rstrip("/")))
+            if pack == "zip":
+                path = shutil.make_archive(base, "zip", src_dir)
+            else:
+                path = shutil.make_archive(base, "gztar", src_dir)
+        node_id = self.add_shock_file(path, copy=True)
+        if pack:
+            os.remove(path)
+        return {"shock_id": node_id, "size": os.path.getsize(self.shock_nodes[node_id])}
+
+    def DataFileUtil_shock_to_file(self, params):
+        file_path = params["file_path"]
+        if os.path.isdir(file_path):
+            file_path = os.path.join(file_path, params["shock_id"])
+        self._shock_to_file(params["shock_id"], file_path)
+        if params.get("unpack"):
+            out_dir = os.path.dirname(file_path)
+            if _is_gzip(file_path) and not tarfile.is_tarfile(file_path):
+                with gzip.open(file_path, "rb") as f_in, open(file_path + ".fq", "wb") as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+                os.remove(file_path)
+                file_path = file_path + ".fq"
+            elif tarfile.is_tarfile(file_path):
+                with tarfile.open(file_path) as tar:
+                    tar.extractall(out_dir)
+            elif zipfile.is_zipfile(file_path):
+                with zipfile.ZipFile(file_path) as zf:
+                    zf.extractall(out_dir)
+        return {"file_path": file_path, "node_file_name": params["shock_id"],
+                "size": os.path.getsize(file_path)}
+
+    def KBaseReport_create_extended_report(self, params):
+        name = params.get("report_object_name") or "report_" + uuid.uuid4().hex
+        ref = self.save_object(name, REPORT_TYPE, params)
+        return {"ref": ref, "name": name}
+
+    def kb_QualiMap_run_bamqc(self, params):
+        out_dir = self._scratch_file("qualimap")
+        os.makedirs(out_dir)
+        with open(os.path.join(out_dir, "qualimapReport.html"), "w") as f:
+            f.write("<html><body>QC of {}</body></html>".format(params["input_ref"]))
+        return {"qc_result_folder_path": out_dir}
+
+    def KBParallel_run_batch(self, params):
+        """
+        Runs each task with the task_runner, each in its own scratch directory like separate
+        subjobs, concurrent_local_tasks at a time (1 if not given).
+        """
+        def run_task(idx_task):
+            (idx, task) = idx_task
+            task_dir = os.path.join(self.scratch_dir, "subjob_{}".format(idx))
+            os.makedirs(task_dir, exist_ok=True)
+            try:
+                result = self.task_runner(task, task_dir)
+                return {"is_error": 0, "result_package": {"result": result, "error": None}}
+            except Exception as e:
+                traceback.print_exc()
+                return {"is_error": 1, "result_package": {"result": None, "error": str(e)}}
+            finally:
+                shutil.rmtree(task_dir, ignore_errors=True)
+
+        num_workers = max(1, int(params.get("concurrent_local_tasks") or 1))
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            results = list(pool.map(run_task, enumerate(params["tasks"])))
+        return {"results": results}
+
+    # ---- dispatch ----
+
+    def call(self, method, params):
+        """
+        Handles one JSON-RPC call. Returns the list of results.
+        """
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        (module, func) = method.split(".")
+        if module == "ServiceWizard" and func == "get_service_status":
+            return [{"url": self.url, "module_name": params[0]["module_name"]}]
+        if func == "_check_job":
+            with self._lock:
+                return [{"finished": 1, "result": self.jobs.pop(params[0])}]
+        if func.startswith("_") and func.endswith("_submit"):
+            result = self._call_module(module, func[1:-len("_submit")], params)
+            job_id = str(uuid.uuid4())
+            with self._lock:
+                self.jobs[job_id] = result
+            return [job_id]
+        return self._call_module(module, func, params)
+
+    def _call_module(self, module, func, params):
+        prefix = {"Workspace": "ws", "SetAPI": "set"}.get(module, module)
+        handler = getattr(self, "{}_{}".format(prefix, func), None)
+        if handler is None:
+            raise NotImplementedError("{}.{} isn't implemented by the stand-in services".format(
+                module, func))
+        return [handler(*params)]
+
+    def send_shock_node(self, node_id, wfile):
+        with open(self.shock_nodes[node_id], "rb") as f:
+            shutil.copyfileobj(f, wfile, COPY_CHUNK)
+
+
+def _make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            # Shock: /node/<id>?download_raw
+            parts = self.path.split("?")[0].strip("/").split("/")
+            if len(parts) != 2 or parts[0] != "node" or parts[1] not in fake.shock_nodes:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length",
+                             str(os.path.getsize(fake.shock_nodes[parts[1]])))
+            self.end_headers()
+            fake.send_shock_node(parts[1], self.wfile)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.headers.get("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+            req = json.loads(body.decode("utf-8"))
+            try:
+                resp = {"version": "1.1", "id": req.get("id"),
+                        "result": fake.call(req["method"], req.get("params", []))}
+                code = 200
+            except Exception as e:
+                traceback.print_exc()
+                resp = {"version": "1.1", "id": req.get("id"), "error": {
+                    "name": "JSONRPCError", "code": -32500, "message": str(e),
+                    "error": traceback.format_exc()
+                }}
+                code = 500
+            out = json.dumps(resp).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+
+    return Handler
+
+
+def _is_gzip(path):
+    with open(path, "rb") as f:
+        return f.read(2) == b"\x1f\x8b"
+
+
+def _copy_file(src, dst):
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        shutil.copyfileobj(fin, fout, COPY_CHUNK)
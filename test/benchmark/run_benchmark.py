@@ -0,0 +1,356 @@
+"""
+Offline end-to-end benchmark for kb_hisat2.
+
+Runs kb_hisat2.run_hisat2 (and through it, Hisat2.run_single or Hisat2.run_batch) against the
+local stand-in services in fake_services.py, on synthetic data from simulate.py, and reports
+the wall time, CPU time, peak RSS, and peak scratch usage of each stage of the pipeline. This
+needs hisat2, hisat2-build, and samtools on the PATH, but no KBase services or token.
+
+Run it from the top of the repo like this:
+PYTHONPATH=lib python test/benchmark/run_benchmark.py --reads 1M,10M,50M --samples 4 \
+    --runner local_pool --output bench.json
+
+Stage numbers are measured over the whole process tree (this process, the stand-in services,
+and every hisat2/samtools subprocess) while the stage is running. They're exact when stages
+run one after another (a single library, or the parallel runner with one task at a time).
+When stages overlap, like with the local_pool runner, each stage's CPU and memory include
+whatever else was running alongside it.
+"""
+
+
+import argparse
+import functools
+import json
+import os
+import resource
+import shutil
+import sys
+import threading
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARK_DIR)
+
+from fake_services import FakeKBase  # noqa: E402
+from simulate import simulate_genome, simulate_reads  # noqa: E402
+from kb_hisat2.hisat2 import Hisat2  # noqa: E402
+from kb_hisat2.kb_hisat2Impl import kb_hisat2  # noqa: E402
+
+# Hisat2 methods that get timed, and the stage name each one is reported under.
+STAGES = [
+    ("build_index", "index"),
+    ("share_index", "share_index"),
+    ("fetch_reads", "download"),
+    ("align_fetched_reads", "align"),
+    ("upload_fetched_alignment", "upload"),
+    ("upload_alignment_set", "upload_set"),
+    ("build_report", "report")
+]
+SAMPLE_INTERVAL = 0.2  # seconds between RSS and scratch samples
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+class StageProfiler(object):
+    """
+    Times stages of a run. Each stage records the number of times it ran, its total wall
+    time, CPU time (user + system, including child processes), and the peak RSS and scratch
+    space seen while it was running. A background thread samples RSS and scratch usage.
+    """
+
+    def __init__(self, scratch_dir, interval=SAMPLE_INTERVAL):
+        self.scratch_dir = scratch_dir
+        self.interval = interval
+        self.stages = dict()
+        self._active = dict()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        self._sampler = threading.Thread(target=self._sample, name="profiler")
+        self._sampler.daemon = True
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+
+    def wrap(self, name, func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            token = object()
+            start = (time.time(), _cpu_time())
+            with self._lock:
+                self._active[token] = {"peak_rss": 0, "peak_scratch": 0}
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    peaks = self._active.pop(token)
+                self._record(name, time.time() - start[0], _cpu_time() - start[1], peaks)
+        return timed
+
+    def _record(self, name, wall, cpu, peaks):
+        with self._lock:
+            stage = self.stages.setdefault(name, {
+                "count": 0, "wall": 0.0, "cpu": 0.0, "peak_rss": 0, "peak_scratch": 0
+            })
+            stage["count"] += 1
+            stage["wall"] += wall
+            stage["cpu"] += cpu
+            stage["peak_rss"] = max(stage["peak_rss"], peaks["peak_rss"])
+            stage["peak_scratch"] = max(stage["peak_scratch"], peaks["peak_scratch"])
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            rss = _tree_rss(os.getpid())
+            scratch = _dir_size(self.scratch_dir)
+            with self._lock:
+                for peaks in self._active.values():
+                    peaks["peak_rss"] = max(peaks["peak_rss"], rss)
+                    peaks["peak_scratch"] = max(peaks["peak_scratch"], scratch)
+
+
+def instrument(profiler):
+    """
+    Wraps the Hisat2 stage methods with the profiler. Returns a function that puts them back.
+    """
+    originals = dict()
+    for (method, stage) in STAGES:
+        originals[method] = getattr(Hisat2, method)
+        setattr(Hisat2, method, profiler.wrap(stage, originals[method]))
+
+    def restore():
+        for method in originals:
+            setattr(Hisat2, method, originals[method])
+    return restore
+
+
+class BenchmarkContext(dict):
+    """
+    Just enough of the SDK's MethodContext for kb_hisat2.run_hisat2.
+    """
+
+    def provenance(self):
+        return []
+
+
+def run_one(args, num_reads, data_dir, run_dir):
+    """
+    Runs one benchmark with num_reads reads (split evenly between args.samples libraries).
+    Returns the results as a dict.
+    """
+    scratch_dir = os.path.join(run_dir, "scratch")
+    os.makedirs(scratch_dir)
+    print("Simulating data for {} reads...".format(num_reads))
+    genome_file = simulate_genome(data_dir, genome_size=args.genome_size)
+    reads_files = list()
+    for idx in range(args.samples):
+        reads_files.append(simulate_reads(
+            data_dir, genome_file, num_reads // args.samples, read_length=args.read_length,
+            paired=args.paired, prefix="reads{}".format(idx), seed=idx + 1))
+
+    def run_task(task, task_dir):
+        return make_impl(fake.url, task_dir).run_hisat2(BenchmarkContext(), task["parameters"])
+
+    fake = FakeKBase(scratch_dir, os.path.join(run_dir, "shock"), task_runner=run_task)
+    fake.start()
+    profiler = StageProfiler(scratch_dir)
+    restore = instrument(profiler)
+    try:
+        os.environ["SDK_CALLBACK_URL"] = fake.url
+        os.environ.setdefault("KB_AUTH_TOKEN", "benchmark")
+        genome_ref = fake.save_genome("genome", genome_file)
+        reads_refs = list()
+        for idx, files in enumerate(reads_files):
+            reads_refs.append(fake.save_reads(
+                "reads{}".format(idx), files[0], files[1] if args.paired else None,
+                read_count=num_reads // args.samples,
+                total_bases=num_reads // args.samples * args.read_length * len(files)))
+        if args.samples == 1:
+            sampleset_ref = reads_refs[0]
+        else:
+            sampleset_ref = fake.save_reads_set("reads_set", [
+                {"ref": ref, "label": "condition{}".format(idx % 2)}
+                for idx, ref in enumerate(reads_refs)])
+        params = {
+            "ws_name": "benchmark",
+            "sampleset_ref": sampleset_ref,
+            "genome_ref": genome_ref,
+            "alignment_suffix": "_alignment",
+            "alignmentset_suffix": "_alignment_set",
+            "condition": "benchmark",
+            "build_report": 0 if args.no_report else 1,
+            "stream_reads": 1 if args.stream_reads else 0,
+            "shared_index": 1 if args.shared_index else 0,
+            "num_shards": args.num_shards,
+            "runner": args.runner
+        }
+        if args.num_threads is not None:
+            params["num_threads"] = args.num_threads
+        if args.max_scratch_gb is not None:
+            params["max_scratch_gb"] = args.max_scratch_gb
+
+        impl = make_impl(fake.url, scratch_dir)
+        profiler.start()
+        run = profiler.wrap("total", impl.run_hisat2)
+        run(BenchmarkContext(), params)
+    finally:
+        profiler.stop()
+        restore()
+        fake.stop()
+    return {
+        "reads": num_reads,
+        "samples": args.samples,
+        "paired": args.paired,
+        "runner": args.runner,
+        "stream_reads": args.stream_reads,
+        "shared_index": args.shared_index,
+        "num_shards": args.num_shards,
+        "stages": profiler.stages,
+        "max_child_rss": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+        "service_calls": fake.calls
+    }
+
+
+def make_impl(url, scratch_dir):
+    return kb_hisat2({
+        "srv-wiz-url": url,
+        "workspace-url": url,
+        "scratch": scratch_dir
+    })
+
+
+def print_results(results):
+    header = "{:>10} {:<12} {:>5} {:>10} {:>10} {:>12} {:>12}".format(
+        "reads", "stage", "runs", "wall (s)", "cpu (s)", "peak rss", "peak scratch")
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        stage_names = [s for (_, s) in STAGES] + ["total"]
+        for name in stage_names:
+            if name not in result["stages"]:
+                continue
+            stage = result["stages"][name]
+            print("{:>10} {:<12} {:>5} {:>10.1f} {:>10.1f} {:>12} {:>12}".format(
+                _format_count(result["reads"]), name, stage["count"], stage["wall"],
+                stage["cpu"], _format_bytes(stage["peak_rss"]),
+                _format_bytes(stage["peak_scratch"])))
+
+
+def parse_count(s):
+    """
+    Parses a read count like 500000, 1M, or 2.5k.
+    """
+    s = s.strip().upper()
+    scale = {"K": 1000, "M": 1000 ** 2, "G": 1000 ** 3}.get(s[-1:], 1)
+    if scale != 1:
+        s = s[:-1]
+    return int(float(s) * scale)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--reads", default="1M,10M,50M",
+                        help="comma-separated total read counts to benchmark (default 1M,10M,50M)")
+    parser.add_argument("--samples", type=int, default=1,
+                        help="number of reads libraries to split the reads between. More than "
+                             "one makes a ReadsSet, and runs a batch (default 1)")
+    parser.add_argument("--paired", action="store_true", help="simulate paired-end reads")
+    parser.add_argument("--read-length", type=int, default=100)
+    parser.add_argument("--genome-size", type=int, default=None,
+                        help="genome size in bases (default: the test genbank section)")
+    parser.add_argument("--runner", default="parallel",
+                        choices=["parallel", "local_pool", "hybrid"])
+    parser.add_argument("--stream-reads", action="store_true")
+    parser.add_argument("--shared-index", action="store_true",
+                        help="memory-map one shared copy of the index in every hisat2 process")
+    parser.add_argument("--num-shards", type=int, default=1,
+                        help="split a single library into this many shards, aligned in parallel")
+    parser.add_argument("--num-threads", type=int, default=None)
+    parser.add_argument("--max-scratch-gb", type=int, default=None)
+    parser.add_argument("--no-report", action="store_true", help="skip building the report")
+    parser.add_argument("--work-dir", default="/tmp/kb_hisat2_benchmark",
+                        help="where simulated data is kept between runs, and runs happen")
+    parser.add_argument("--keep", action="store_true",
+                        help="keep each run's scratch and stand-in Shock files")
+    parser.add_argument("--output", default=None, help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    data_dir = os.path.join(args.work_dir, "data")
+    os.makedirs(data_dir, exist_ok=True)
+    results = list()
+    for num_reads in [parse_count(r) for r in args.reads.split(",")]:
+        run_dir = os.path.join(args.work_dir, "run_{}_{}".format(num_reads, int(time.time())))
+        try:
+            results.append(run_one(args, num_reads, data_dir, run_dir))
+        finally:
+            if not args.keep:
+                shutil.rmtree(run_dir, ignore_errors=True)
+    print_results(results)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def _cpu_time():
+    usage = [resource.getrusage(who) for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+def _tree_rss(root_pid):
+    """
+    Returns the total RSS in bytes of root_pid and all of its descendants.
+    """
+    parents = dict()
+    rss = dict()
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(pid)) as f:
+                # the command name can have spaces in it, so split after its closing paren.
+                fields = f.read().rsplit(")", 1)[1].split()
+            parents[int(pid)] = int(fields[1])
+            rss[int(pid)] = int(fields[21]) * PAGE_SIZE
+        except (IOError, IndexError, ValueError):
+            continue
+    total = 0
+    for pid in rss:
+        p = pid
+        while p in parents and p != root_pid and p > 1:
+            p = parents[p]
+        if p == root_pid:
+            total += rss[pid]
+    return total
+
+
+def _dir_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def _format_bytes(num_bytes):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if num_bytes < 1024:
+            return "{:.1f} {}".format(num_bytes, unit)
+        num_bytes /= 1024.0
+    return "{:.1f} TB".format(num_bytes)
+
+
+def _format_count(count):
+    for (suffix, scale) in [("G", 1000 ** 3), ("M", 1000 ** 2), ("K", 1000)]:
+        if count >= scale and count % scale == 0:
+            return "{}{}".format(count // scale, suffix)
+    return str(count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Makes synthetic benchmark data, seeded from the test data in test/data: a genome built from
+the Arabidopsis chromosome 1 section in at_chrom1_section.gbk, and reads sampled from it,
+with base qualities taken from the test FASTQ files.
+
+genome_file = simulate_genome(out_dir, genome_size=10 * 1000 ** 2)
+reads_files = simulate_reads(out_dir, genome_file, num_reads=10 ** 6, paired=True)
+
+Everything is seeded, so the same arguments always give the same files, and files that
+already exist are reused instead of simulated again.
+"""
+
+
+import os
+import random
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+SOURCE_GBK = os.path.join(DATA_DIR, "at_chrom1_section.gbk")
+SOURCE_FASTQ = [os.path.join(DATA_DIR, "extracted_WT_rep1.fastq"),
+                os.path.join(DATA_DIR, "extracted_hy5_rep1.fastq")]
+# each extra chromosome is a copy of the source with this fraction of bases changed, so
+# reads still map uniquely to one of them.
+CHROMOSOME_DIVERGENCE = 0.05
+FASTA_LINE_LENGTH = 60
+COMPLEMENT = str.maketrans("ACGTN", "TGCAN")
+BASES = "ACGT"
+
+
+def read_genbank_sequence(gbk_file=SOURCE_GBK):
+    """
+    Returns the sequence from the ORIGIN section of a Genbank file, upper case.
+    """
+    seq = list()
+    in_origin = False
+    with open(gbk_file) as f:
+        for line in f:
+            if line.startswith("ORIGIN"):
+                in_origin = True
+            elif line.startswith("//"):
+                in_origin = False
+            elif in_origin:
+                seq.extend(line.split()[1:])
+    return "".join(seq).upper()
+
+
+def read_qualities(fastq_files=SOURCE_FASTQ):
+    """
+    Returns the list of quality strings from the given FASTQ files.
+    """
+    quals = list()
+    for fastq_file in fastq_files:
+        with open(fastq_file) as f:
+            for idx, line in enumerate(f):
+                if idx % 4 == 3:
+                    quals.append(line.strip())
+    return quals
+
+
+def simulate_genome(out_dir, genome_size=None, seed=1):
+    """
+    Writes a FASTA genome of about genome_size bases (the size of the source sequence, if not
+    given) to out_dir, and returns its path. The first chromosome is the source sequence, and
+    the rest are mutated copies of it.
+    """
+    source = read_genbank_sequence()
+    if genome_size is None:
+        genome_size = len(source)
+    fasta_file = os.path.join(out_dir, "genome_{}_{}.fa".format(genome_size, seed))
+    if os.path.exists(fasta_file):
+        return fasta_file
+    rng = random.Random(seed)
+    tmp_file = fasta_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        written = 0
+        chrom = 0
+        while written < genome_size:
+            seq = source if chrom == 0 else _mutate(source, CHROMOSOME_DIVERGENCE, rng)
+            seq = seq[:genome_size - written]
+            f.write(">chr{}\n".format(chrom + 1))
+            for i in range(0, len(seq), FASTA_LINE_LENGTH):
+                f.write(seq[i:i + FASTA_LINE_LENGTH] + "\n")
+            written += len(seq)
+            chrom += 1
+    os.rename(tmp_file, fasta_file)
+    return fasta_file
+
+
+def simulate_reads(out_dir, genome_file, num_reads, read_length=100, paired=False,
+                   insert_size=300, error_rate=0.01, spliced_fraction=0.1, prefix="reads",
+                   seed=1):
+    """
+    Writes num_reads reads (or read pairs) sampled from genome_file to FASTQ files in out_dir.
+    A spliced_fraction of the reads are split across a gap in the genome, like reads spanning
+    an intron, and error_rate of the bases are substitution errors.
+    Returns a list of the FASTQ file paths (2 if paired, 1 otherwise).
+    """
+    name = "{}_{}_{}_{}{}".format(prefix, num_reads, read_length, seed, "_pe" if paired else "")
+    files = [os.path.join(out_dir, name + "_1.fq")]
+    if paired:
+        files.append(os.path.join(out_dir, name + "_2.fq"))
+    if all(os.path.exists(f) for f in files):
+        return files
+
+    rng = random.Random(seed)
+    chroms = [seq for (_, seq) in _read_fasta(genome_file)]
+    quals = [_stretch(q, read_length) for q in read_qualities()]
+    fragment_length = insert_size if paired else read_length
+    tmp_files = [f + ".tmp" for f in files]
+    outs = [open(f, "w") for f in tmp_files]
+    try:
+        for i in range(num_reads):
+            chrom = chroms[rng.randrange(len(chroms))]
+            fragment = _sample_fragment(chrom, fragment_length, spliced_fraction, rng)
+            if rng.random() < 0.5:
+                fragment = _reverse_complement(fragment)
+            mates = [fragment[:read_length]]
+            if paired:
+                mates.append(_reverse_complement(fragment[-read_length:]))
+            for mate_idx, (seq, out) in enumerate(zip(mates, outs)):
+                seq = _add_errors(seq, error_rate, rng)
+                out.write("@sim.{} {}/{}\n{}\n+\n{}\n".format(
+                    i, name, mate_idx + 1, seq, quals[rng.randrange(len(quals))][:len(seq)]))
+    finally:
+        for out in outs:
+            out.close()
+    for (tmp_file, f) in zip(tmp_files, files):
+        os.rename(tmp_file, f)
+    return files
+
+
+def _read_fasta(fasta_file):
+    name = None
+    seq = list()
+    with open(fasta_file) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith(">"):
+                if name is not None:
+                    yield (name, "".join(seq))
+                name = line[1:]
+                seq = list()
+            else:
+                seq.append(line)
+    if name is not None:
+        yield (name, "".join(seq))
+
+
+def _sample_fragment(chrom, length, spliced_fraction, rng):
+    """
+    Returns a random fragment of the given length from chrom. Some get a gap of 100-2000
+    bases cut out of the middle, like an intron.
+    """
+    gap = rng.randint(100, 2000) if rng.random() < spliced_fraction else 0
+    if length + gap >= len(chrom):
+        gap = 0
+    start = rng.randrange(len(chrom) - length - gap)
+    if gap == 0:
+        return chrom[start:start + length]
+    split = rng.randint(length // 4, 3 * length // 4)
+    return chrom[start:start + split] + chrom[start + split + gap:start + length + gap]
+
+
+def _mutate(seq, rate, rng):
+    seq = list(seq)
+    for _ in range(int(len(seq) * rate)):
+        seq[rng.randrange(len(seq))] = rng.choice(BASES)
+    return "".join(seq)
+
+
+def _add_errors(seq, rate, rng):
+    # picks the number of errors up front, instead of rolling for every base, which is far
+    # too slow for tens of millions of reads.
+    expected = rate * len(seq)
+    num_errors = int(expected) + (1 if rng.random() < expected - int(expected) else 0)
+    for _ in range(num_errors):
+        pos = rng.randrange(len(seq))
+        seq = seq[:pos] + rng.choice(BASES) + seq[pos + 1:]
+    return seq
+
+
+def _reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def _stretch(qual, length):
+    """
+    Stretches (or shrinks) a quality string to the given length.
+    """
+    return "".join(qual[i * len(qual) // length] for i in range(length))
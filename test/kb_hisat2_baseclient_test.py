@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+
+import gzip
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+
+from installed_clients import baseclient as installed_baseclient
+from kb_hisat2 import baseclient
+
+
+class _JSONRPCHandler(BaseHTTPRequestHandler):
+    """
+    Answers every call with the length of its first parameter, gzipped if that's asked for,
+    and keeps the encoding headers of each request it gets.
+    """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        self.server.requests.append(dict(self.headers))
+        call = json.loads(body.decode("utf-8"))
+        out = json.dumps({"version": "1.1", "id": call["id"],
+                          "result": [len(call["params"][0])]}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("content-type", "application/json")
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            out = gzip.compress(out)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def log_message(self, *args):
+        pass
+
+
+class BaseClientTest(unittest.TestCase):
+    """
+    Checks connection pooling and gzip in both copies of the base client, against a JSON-RPC
+    server on localhost. These don't need a KBase token or any services.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(("127.0.0.1", 0), _JSONRPCHandler)
+        cls.server.requests = list()
+        cls.server_thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.server_thread.start()
+        cls.url = "http://127.0.0.1:{}/".format(cls.server.server_port)
+        cls.modules = [baseclient, installed_baseclient]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_pool_size_from_env(self):
+        for module in self.modules:
+            with mock.patch.dict("os.environ", {"KB_CLIENT_POOL_SIZE": "4"}):
+                self.assertEqual(module._env_pool_size(), 4)
+            # a bad value falls back to the default, instead of breaking every client.
+            with mock.patch.dict("os.environ", {"KB_CLIENT_POOL_SIZE": "lots"}):
+                self.assertEqual(module._env_pool_size(), module._DEFAULT_POOL_SIZE)
+            with mock.patch.dict("os.environ", {"KB_CLIENT_POOL_SIZE": "0"}):
+                self.assertEqual(module._env_pool_size(), 1)
+
+    def test_shared_adapter(self):
+        for module in self.modules:
+            clients = [module.BaseClient(self.url, token="token", pool_size=3)
+                       for _ in range(2)]
+            sessions = [client._get_session(self.url) for client in clients]
+            other_thread = list()
+            thread = threading.Thread(
+                target=lambda: other_thread.append(clients[0]._get_session(self.url)))
+            thread.start()
+            thread.join()
+            sessions.extend(other_thread)
+            # each client, in each thread, has its own session (and cookies)...
+            self.assertEqual(len(set(id(session) for session in sessions)), 3)
+            self.assertIs(clients[0]._get_session(self.url), sessions[0])
+            # ...but they all share one connection pool for the host.
+            adapters = [session.get_adapter(self.url) for session in sessions]
+            self.assertTrue(all(adapter is adapters[0] for adapter in adapters))
+            self.assertEqual(adapters[0]._pool_maxsize, 3)
+            # a different pool size gets a pool of its own.
+            client = module.BaseClient(self.url, token="token", pool_size=5)
+            self.assertIsNot(client._get_session(self.url).get_adapter(self.url), adapters[0])
+
+    def test_gzip(self):
+        big = "x" * 100000
+        for module in self.modules:
+            client = module.BaseClient(self.url, token="token", gzip=False)
+            self.assertEqual(client._call(self.url, "Test.len", [big]), len(big))
+            self.assertNotIn("Content-Encoding", self.server.requests[-1])
+            client = module.BaseClient(self.url, token="token", gzip=True)
+            self.assertEqual(client._call(self.url, "Test.len", [big]), len(big))
+            self.assertEqual(self.server.requests[-1]["Content-Encoding"], "gzip")
+            self.assertEqual(self.server.requests[-1]["Accept-Encoding"], "gzip")
+            # small requests aren't worth compressing, but the response still can be.
+            self.assertEqual(client._call(self.url, "Test.len", ["x"]), 1)
+            self.assertNotIn("Content-Encoding", self.server.requests[-1])
+            self.assertEqual(self.server.requests[-1]["Accept-Encoding"], "gzip")
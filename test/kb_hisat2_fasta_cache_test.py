@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from kb_hisat2 import file_util
+from kb_hisat2.file_cache import FileCache
+from kb_hisat2.file_util import FASTA_FILE_NAME, fetch_fasta_from_assembly
+
+ASSEMBLY_REF = "1/2/3"
+FASTA = b">contig_1\nACGTACGTAC\n>contig_2\nGGCCTTAA\n"
+
+
+class FastaCacheTest(unittest.TestCase):
+    """
+    Checks that FASTA files are reused from the cache, and fetched again when they don't match
+    their MD5. The workspace and AssemblyUtil are faked, so these don't need a KBase token or
+    any services.
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.cache = FileCache(os.path.join(self.work_dir, "fasta_cache"), 1024 ** 3)
+        self.fetches = list()
+        assembly_util = mock.MagicMock()
+        assembly_util.return_value.get_assembly_as_fasta.side_effect = self.fake_fetch
+        self.patches = [
+            mock.patch.object(file_util, "AssemblyUtil", assembly_util),
+            mock.patch.object(file_util, "check_ref_type", return_value=True),
+            mock.patch.object(file_util, "get_object_upa", return_value=ASSEMBLY_REF)
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.cache.close()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def fake_fetch(self, params):
+        self.fetches.append(params["ref"])
+        path = os.path.join(self.work_dir, "fetched_{}.fa".format(len(self.fetches)))
+        with open(path, "wb") as f:
+            f.write(FASTA)
+        return {"path": path}
+
+    def fetch(self):
+        return fetch_fasta_from_assembly(ASSEMBLY_REF, "ws_url", "callback_url",
+                                         fasta_cache=self.cache)
+
+    def test_fasta_cache_reuse(self):
+        first = self.fetch()
+        self.assertEqual(os.path.basename(first["path"]), FASTA_FILE_NAME)
+        second = self.fetch()
+        self.assertEqual(second["path"], first["path"])
+        self.assertEqual(self.fetches, [ASSEMBLY_REF])
+        with open(second["path"], "rb") as f:
+            self.assertEqual(f.read(), FASTA)
+
+    def test_fasta_cache_corrupt(self):
+        first = self.fetch()
+        with open(first["path"], "ab") as f:
+            f.write(b"NNNN\n")
+        # the MD5 doesn't match any more, so it gets fetched again.
+        second = self.fetch()
+        self.assertEqual(self.fetches, [ASSEMBLY_REF, ASSEMBLY_REF])
+        with open(second["path"], "rb") as f:
+            self.assertEqual(f.read(), FASTA)
+
+    def test_no_fasta_cache(self):
+        fasta_file = fetch_fasta_from_assembly(ASSEMBLY_REF, "ws_url", "callback_url")
+        self.assertEqual(fasta_file["path"], os.path.join(self.work_dir, "fetched_1.fa"))
+        self.assertEqual(self.fetches, [ASSEMBLY_REF])
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+
+import sys
+import unittest
+
+from kb_hisat2.process import (
+    MonitoredProcess,
+    is_out_of_memory,
+    run_process,
+    summarize_processes
+)
+from kb_hisat2.tracing import Tracer
+
+MB = 1024 ** 2
+# holds on to about 64 MB for half a second, so both wait4 and the /proc samples see it.
+ALLOCATE_CMD = [sys.executable, "-c",
+                "import time; data = bytearray(64 * 1024 ** 2); time.sleep(0.5)"]
+
+
+class ProcessTest(unittest.TestCase):
+    """
+    Checks the resource stats of real (small) subprocesses. These don't need a KBase token or
+    any services.
+    """
+
+    def test_process_stats(self):
+        tracer = Tracer()
+        with tracer.span("allocate") as span:
+            proc = MonitoredProcess(ALLOCATE_CMD, name="allocate", span=span, interval=0.05)
+            self.assertEqual(proc.wait(), 0)
+        self.assertEqual(proc.returncode, 0)
+        stats = proc.stats
+        self.assertEqual(stats["name"], "allocate")
+        self.assertGreaterEqual(stats["wall"], 0.5)
+        self.assertGreaterEqual(stats["max_rss"], 64 * MB)
+        self.assertGreaterEqual(stats["sampled_max_rss"], 64 * MB)
+        self.assertGreaterEqual(stats["max_threads"], 1)
+        self.assertAlmostEqual(stats["parallelism"],
+                               (stats["user_cpu"] + stats["sys_cpu"]) / stats["wall"])
+        # the stats go in the span, for the profile.
+        self.assertEqual(span.attrs["processes"], [stats])
+        # waiting again doesn't reap (or record) it twice.
+        self.assertEqual(proc.wait(), 0)
+        self.assertEqual(len(span.attrs["processes"]), 1)
+
+    def test_exit_codes(self):
+        self.assertEqual(run_process(["false"]).returncode, 1)
+        killed = run_process(["sh", "-c", "kill -9 $$"])
+        self.assertEqual(killed.returncode, -9)
+
+    def test_is_out_of_memory(self):
+        ok = run_process(["true"])
+        self.assertFalse(is_out_of_memory(ok, 1))
+        # killed by SIGKILL, like the OOM killer does.
+        killed = run_process(["sh", "-c", "kill -9 $$"])
+        self.assertTrue(is_out_of_memory(killed, 1024 ** 4))
+        # failed after using about all of its memory limit.
+        failed = run_process(["sh", "-c", "exit 3"])
+        peak = max(failed.stats["max_rss"], failed.stats["sampled_max_rss"])
+        self.assertTrue(is_out_of_memory(failed, peak))
+        self.assertFalse(is_out_of_memory(failed, peak * 10))
+
+    def test_summarize_processes(self):
+        stats = [
+            {"name": "hisat2", "wall": 10.0, "user_cpu": 30.0, "sys_cpu": 10.0,
+             "max_rss": 100 * MB, "sampled_max_rss": 120 * MB, "max_threads": 4},
+            {"name": "samtools sort", "wall": 2.0, "user_cpu": 1.0, "sys_cpu": 1.0,
+             "max_rss": 10 * MB, "sampled_max_rss": 0, "max_threads": 1},
+            {"name": "hisat2", "wall": 10.0, "user_cpu": 30.0, "sys_cpu": 10.0,
+             "max_rss": 200 * MB, "sampled_max_rss": 0, "max_threads": 8}
+        ]
+        lines = summarize_processes(stats).split("\n")
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].startswith("Program"))
+        # totalled by program, in the order they first ran.
+        self.assertEqual(lines[1].split(),
+                         ["hisat2", "2", "20.0", "80.0", "4.0", "8", "200", "MB"])
+        self.assertEqual(lines[2].split()[:3], ["samtools", "sort", "1"])
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from kb_hisat2 import resources
+from kb_hisat2.resources import get_cpu_limit, plan_resources, plan_workers
+
+GB = 1024 ** 3
+
+
+class ResourcesTest(unittest.TestCase):
+    """
+    Checks the cgroup limits and resource plans against fake cgroup files in a temp dir.
+    These don't need a KBase token or any services.
+    """
+
+    def setUp(self):
+        self.cgroup_dir = tempfile.mkdtemp()
+        # point every cgroup file at one that doesn't exist yet, so each test only sees the
+        # ones it writes.
+        self.patches = [
+            mock.patch.object(resources, name, os.path.join(self.cgroup_dir, name))
+            for name in ["CGROUP_V2_CPU_MAX", "CGROUP_V1_CPU_QUOTA", "CGROUP_V1_CPU_PERIOD",
+                         "CGROUP_V2_MEMORY_MAX", "CGROUP_V1_MEMORY_LIMIT"]
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree(self.cgroup_dir, ignore_errors=True)
+
+    def write_cgroup(self, name, value):
+        with open(getattr(resources, name), "w") as f:
+            f.write(value + "\n")
+
+    def test_cpu_quota_v2(self):
+        self.write_cgroup("CGROUP_V2_CPU_MAX", "250000 100000")
+        self.assertEqual(resources._read_cpu_quota(), 2.5)
+        self.write_cgroup("CGROUP_V2_CPU_MAX", "max 100000")
+        self.assertIsNone(resources._read_cpu_quota())
+
+    def test_cpu_quota_v1(self):
+        self.write_cgroup("CGROUP_V1_CPU_QUOTA", "400000")
+        self.write_cgroup("CGROUP_V1_CPU_PERIOD", "100000")
+        self.assertEqual(resources._read_cpu_quota(), 4.0)
+        self.write_cgroup("CGROUP_V1_CPU_QUOTA", "-1")
+        self.assertIsNone(resources._read_cpu_quota())
+
+    def test_no_cgroup(self):
+        self.assertIsNone(resources._read_cpu_quota())
+        self.assertIsNone(resources._read_memory_limit())
+
+    def test_memory_limit(self):
+        self.write_cgroup("CGROUP_V1_MEMORY_LIMIT", str(8 * GB))
+        self.assertEqual(resources._read_memory_limit(), 8 * GB)
+        # cgroup v2 wins over v1.
+        self.write_cgroup("CGROUP_V2_MEMORY_MAX", str(4 * GB))
+        self.assertEqual(resources._read_memory_limit(), 4 * GB)
+        self.write_cgroup("CGROUP_V2_MEMORY_MAX", "max")
+        self.assertIsNone(resources._read_memory_limit())
+
+    def test_cpu_limit_rounds_quota_down(self):
+        self.write_cgroup("CGROUP_V2_CPU_MAX", "150000 100000")
+        with mock.patch.object(os, "sched_getaffinity", return_value=set(range(8))):
+            self.assertEqual(get_cpu_limit(), 1)
+        # a quota under one CPU still gets one.
+        self.write_cgroup("CGROUP_V2_CPU_MAX", "50000 100000")
+        with mock.patch.object(os, "sched_getaffinity", return_value=set(range(8))):
+            self.assertEqual(get_cpu_limit(), 1)
+        # and the cpuset wins when it's smaller.
+        self.write_cgroup("CGROUP_V2_CPU_MAX", "800000 100000")
+        with mock.patch.object(os, "sched_getaffinity", return_value={0, 1}):
+            self.assertEqual(get_cpu_limit(), 2)
+
+    def test_plan_resources(self):
+        with mock.patch.object(resources, "get_cpu_limit", return_value=16), \
+                mock.patch.object(resources, "get_memory_limit", return_value=32 * GB):
+            plan = plan_resources()
+            self.assertEqual(plan["cpus"], 16)
+            self.assertEqual(plan["align_threads"], 16)
+            self.assertEqual(plan["sort_threads"], 4)
+            self.assertEqual(plan["sort_memory_per_thread"], "2048M")
+            # num_threads caps the plan, but can't go over what's there.
+            self.assertEqual(plan_resources(max_threads=4)["align_threads"], 4)
+            self.assertEqual(plan_resources(max_threads=4)["sort_threads"], 1)
+            self.assertEqual(plan_resources(max_threads=64)["cpus"], 16)
+        with mock.patch.object(resources, "get_cpu_limit", return_value=2), \
+                mock.patch.object(resources, "get_memory_limit", return_value=GB):
+            # sort memory never goes under the minimum.
+            self.assertEqual(plan_resources()["sort_memory_per_thread"], "256M")
+
+    def test_plan_workers(self):
+        plan = {"cpus": 32, "memory": 64 * GB}
+        # limited by CPUs, at MIN_THREADS_PER_WORKER each.
+        self.assertEqual(plan_workers(20, 2 * GB, plan), 8)
+        # limited by memory.
+        self.assertEqual(plan_workers(20, 20 * GB, plan), 3)
+        # limited by the number of tasks.
+        self.assertEqual(plan_workers(2, 2 * GB, plan), 2)
+        # a shared index comes off the top, once.
+        self.assertEqual(plan_workers(20, 8 * GB, plan, shared_memory=24 * GB), 5)
+        # always at least one, even if it doesn't fit.
+        self.assertEqual(plan_workers(20, 128 * GB, plan), 1)
@@ -1,17 +1,23 @@
 # -*- coding: utf-8 -*-
 
 
+import json
 import os  # noqa: F401
 import shutil
 import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from os import environ
 from configparser import ConfigParser
 
 from kb_hisat2.kb_hisat2Impl import kb_hisat2
 from kb_hisat2.kb_hisat2Server import MethodContext
 from kb_hisat2.authclient import KBaseAuth as _KBaseAuth
+from kb_hisat2.file_cache import FileCache
+from kb_hisat2.file_util import ReadsStream, close_reads_streams
 from kb_hisat2.hisat2indexmanager import Hisat2IndexManager
+from kb_hisat2.manifest import MANIFEST_DIR, BatchManifest
+from kb_hisat2.scratch import JOB_DIR_PREFIX
 from installed_clients.WorkspaceClient import Workspace
 from installed_clients.DataFileUtilClient import DataFileUtil
 from util import (
@@ -22,7 +28,12 @@ from util import (
     load_ama,
 )
 # kinda cheating, but I don't want to duplicate code for no good reason.
-from kb_hisat2.util import check_reference, get_object_names
+from kb_hisat2.util import (
+    ObjectInfoCache,
+    check_reference,
+    get_object_names,
+    get_reads_counts
+)
 
 
 TEST_GBK_FILE = os.path.join("data", "at_chrom1_section.gbk")
@@ -154,6 +165,10 @@ class kb_hisat2Test(unittest.TestCase):
             cls.ws_client.delete_workspace({'workspace': cls.ws_name})
             print('Test workspace was deleted')
 
+    def setUp(self):
+        # alignments get checkpointed and memoized in scratch, so each test starts without any.
+        shutil.rmtree(os.path.join(self.scratch, MANIFEST_DIR), ignore_errors=True)
+
     def get_ws_client(self):
         return self.__class__.ws_client
 
@@ -191,6 +206,25 @@ class kb_hisat2Test(unittest.TestCase):
         idx_prefix = manager.get_hisat2_index(self.assembly_ref)
         self.assertIn("kb_hisat2_idx", idx_prefix)
 
+    def test_build_hisat2_index_cached(self):
+        manager = Hisat2IndexManager(self.wsURL, self.callback_url, self.scratch)
+        idx_prefix = manager.get_hisat2_index(self.genome_ref)
+        # the genome and its assembly have the same sequence, so they share one cached index.
+        self.assertEqual(idx_prefix, manager.get_hisat2_index(self.assembly_ref))
+        self.assertTrue(os.path.exists(idx_prefix + ".1.ht2"))
+
+    def test_build_hisat2_index_memory_frugal(self):
+        # the memory-frugal build settings don't change the index, so a build with them lands
+        # in the same cache entry.
+        manager = Hisat2IndexManager(self.wsURL, self.callback_url, self.scratch)
+        idx_prefix = manager.get_hisat2_index(self.genome_ref, options={
+            "num_threads": 1,
+            "bmaxdivn": 32,
+            "dcv": 4096
+        })
+        self.assertTrue(os.path.exists(idx_prefix + ".1.ht2"))
+        self.assertEqual(idx_prefix, manager.get_hisat2_index(self.genome_ref))
+
     def test_run_hisat2_readsset_ok(self):
         res = self.get_impl().run_hisat2(self.get_context(), {
             "ws_name": self.ws_name,
@@ -225,6 +259,36 @@ class kb_hisat2Test(unittest.TestCase):
             self.assertTrue(res["alignment_objs"][reads_ref]["name"].endswith("_alignment"))
             self.assertTrue(check_reference(res["alignment_objs"][reads_ref]["ref"]))
 
+    def test_run_hisat2_readsset_local_pool_ok(self):
+        res = self.get_impl().run_hisat2(self.get_context(), {
+            "ws_name": self.ws_name,
+            "sampleset_ref": self.single_end_reads_set,
+            "genome_ref": self.genome_ref,
+            "alignmentset_suffix": "_local_alignment_set",
+            "alignment_suffix": "_local_alignment",
+            "quality_score": "phred33",
+            "min_intron_length": 20,
+            "max_intron_length": 500000,
+            "runner": "local_pool",
+            "build_report": 0
+        })[0]
+        self.assertIsNotNone(res)
+        self.assertTrue(check_reference(res["alignmentset_ref"]))
+        set_names = get_object_names([res["alignmentset_ref"]], self.wsURL)
+        self.assertTrue(set_names[res["alignmentset_ref"]].endswith("_local_alignment_set"))
+        self.assertTrue(len(list(res["alignment_objs"].keys())) == 2)
+        for reads_ref in res["alignment_objs"]:
+            ref_from_refpath = reads_ref.split(';')[-1]
+            self.assertIn(ref_from_refpath, self.reads_refs)
+            self.assertTrue(res["alignment_objs"][reads_ref]["name"].endswith("_local_alignment"))
+            self.assertTrue(check_reference(res["alignment_objs"][reads_ref]["ref"]))
+        # the pipeline's worker threads trace under the batch, so the job is the only root.
+        with open(res["profile_file"]) as f:
+            profile = json.load(f)
+        roots = [span["name"] for span in profile["spans"] if span["parent_id"] is None]
+        self.assertEqual(roots, ["job"])
+        self.assertTrue([span for span in profile["spans"] if span["name"] == "run_hisat2"])
+
     def test_run_hisat2_single_end_lib_ok(self):
         res = self.get_impl().run_hisat2(self.get_context(), {
             "ws_name": self.ws_name,
@@ -267,6 +331,403 @@ class kb_hisat2Test(unittest.TestCase):
             self.assertEqual(align_stats.get('unmapped_reads'), 173)
             self.assertEqual(align_stats.get('singletons'), 0)
             self.assertEqual(align_stats.get('multiple_alignments'), 4037)
+            # the stats gathered while aligning should agree with the uploaded ones.
+            native_stats = res["alignment_objs"][reads_ref]["alignment_stats"]
+            self.assertEqual(native_stats["hisat2_summary"]["Total reads"], 15254)
+            self.assertEqual(native_stats["primary_alignments"], 15254)
+            self.assertEqual(native_stats["mapped"], 15081)
+            self.assertEqual(native_stats["unmapped"], 173)
+        # every stage should be in the run profile, along with the report it ends with.
+        with open(res["profile_file"]) as f:
+            profile = json.load(f)
+        span_names = set(span["name"] for span in profile["spans"])
+        for name in ["job", "run_single", "build_index", "fetch_reads", "run_hisat2",
+                     "upload_alignment", "build_report"]:
+            self.assertIn(name, span_names)
+        report = self.dfu.get_objects({"object_refs": [res["report_ref"]]})['data'][0]['data']
+        self.assertIn("Run profile:", report["text_message"])
+        # QualiMap only runs when asked for.
+        self.assertNotIn("qualimap", span_names)
+        self.assertEqual(len(report["html_links"]), 1)
+        # the intermediate files are gone, but their peak size was recorded.
+        self.assertIn("Peak scratch space", report["text_message"])
+        run_span = [span for span in profile["spans"] if span["name"] == "run_single"][0]
+        self.assertGreater(run_span["attrs"]["peak_scratch_bytes"], 0)
+        self.assertFalse(os.path.exists(os.path.join(self.scratch, "accepted_hits.bam")))
+        self.assertFalse([f for f in os.listdir(self.scratch) if f.startswith("hisat2_report_")])
+
+    def test_reads_stream_failed_download(self):
+        fifo_path = os.path.join(self.scratch, "failed_stream.fq")
+        if os.path.exists(fifo_path):
+            os.remove(fifo_path)
+        os.mkfifo(fifo_path)
+        stream = ReadsStream("http://localhost:1", "no_such_node", fifo_path, token="")
+        stream.start()
+        # the reader gets EOF, instead of waiting forever on a download that failed, and the
+        # failure comes out when the stream is closed.
+        with open(fifo_path, "rb") as f:
+            self.assertEqual(f.read(), b"")
+        with self.assertRaises(RuntimeError):
+            close_reads_streams([stream])
+        os.remove(fifo_path)
+
+    def test_run_hisat2_stream_reads_ok(self):
+        res = self.get_impl().run_hisat2(self.get_context(), {
+            "ws_name": self.ws_name,
+            "sampleset_ref": self.single_end_ref_wt_1,
+            "condition": "wt",
+            "genome_ref": self.genome_ref,
+            "alignmentset_suffix": "_alignment_set",
+            "alignment_suffix": "_streamed_alignment",
+            "num_threads": 2,
+            "quality_score": "phred33",
+            "min_intron_length": 20,
+            "max_intron_length": 500000,
+            "stream_reads": 1,
+            "build_report": 0
+        })[0]
+        self.assertIsNotNone(res)
+        self.assertTrue(len(list(res["alignment_objs"].keys())) == 1)
+        for reads_ref in res["alignment_objs"]:
+            alignment_ref = res["alignment_objs"][reads_ref]["ref"]
+            self.assertTrue(check_reference(alignment_ref))
+            alignment_data = self.dfu.get_objects(
+                                {"object_refs": [alignment_ref]})['data'][0]['data']
+            align_stats = alignment_data.get('alignment_stats')
+            # should be the same alignment as when the reads get downloaded first.
+            self.assertEqual(align_stats.get('total_reads'), 15254)
+            self.assertEqual(align_stats.get('mapped_reads'), 15081)
+
+    def test_run_hisat2_sharded_ok(self):
+        res = self.get_impl().run_hisat2(self.get_context(), {
+            "ws_name": self.ws_name,
+            "sampleset_ref": self.single_end_ref_wt_1,
+            "condition": "wt",
+            "genome_ref": self.genome_ref,
+            "alignmentset_suffix": "_alignment_set",
+            "alignment_suffix": "_sharded_alignment",
+            "num_threads": 2,
+            "quality_score": "phred33",
+            "min_intron_length": 20,
+            "max_intron_length": 500000,
+            "num_shards": 2,
+            "runner": "local_pool",
+            "build_report": 0
+        })[0]
+        self.assertIsNotNone(res)
+        self.assertTrue(len(list(res["alignment_objs"].keys())) == 1)
+        for reads_ref in res["alignment_objs"]:
+            alignment_ref = res["alignment_objs"][reads_ref]["ref"]
+            self.assertTrue(check_reference(alignment_ref))
+            alignment_data = self.dfu.get_objects(
+                                {"object_refs": [alignment_ref]})['data'][0]['data']
+            align_stats = alignment_data.get('alignment_stats')
+            # the merged shards should be the same alignment as the whole library.
+            self.assertEqual(align_stats.get('total_reads'), 15254)
+            self.assertEqual(align_stats.get('mapped_reads'), 15081)
+            native_stats = res["alignment_objs"][reads_ref]["alignment_stats"]
+            self.assertEqual(native_stats["mapped"], 15081)
+        with open(res["profile_file"]) as f:
+            profile = json.load(f)
+        self.assertEqual(len([span for span in profile["spans"]
+                              if span["name"] == "run_hisat2" and "shard" in span["attrs"]]), 2)
+        roots = [span["name"] for span in profile["spans"] if span["parent_id"] is None]
+        self.assertEqual(roots, ["job"])
+
+    def test_batch_manifest_shared_ok(self):
+        path = os.path.join(self.scratch, MANIFEST_DIR, "shared_manifest.json")
+        manifests = [BatchManifest(path), BatchManifest(path)]
+
+        def record(idx):
+            for key in range(100):
+                manifests[idx].record("{}_{}".format(idx, key), "1/2/3", {"ref": "4/5/6"})
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(record, [0, 1]))
+        # neither writer loses the other's entries.
+        self.assertEqual(len(BatchManifest(path).entries), 200)
+        manifests[0].discard("1_0")
+        self.assertEqual(len(BatchManifest(path).entries), 199)
+
+    def test_file_cache_eviction_ok(self):
+        cache_dir = os.path.join(self.scratch, "test_file_cache_" + str(int(time.time() * 1000)))
+
+        def publish(cache, key):
+            staging = cache.make_staging_dir()
+            with open(os.path.join(staging, "data"), "wb") as f:
+                f.write(b"x" * 1000)
+            return cache.publish(key, staging)
+
+        # room for two entries, but not three.
+        with FileCache(cache_dir, 2500) as cache:
+            publish(cache, "a")
+            publish(cache, "b")
+        with FileCache(cache_dir, 2500) as cache:
+            # "a" gets used again, so "b" is now the least recently used.
+            time.sleep(0.1)
+            self.assertIsNotNone(cache.get("a"))
+        with FileCache(cache_dir, 2500) as cache:
+            publish(cache, "c")
+            self.assertIsNotNone(cache.get("a"))
+            self.assertIsNone(cache.get("b"))
+            self.assertIsNotNone(cache.get("c"))
+            # while pinned here, "a" and "c" can't be evicted by anyone else, even though
+            # "a" is the least recently used.
+            with FileCache(cache_dir, 2500) as other:
+                publish(other, "d")
+                self.assertIsNotNone(cache.get("a"))
+                self.assertIsNotNone(cache.get("c"))
+                self.assertIsNotNone(other.get("d"))
+        # once they're released, the cache gets back down to size.
+        with FileCache(cache_dir, 2500) as cache:
+            cache.evict()
+            self.assertEqual(len([k for k in os.listdir(cache_dir) if not k.startswith(".")]), 2)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def test_run_hisat2_resume_batch_ok(self):
+        params = {
+            "ws_name": self.ws_name,
+            "sampleset_ref": self.single_end_sampleset,
+            "genome_ref": self.genome_ref,
+            "alignmentset_suffix": "_resumed_alignment_set",
+            "alignment_suffix": "_resumed_alignment",
+            "num_threads": 2,
+            "quality_score": "phred33",
+            "min_intron_length": 20,
+            "max_intron_length": 500000,
+            "runner": "local_pool",
+            "build_report": 0
+        }
+        first = self.get_impl().run_hisat2(self.get_context(), dict(params))[0]
+        # running the same set again reuses the checkpointed alignments, and doesn't align
+        # anything.
+        second = self.get_impl().run_hisat2(self.get_context(), dict(params))[0]
+        self.assertEqual(sorted(first["alignment_objs"].keys()),
+                         sorted(second["alignment_objs"].keys()))
+        for reads_ref in first["alignment_objs"]:
+            self.assertEqual(first["alignment_objs"][reads_ref]["ref"],
+                             second["alignment_objs"][reads_ref]["ref"])
+        with open(second["profile_file"]) as f:
+            profile = json.load(f)
+        batch_spans = [span for span in profile["spans"] if span["name"] == "run_batch"]
+        self.assertEqual(batch_spans[0]["attrs"]["num_checkpointed"], 2)
+        self.assertFalse([span for span in profile["spans"] if span["name"] == "run_hisat2"])
+
+    def test_run_hisat2_memoized_ok(self):
+        params = {
+            "ws_name": self.ws_name,
+            "sampleset_ref": self.single_end_ref_wt_1,
+            "condition": "wt",
+            "genome_ref": self.genome_ref,
+            "alignmentset_suffix": "_alignment_set",
+            "alignment_suffix": "_memo_alignment",
+            "num_threads": 2,
+            "quality_score": "phred33",
+            "min_intron_length": 20,
+            "max_intron_length": 500000,
+            "build_report": 0
+        }
+        first = self.get_impl().run_hisat2(self.get_context(), dict(params))[0]
+        # the same alignment under another name is just a copy of the first one.
+        params["alignment_suffix"] = "_memo_alignment_copy"
+        second = self.get_impl().run_hisat2(self.get_context(), dict(params))[0]
+        with open(second["profile_file"]) as f:
+            profile = json.load(f)
+        self.assertFalse([span for span in profile["spans"] if span["name"] == "run_hisat2"])
+        self.assertEqual(len([span for span in profile["spans"]
+                              if span["name"] == "copy_alignment"]), 1)
+        for reads_ref in first["alignment_objs"]:
+            first_alignment = first["alignment_objs"][reads_ref]
+            second_alignment = second["alignment_objs"][reads_ref]
+            self.assertNotEqual(first_alignment["ref"], second_alignment["ref"])
+            self.assertTrue(check_reference(second_alignment["ref"]))
+            self.assertTrue(second_alignment["name"].endswith("_memo_alignment_copy"))
+            self.assertEqual(first_alignment["alignment_stats"],
+                             second_alignment["alignment_stats"])
+
+    def test_run_hisat2_concurrent_ok(self):
+        def run(reads_ref):
+            return self.get_impl().run_hisat2(self.get_context(), {
+                "ws_name": self.ws_name,
+                "sampleset_ref": reads_ref,
+                "condition": "wt",
+                "genome_ref": self.genome_ref,
+                "alignmentset_suffix": "_alignment_set",
+                "alignment_suffix": "_concurrent_alignment",
+                "num_threads": 2,
+                "quality_score": "phred33",
+                "min_intron_length": 20,
+                "max_intron_length": 500000,
+                "build_report": 0
+            })[0]
+        # two runs on the same server and scratch at once each keep to their own files.
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            results = list(executor.map(run, [self.single_end_ref_wt_1,
+                                              self.single_end_ref_wt_2]))
+        for res in results:
+            self.assertTrue(len(list(res["alignment_objs"].keys())) == 1)
+            for reads_ref in res["alignment_objs"]:
+                self.assertTrue(check_reference(res["alignment_objs"][reads_ref]["ref"]))
+                native_stats = res["alignment_objs"][reads_ref]["alignment_stats"]
+                self.assertGreater(native_stats["mapped"], 0)
+        self.assertNotEqual(results[0]["alignment_objs"], results[1]["alignment_objs"])
+        # each one has its own profile, of its own alignment.
+        self.assertNotEqual(results[0]["profile_file"], results[1]["profile_file"])
+        for res in results:
+            with open(res["profile_file"]) as f:
+                profile = json.load(f)
+            self.assertEqual(len([span for span in profile["spans"]
+                                  if span["name"] == "run_hisat2"]), 1)
+        # and clean up after themselves.
+        self.assertFalse([f for f in os.listdir(self.scratch) if f.startswith(JOB_DIR_PREFIX)])
+
+    def test_run_hisat2_shared_index_ok(self):
+        res = self.get_impl().run_hisat2(self.get_context(), {
+            "ws_name": self.ws_name,
+            "sampleset_ref": self.single_end_sampleset,
+            "genome_ref": self.genome_ref,
+            "alignmentset_suffix": "_shared_alignment_set",
+            "alignment_suffix": "_shared_alignment",
+            "num_threads": 2,
+            "quality_score": "phred33",
+            "min_intron_length": 20,
+            "max_intron_length": 500000,
+            "runner": "local_pool",
+            "shared_index": 1,
+            "build_report": 0
+        })[0]
+        self.assertIsNotNone(res)
+        self.assertTrue(len(list(res["alignment_objs"].keys())) == 2)
+        for reads_ref in res["alignment_objs"]:
+            self.assertTrue(check_reference(res["alignment_objs"][reads_ref]["ref"]))
+        # the index only gets read into the page cache once, however many aligners use it.
+        with open(res["profile_file"]) as f:
+            profile = json.load(f)
+        prewarms = [span for span in profile["spans"] if span["name"] == "prewarm_index"]
+        self.assertEqual(len([span for span in prewarms if span["bytes"] > 0]), 1)
+
+    def test_run_hisat2_multiplexed_ok(self):
+        res = self.get_impl().run_hisat2(self.get_context(), {
+            "ws_name": self.ws_name,
+            "sampleset_ref": self.single_end_sampleset,
+            "genome_ref": self.genome_ref,
+            "alignmentset_suffix": "_multiplexed_alignment_set",
+            "alignment_suffix": "_multiplexed_alignment",
+            "num_threads": 2,
+            "quality_score": "phred33",
+            "min_intron_length": 20,
+            "max_intron_length": 500000,
+            "runner": "local_pool",
+            "multiplex": 1,
+            "build_report": 0
+        })[0]
+        self.assertIsNotNone(res)
+        self.assertTrue(len(list(res["alignment_objs"].keys())) == 2)
+        for reads_ref in res["alignment_objs"]:
+            self.assertTrue(check_reference(res["alignment_objs"][reads_ref]["ref"]))
+            native_stats = res["alignment_objs"][reads_ref]["alignment_stats"]
+            # each library's summary only counts its own reads, not the whole group's.
+            self.assertEqual(native_stats["hisat2_summary"]["Total reads"], 15254)
+            if reads_ref.split(';')[-1] == self.single_end_ref_wt_1:
+                # the same alignment as the library gets on its own.
+                self.assertEqual(native_stats["mapped"], 15081)
+        # both libraries went through a single hisat2 process.
+        with open(res["profile_file"]) as f:
+            profile = json.load(f)
+        names = [span["name"] for span in profile["spans"]]
+        self.assertEqual(names.count("run_hisat2_multiplexed"), 1)
+        self.assertEqual(names.count("run_hisat2"), 0)
+
+    def test_run_hisat2_largest_first_ok(self):
+        res = self.get_impl().run_hisat2(self.get_context(), {
+            "ws_name": self.ws_name,
+            "sampleset_ref": self.single_end_sampleset,
+            "genome_ref": self.genome_ref,
+            "alignmentset_suffix": "_scheduled_alignment_set",
+            "alignment_suffix": "_scheduled_alignment",
+            "quality_score": "phred33",
+            "min_intron_length": 20,
+            "max_intron_length": 500000,
+            "runner": "local_pool",
+            "max_concurrent_tasks": 1,
+            "build_report": 0
+        })[0]
+        self.assertIsNotNone(res)
+        # the results are back in the order of the set, whatever order they ran in.
+        self.assertEqual([ref.split(';')[-1] for ref in res["alignment_objs"]], self.reads_refs)
+        with open(res["profile_file"]) as f:
+            profile = json.load(f)
+        schedule = [span for span in profile["spans"] if span["name"] == "run_batch"][0][
+            "attrs"]["schedule"]
+        info_cache = ObjectInfoCache(self.wsURL)
+        total_bases = [get_reads_counts(info_cache.get_info(ref))[1] for ref in schedule]
+        self.assertEqual(total_bases, sorted(total_bases, reverse=True))
+        # with one task at a time, no two alignments overlap.
+        alignments = sorted([span for span in profile["spans"] if span["name"] == "run_hisat2"],
+                            key=lambda span: span["start"])
+        self.assertEqual(len(alignments), 2)
+        self.assertGreaterEqual(alignments[1]["start"], alignments[0]["end"])
+
+    def test_run_hisat2_largest_first_parallel_ok(self):
+        res = self.get_impl().run_hisat2(self.get_context(), {
+            "ws_name": self.ws_name,
+            "sampleset_ref": self.single_end_sampleset,
+            "genome_ref": self.genome_ref,
+            "alignmentset_suffix": "_scheduled_parallel_alignment_set",
+            "alignment_suffix": "_scheduled_parallel_alignment",
+            "quality_score": "phred33",
+            "min_intron_length": 20,
+            "max_intron_length": 500000,
+            "runner": "parallel",
+            "max_concurrent_tasks": 1,
+            "build_report": 0
+        })[0]
+        self.assertIsNotNone(res)
+        self.assertEqual([ref.split(';')[-1] for ref in res["alignment_objs"]], self.reads_refs)
+        for reads_ref in res["alignment_objs"]:
+            self.assertTrue(check_reference(res["alignment_objs"][reads_ref]["ref"]))
+        with open(res["profile_file"]) as f:
+            profile = json.load(f)
+        # KBParallel is told to run one subtask at a time, biggest library first.
+        kbparallel = [span for span in profile["spans"] if span["name"] == "kbparallel"]
+        self.assertEqual(len(kbparallel), 1)
+        self.assertEqual(kbparallel[0]["attrs"]["num_tasks"], 2)
+        self.assertEqual(kbparallel[0]["attrs"]["concurrent_njsw_tasks"], 1)
+        schedule = [span for span in profile["spans"] if span["name"] == "run_batch"][0][
+            "attrs"]["schedule"]
+        info_cache = ObjectInfoCache(self.wsURL)
+        total_bases = [get_reads_counts(info_cache.get_info(ref))[1] for ref in schedule]
+        self.assertEqual(total_bases, sorted(total_bases, reverse=True))
+
+    def test_run_hisat2_hybrid_ok(self):
+        res = self.get_impl().run_hisat2(self.get_context(), {
+            "ws_name": self.ws_name,
+            "sampleset_ref": self.single_end_sampleset,
+            "genome_ref": self.genome_ref,
+            "alignmentset_suffix": "_hybrid_alignment_set",
+            "alignment_suffix": "_hybrid_alignment",
+            "quality_score": "phred33",
+            "min_intron_length": 20,
+            "max_intron_length": 500000,
+            "runner": "hybrid",
+            "build_report": 1
+        })[0]
+        self.assertIsNotNone(res)
+        self.assertTrue(len(list(res["alignment_objs"].keys())) == 2)
+        for reads_ref in res["alignment_objs"]:
+            self.assertTrue(check_reference(res["alignment_objs"][reads_ref]["ref"]))
+        # the test libraries are small, so they're both aligned here, without any subtasks.
+        with open(res["profile_file"]) as f:
+            profile = json.load(f)
+        run_batch = [span for span in profile["spans"] if span["name"] == "run_batch"][0]
+        self.assertEqual(run_batch["attrs"]["num_local"], 2)
+        self.assertEqual(run_batch["attrs"]["num_remote"], 0)
+        self.assertFalse([span for span in profile["spans"] if span["name"] == "kbparallel"])
+        # the local run is traced under the batch, even though it runs in a thread of its own.
+        run_local = [span for span in profile["spans"] if span["name"] == "run_local"]
+        self.assertEqual([span["parent_id"] for span in run_local], [run_batch["id"]])
+        report = self.dfu.get_objects({"object_refs": [res["report_ref"]]})['data'][0]['data']
+        self.assertIn("Where each reads library was aligned", report["text_message"])
+        self.assertEqual(report["text_message"].count(": local ("), 2)
 
     def test_run_hisat2_assembly_ok(self):
         res = self.get_impl().run_hisat2(self.get_context(), {
@@ -286,6 +747,7 @@ class kb_hisat2Test(unittest.TestCase):
             "max_intron_length": 500000,
             "no_spliced_alignment": 0,
             "transcriptome_mapping_only": 0,
+            "qc_mode": "qualimap",
             "build_report": 1
         })[0]
         self.assertIsNotNone(res)
@@ -302,6 +764,12 @@ class kb_hisat2Test(unittest.TestCase):
             self.assertIn(ref_from_refpath, self.reads_refs)
             self.assertTrue(res["alignment_objs"][reads_ref]["name"].endswith("_alignment"))
             self.assertTrue(check_reference(res["alignment_objs"][reads_ref]["ref"]))
+        # the QualiMap pages are merged into the alignment stats page.
+        report = self.dfu.get_objects({"object_refs": [res["report_ref"]]})['data'][0]['data']
+        self.assertEqual(len(report["html_links"]), 1)
+        with open(res["profile_file"]) as f:
+            profile = json.load(f)
+        self.assertIn("qualimap", set(span["name"] for span in profile["spans"]))
 
     def test_run_hisat2_ama_ok(self):
         res = self.get_impl().run_hisat2(self.get_context(), {